@@ -0,0 +1,311 @@
+import re
+from app.definitions import (
+    ADD_TRAINING_TO_FAVS,
+    MEDIA_UPLOAD,
+    NEW_TRAINING,
+    SIGNUP,
+    TRAINING_SERVICE,
+    USER_SERVICE,
+)
+from app.entry_storage import TERM_COLUMNS, VISIBLE_ENTRY
+from app.route_templates import route_template
+
+# Definitions of the /history aggregates. Each one counts the entries of a
+# service that match its filters, grouped by a key.
+
+KEY_EXPRESSIONS = {
+    "month": "substr(datetime, 1, 7)",  # YYYY-MM
+}
+# Columns of the long-term rollups of expired entries (see app/retention.py)
+ROLLUP_COLUMNS = ("service", "action", "path_template", "country", "training_type")
+# Columns of the rolled up distinct datetimes
+DATETIME_ROLLUP_COLUMNS = ("service", "action", "path_template")
+# Same keys, computed in Python over a single entry (see app/live.py)
+KEY_FUNCTIONS = {
+    "month": lambda entry: entry.datetime[:7],
+    "path_template": lambda entry: route_template(entry.path),
+}
+
+
+def _literal(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+def _term_ids(condition: str) -> str:
+    """
+    Returns an array of the ids of the terms whose value matches the condition
+    """
+    return f"ARRAY(SELECT id FROM entry_term WHERE value {condition})"
+
+
+class HistoryAggregate:
+    """
+    :param str name: Name of the aggregate (and of its /history endpoint)
+    :param str service: Service whose entries are counted
+    :param str key: Entry column (or "month") the counts are grouped by
+    :param tuple actions: Only count entries with one of these actions
+    :param tuple paths: Only count entries with one of these paths
+    :param tuple path_templates: Only count entries with one of these route
+        templates (see app/route_templates.py)
+    :param str path_like: Only count entries whose path matches this pattern
+    :param str count_distinct: Count distinct values of this column instead
+        of rows
+    """
+
+    def __init__(
+        self,
+        name: str,
+        service: str,
+        key: str,
+        actions: tuple = (),
+        paths: tuple = (),
+        path_templates: tuple = (),
+        path_like: str = None,
+        count_distinct: str = None,
+    ):
+        self.name = name
+        self.service = service
+        self.key = key
+        self.actions = actions
+        self.paths = paths
+        self.path_templates = path_templates
+        self.path_like = path_like
+        self.count_distinct = count_distinct
+        self._path_pattern = None
+        if path_like:
+            pattern = "".join(
+                {"%": ".*", "_": "."}.get(char, re.escape(char)) for char in path_like
+            )
+            self._path_pattern = re.compile(pattern + r"\Z", re.DOTALL)
+
+    def matches(self, entry) -> bool:
+        """
+        Whether the entry passes the filters of where_sql()
+        """
+        if entry.service != self.service:
+            return False
+        if self.actions and entry.action not in self.actions:
+            return False
+        if self.paths and entry.path not in self.paths:
+            return False
+        if (
+            self.path_templates
+            and route_template(entry.path) not in self.path_templates
+        ):
+            return False
+        if self._path_pattern and not self._path_pattern.match(entry.path or ""):
+            return False
+        return True
+
+    def key_of(self, entry):
+        if self.key in KEY_FUNCTIONS:
+            return KEY_FUNCTIONS[self.key](entry)
+        return getattr(entry, self.key)
+
+    def where_sql(self, since: str = None) -> str:
+        conditions = [f"service = {_literal(self.service)}"]
+        if since:
+            conditions.append(f"datetime >= {_literal(since)}")
+        if self.actions:
+            actions = ", ".join(_literal(action) for action in self.actions)
+            conditions.append(f"action IN ({actions})")
+        if self.paths:
+            paths = ", ".join(_literal(path) for path in self.paths)
+            conditions.append(f"path IN ({paths})")
+        if self.path_templates:
+            templates = ", ".join(
+                _literal(template) for template in self.path_templates
+            )
+            conditions.append(f"path_template IN ({templates})")
+        if self.path_like:
+            conditions.append(f"path LIKE {_literal(self.path_like)}")
+        return " AND ".join(conditions)
+
+    def encoded_where_sql(self, since: str = None) -> str:
+        """
+        where_sql() over entry_compact (aliased e) instead of the entry view:
+        the values are resolved to their term ids first, so that the indexes
+        on the ids can be used. Hides the entries of deleted trainings, as
+        the view does
+        """
+        service = _literal(self.service)
+        conditions = [
+            f"e.service_id = (SELECT id FROM entry_term WHERE value = {service})"
+        ]
+        if since:
+            conditions.append(f"e.datetime >= {_literal(since)}")
+        for column, values in (
+            ("action", self.actions),
+            ("path", self.paths),
+            ("path_template", self.path_templates),
+        ):
+            if values:
+                listed = ", ".join(_literal(value) for value in values)
+                conditions.append(f"e.{column}_id = ANY({_term_ids(f'IN ({listed})')})")
+        if self.path_like:
+            pattern = f"LIKE {_literal(self.path_like)}"
+            conditions.append(f"e.path_id = ANY({_term_ids(pattern)})")
+        conditions.append(VISIBLE_ENTRY)
+        return " AND ".join(conditions)
+
+    def uses_rollups(self) -> bool:
+        """
+        Whether the aggregate can also count the rolled up expired entries:
+        its filters and key must only use rollup columns. Distinct counts
+        can't be summed across rollup buckets, which may share values: only
+        distinct datetimes are rolled up, with fewer columns
+        """
+        if self.paths or self.path_like:
+            return False
+        if self.count_distinct == "datetime":
+            columns = DATETIME_ROLLUP_COLUMNS
+        elif self.count_distinct:
+            return False
+        else:
+            columns = ROLLUP_COLUMNS
+        return self.key == "month" or self.key in columns
+
+    def rollup_sql(self, table: str = "entry_rollup") -> str:
+        """
+        Returns a SELECT of (key, count) rows of the aggregate over the
+        rollups
+        """
+        return (
+            f"SELECT {self.key} AS key, sum(count) AS count FROM {table} "
+            f"WHERE {self.where_sql()} GROUP BY {self.key}"
+        )
+
+    def rollup_datetimes_sql(self, table: str = "entry_rollup_datetime") -> str:
+        """
+        Returns a SELECT of (key, datetime) rows of the aggregate over the
+        rolled up distinct datetimes
+        """
+        return (
+            f"SELECT {self.key} AS key, datetime FROM {table} WHERE {self.where_sql()}"
+        )
+
+    def _source(self, table: str, since: str, encoded: bool) -> tuple:
+        """
+        Returns the key expression and the FROM and WHERE clauses of the
+        entries counted, and the expression of the count_distinct column
+        """
+        key = KEY_EXPRESSIONS.get(self.key, self.key)
+        if not encoded:
+            source = f"FROM {table} WHERE {self.where_sql(since)}"
+            return key, source, self.count_distinct
+        source = "FROM entry_compact e"
+        if self.key in TERM_COLUMNS:
+            key = "k.value"
+            source += f" LEFT JOIN entry_term k ON k.id = e.{self.key}_id"
+        source += f" WHERE {self.encoded_where_sql(since)}"
+        distinct = self.count_distinct
+        if distinct in TERM_COLUMNS:
+            # Distinct ids are distinct values
+            distinct = f"e.{distinct}_id"
+        return key, source, distinct
+
+    def sql(
+        self, table: str = "entry", since: str = None, encoded: bool = False
+    ) -> str:
+        """
+        Returns a SELECT of (key, count) rows computing the aggregate (over
+        the entries since the given datetime, if any). With encoded, the
+        entries are read from entry_compact (Postgres only, see
+        encoded_where_sql)
+        """
+        key, source, distinct = self._source(table, since, encoded)
+        count = f"count(DISTINCT {distinct})" if distinct else "count(*)"
+        return f"SELECT {key} AS key, {count} AS count {source} GROUP BY {key}"
+
+    def all_time_sql(self, encoded: bool = False) -> str:
+        """
+        Returns sql() plus the rolled up expired entries, if the aggregate
+        uses them
+        """
+        counts = self.sql(encoded=encoded)
+        if self.uses_rollups() and self.count_distinct:
+            # A datetime may be both retained and rolled up, count it once
+            key, source, _ = self._source("entry", None, encoded)
+            counts = (
+                f"SELECT key, count(DISTINCT datetime) AS count FROM ("
+                f"SELECT {key} AS key, datetime {source} "
+                f"UNION ALL {self.rollup_datetimes_sql()}) AS parts GROUP BY key"
+            )
+        elif self.uses_rollups():
+            # Entries past retention only remain in the rollups
+            counts = (
+                f"SELECT key, sum(count)::bigint AS count FROM ({counts} "
+                f"UNION ALL {self.rollup_sql()}) AS parts GROUP BY key"
+            )
+        return counts
+
+
+USERS_AUTH = HistoryAggregate(
+    "users_auth",
+    USER_SERVICE,
+    key="path_template",
+    path_templates=(
+        "/login/",
+        "/login/google/",
+        "/signup/",
+        "/signup/google/",
+        "/login/forgot_password",
+    ),
+)
+# Blocks which happened at the same datetime are counted once
+BLOCKED_USERS = HistoryAggregate(
+    "blocked_users",
+    USER_SERVICE,
+    key="month",
+    path_templates=("/users/{user_id}/block",),
+    count_distinct="datetime",
+)
+USERS_BY_LOCATION = HistoryAggregate(
+    "users_by_location", USER_SERVICE, key="country", actions=(SIGNUP,)
+)
+TRAININGS_REQUESTS_COUNT = HistoryAggregate(
+    "trainings_requests_count",
+    TRAINING_SERVICE,
+    key="action",
+    actions=(NEW_TRAINING, MEDIA_UPLOAD),
+)
+NEW_TRAININGS_PER_MONTH = HistoryAggregate(
+    "new_trainings_per_month",
+    TRAINING_SERVICE,
+    key="month",
+    actions=(NEW_TRAINING,),
+    count_distinct="datetime",
+)
+TRAININGS_UPLOADS_BY_USER = HistoryAggregate(
+    "trainings_uploads_by_user",
+    TRAINING_SERVICE,
+    key="user_id",
+    actions=(MEDIA_UPLOAD,),
+)
+TRAININGS_PER_TYPE = HistoryAggregate(
+    "trainings_per_type", TRAINING_SERVICE, key="training_type", actions=(NEW_TRAINING,)
+)
+FAVORITE_TRAININGS_PER_LOCATION = HistoryAggregate(
+    "favorite_trainings_per_location",
+    USER_SERVICE,
+    key="country",
+    actions=(ADD_TRAINING_TO_FAVS,),
+)
+FAVORITE_TRAININGS_BY_USER = HistoryAggregate(
+    "favorite_trainings_by_user",
+    USER_SERVICE,
+    key="user_id",
+    actions=(ADD_TRAINING_TO_FAVS,),
+)
+
+HISTORY_AGGREGATES = (
+    USERS_AUTH,
+    BLOCKED_USERS,
+    USERS_BY_LOCATION,
+    TRAININGS_REQUESTS_COUNT,
+    NEW_TRAININGS_PER_MONTH,
+    TRAININGS_UPLOADS_BY_USER,
+    TRAININGS_PER_TYPE,
+    FAVORITE_TRAININGS_PER_LOCATION,
+    FAVORITE_TRAININGS_BY_USER,
+)
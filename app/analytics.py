@@ -0,0 +1,562 @@
+import asyncio
+import fcntl
+import itertools
+import logging
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from enum import Enum
+from typing import Optional
+from sqlalchemy import text
+from app.aggregates import HISTORY_AGGREGATES
+from app.db import engine
+from app.entry_storage import ENTRY_COLUMNS
+
+# Optional analytics backend for /history: a local DuckDB file
+# (https://duckdb.org/, columnar storage and vectorized execution) mirroring
+# the entries, so the history aggregates can be computed there instead of in
+# Postgres (HISTORY_BACKEND, or per aggregate with HISTORY_BACKENDS).
+#
+# Each API process claims its own file under ANALYTICS_DIR and keeps it in
+# sync every ANALYTICS_SYNC_SECONDS:
+#   - new entries are copied by id watermark (COPY to CSV, read by DuckDB),
+#     re-reading the last ANALYTICS_SYNC_LOOKBACK ids in case a transaction
+#     committed a lower id late;
+#   - updated and deleted entries (including the retention job and the
+#     compaction of deleted trainings) are logged in entry_change by a
+#     trigger on entry_compact, and replaced in the mirror;
+#   - the rollups and the tombstones of deleted trainings are copied whole.
+# The log is pruned after ANALYTICS_CHANGE_RETENTION_SECONDS; a mirror that
+# wasn't synced for that long is rebuilt. Until its first sync is done the
+# endpoints keep reading the materialized views.
+
+ANALYTICS_DIR = os.environ.get("ANALYTICS_DIR")  # the mirror is disabled when unset
+ANALYTICS_SYNC_SECONDS = float(os.environ.get("ANALYTICS_SYNC_SECONDS", 5))
+ANALYTICS_SYNC_BATCH = int(os.environ.get("ANALYTICS_SYNC_BATCH", 100000))
+ANALYTICS_SYNC_LOOKBACK = int(os.environ.get("ANALYTICS_SYNC_LOOKBACK", 10000))
+ANALYTICS_CHANGE_RETENTION_SECONDS = float(
+    os.environ.get("ANALYTICS_CHANGE_RETENTION_SECONDS", 86400)
+)
+ANALYTICS_THREADS = int(os.environ.get("ANALYTICS_THREADS", 4))
+# Backend of every aggregate, and comma-separated name=backend overrides
+HISTORY_BACKEND = os.environ.get("HISTORY_BACKEND", "postgres")
+HISTORY_BACKENDS = os.environ.get("HISTORY_BACKENDS", "")
+
+PRUNE_INTERVAL_SECONDS = 3600
+# NULL marker of the CSV files (empty fields are empty strings)
+CSV_NULL = "\\N"
+
+ENTRY_TYPES = {"id": "BIGINT", "status_code": "INTEGER", "response_time": "DOUBLE"}
+ENTRY_MIRROR_COLUMNS = {
+    column: ENTRY_TYPES.get(column, "VARCHAR") for column in ENTRY_COLUMNS
+}
+ROLLUP_MIRROR_COLUMNS = {
+    "service": "VARCHAR",
+    "action": "VARCHAR",
+    "path_template": "VARCHAR",
+    "country": "VARCHAR",
+    "training_type": "VARCHAR",
+    "month": "VARCHAR",
+    "count": "BIGINT",
+    "distinct_datetimes": "BIGINT",
+}
+ROLLUP_DATETIME_MIRROR_COLUMNS = {
+    "service": "VARCHAR",
+    "action": "VARCHAR",
+    "path_template": "VARCHAR",
+    "month": "VARCHAR",
+    "datetime": "VARCHAR",
+}
+# Rollup tables copied whole, with their columns
+ROLLUP_TABLES = {
+    "entry_rollup": ROLLUP_MIRROR_COLUMNS,
+    "entry_rollup_datetime": ROLLUP_DATETIME_MIRROR_COLUMNS,
+}
+
+
+def _columns_ddl(columns: dict) -> str:
+    return ", ".join(f"{name} {kind}" for name, kind in columns.items())
+
+
+MIRROR_DDL = (
+    f"CREATE TABLE IF NOT EXISTS entry_mirror ({_columns_ddl(ENTRY_MIRROR_COLUMNS)})",
+    *(
+        f"CREATE TABLE IF NOT EXISTS {table} ({_columns_ddl(columns)})"
+        for table, columns in ROLLUP_TABLES.items()
+    ),
+    "CREATE TABLE IF NOT EXISTS training_tombstone (training_id VARCHAR, max_id BIGINT)",
+    "CREATE TABLE IF NOT EXISTS mirror_state "
+    "(watermark BIGINT, change_seq BIGINT, synced_at DOUBLE)",
+    # The same entries as the entry view of Postgres
+    """
+    CREATE OR REPLACE VIEW entry AS SELECT e.* FROM entry_mirror e
+    WHERE NOT EXISTS (
+        SELECT 1 FROM training_tombstone d
+        WHERE d.training_id = e.training_id AND e.id <= d.max_id
+    )
+    """,
+)
+
+# Postgres side: the log of updated and deleted entries
+CHANGELOG_TRIGGERS = {
+    "entry_compact_updated": "UPDATE",
+    "entry_compact_deleted": "DELETE",
+}
+CHANGELOG_FUNCTION = """
+    CREATE OR REPLACE FUNCTION entry_compact_changed() RETURNS trigger AS $$
+    BEGIN
+        INSERT INTO entry_change (entry_id) SELECT id FROM changed_rows;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+"""
+
+COPY_ENTRIES = (
+    f"SELECT {', '.join(ENTRY_COLUMNS)} FROM entry WHERE id > $1 ORDER BY id LIMIT $2"
+)
+COPY_CHANGED_ENTRIES = (
+    f"SELECT {', '.join(ENTRY_COLUMNS)} FROM entry WHERE id = ANY($1::bigint[])"
+)
+COPY_ROLLUPS = {
+    table: f"SELECT {', '.join(columns)} FROM {table}"
+    for table, columns in ROLLUP_TABLES.items()
+}
+MAX_CHANGE = text("SELECT max(seq) FROM entry_change")
+CHANGES = text(
+    "SELECT seq, entry_id FROM entry_change WHERE seq > :seq AND seq <= :target "
+    "ORDER BY seq LIMIT :limit"
+)
+TOMBSTONES = text(
+    "SELECT training_id, max_id FROM training_tombstone ORDER BY training_id"
+)
+PRUNE_CHANGES = text(
+    "DELETE FROM entry_change "
+    "WHERE changed_at < now() - make_interval(secs => :seconds)"
+)
+
+logger = logging.getLogger('app')
+
+
+class HistoryBackend(str, Enum):
+    postgres = "postgres"
+    duckdb = "duckdb"
+
+
+def parse_backends(default: str, overrides: str) -> dict:
+    """
+    Returns the backend of each aggregate, from the default one and the
+    comma-separated name=backend overrides
+    """
+    backends = {
+        aggregate.name: HistoryBackend(default) for aggregate in HISTORY_AGGREGATES
+    }
+    for override in filter(None, (item.strip() for item in overrides.split(","))):
+        name, _, backend = (part.strip() for part in override.partition("="))
+        if name not in backends:
+            raise ValueError(f"Unknown history aggregate: {name}")
+        backends[name] = HistoryBackend(backend)
+    return backends
+
+
+BACKENDS = parse_backends(HISTORY_BACKEND, HISTORY_BACKENDS)
+
+
+def _quote(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+def read_csv_sql(path: str, columns: dict) -> str:
+    """
+    Returns the DuckDB table function reading a CSV file written by COPY
+    """
+    types = ", ".join(
+        f"{_quote(name)}: {_quote(kind)}" for name, kind in columns.items()
+    )
+    return (
+        f"read_csv({_quote(path)}, header = false, nullstr = {_quote(CSV_NULL)}, "
+        f"columns = {{{types}}})"
+    )
+
+
+async def create_changelog(conn):
+    """
+    Creates the triggers logging the updated and deleted entries, if missing
+    """
+    await conn.execute(text(CHANGELOG_FUNCTION))
+    for name, event in CHANGELOG_TRIGGERS.items():
+        exists = await conn.scalar(
+            text("SELECT 1 FROM pg_trigger WHERE tgname = :name"), {"name": name}
+        )
+        if not exists:
+            await conn.execute(
+                text(
+                    f"CREATE TRIGGER {name} AFTER {event} ON entry_compact "
+                    f"REFERENCING OLD TABLE AS changed_rows FOR EACH STATEMENT "
+                    f"EXECUTE FUNCTION entry_compact_changed()"
+                )
+            )
+
+
+class AnalyticsMirror:
+    def __init__(
+        self,
+        sync_interval: float,
+        batch_size: int,
+        lookback: int,
+        change_retention: float,
+        threads: int,
+    ):
+        self.sync_interval = sync_interval
+        self.batch_size = batch_size
+        self.lookback = lookback
+        self.change_retention = change_retention
+        self.threads = threads
+        self.db = None
+        self.path = None
+        self.executor = None
+        # Highest entry id copied, and last change applied
+        self.watermark = 0
+        self.change_seq = 0
+        self.synced_at = None
+        self.tombstones = None
+        # Changes every time a sync changes the mirror. The instance id tells
+        # the mirrors of different processes apart in the ETags
+        self.instance = os.urandom(4).hex()
+        self.version = 0
+        self.ready = False
+        self.syncs = 0
+        self.copied = 0
+        self.changed = 0
+        self.rebuilds = 0
+        self.last_sync_seconds = None
+        self.pruned_at = 0
+
+    def open(self, path: str):
+        try:
+            import duckdb
+        except ImportError:
+            raise RuntimeError(
+                "The analytics mirror needs duckdb (poetry install -E analytics)"
+            )
+        self.path = path
+        self.db = duckdb.connect(path)
+        for statement in MIRROR_DDL:
+            self.db.execute(statement)
+        state = self.db.execute(
+            "SELECT watermark, change_seq, synced_at FROM mirror_state"
+        ).fetchone()
+        if state is None:
+            self.db.execute("INSERT INTO mirror_state VALUES (0, 0, NULL)")
+        else:
+            self.watermark, self.change_seq, self.synced_at = state
+        self.executor = ThreadPoolExecutor(self.threads, thread_name_prefix="analytics")
+
+    async def _run(self, function, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, function, *args)
+
+    @contextmanager
+    def _transaction(self):
+        """
+        DuckDB cursor of its own (cursors can be used from any thread) in a
+        transaction, committed unless the block raises
+        """
+        cursor = self.db.cursor()
+        try:
+            cursor.execute("BEGIN TRANSACTION")
+            yield cursor
+            cursor.execute("COMMIT")
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
+        finally:
+            cursor.close()
+
+    def _query(self, sql: str) -> list:
+        cursor = self.db.cursor()
+        try:
+            return cursor.execute(sql).fetchall()
+        finally:
+            cursor.close()
+
+    async def query(self, sql: str) -> list:
+        """
+        Returns the rows of a query on the mirror (its entry view and
+        rollup tables mirror the Postgres ones)
+        """
+        return await self._run(self._query, sql)
+
+    def _insert_entries(self, path: str, low: int) -> tuple:
+        """
+        Inserts the copied entries not in the mirror yet (only those above
+        low may be) and moves the watermark. Returns the number of copied
+        rows, their highest id and the number of inserted ones
+        """
+        with self._transaction() as cursor:
+            cursor.execute(
+                "CREATE OR REPLACE TEMP TABLE incoming AS "
+                f"SELECT * FROM {read_csv_sql(path, ENTRY_MIRROR_COLUMNS)}"
+            )
+            count, high = cursor.execute(
+                "SELECT count(*), max(id) FROM incoming"
+            ).fetchone()
+            (inserted,) = cursor.execute(
+                "INSERT INTO entry_mirror SELECT * FROM incoming i WHERE NOT EXISTS "
+                "(SELECT 1 FROM entry_mirror m WHERE m.id > ? AND m.id = i.id)",
+                [low],
+            ).fetchone()
+            if high is not None:
+                cursor.execute(
+                    "UPDATE mirror_state SET watermark = greatest(watermark, ?)",
+                    [high],
+                )
+            cursor.execute("DROP TABLE incoming")
+        return count, high, inserted
+
+    def _replace_entries(self, ids: list, path: Optional[str], change_seq: int):
+        """
+        Replaces the changed entries by their current rows (none if they
+        were deleted) and saves the last applied change
+        """
+        with self._transaction() as cursor:
+            if ids:
+                cursor.execute(
+                    "DELETE FROM entry_mirror WHERE id IN "
+                    "(SELECT unnest(CAST(? AS BIGINT[])))",
+                    [ids],
+                )
+                cursor.execute(
+                    "INSERT INTO entry_mirror SELECT * FROM "
+                    f"{read_csv_sql(path, ENTRY_MIRROR_COLUMNS)}"
+                )
+            cursor.execute("UPDATE mirror_state SET change_seq = ?", [change_seq])
+
+    def _replace_rollups(self, table: str, path: str):
+        with self._transaction() as cursor:
+            cursor.execute(f"DELETE FROM {table}")
+            cursor.execute(
+                f"INSERT INTO {table} SELECT * FROM "
+                f"{read_csv_sql(path, ROLLUP_TABLES[table])}"
+            )
+
+    def _replace_tombstones(self, tombstones: list):
+        with self._transaction() as cursor:
+            cursor.execute("DELETE FROM training_tombstone")
+            if tombstones:
+                cursor.executemany(
+                    "INSERT INTO training_tombstone VALUES (?, ?)",
+                    [list(row) for row in tombstones],
+                )
+
+    def _save_synced_at(self, synced_at: float):
+        with self._transaction() as cursor:
+            cursor.execute("UPDATE mirror_state SET synced_at = ?", [synced_at])
+
+    def _reset(self):
+        with self._transaction() as cursor:
+            for table in ("entry_mirror", *ROLLUP_TABLES, "training_tombstone"):
+                cursor.execute(f"DELETE FROM {table}")
+            cursor.execute(
+                "UPDATE mirror_state SET watermark = 0, change_seq = 0, "
+                "synced_at = NULL"
+            )
+
+    async def _copy_out(self, conn, query: str, *args) -> str:
+        """
+        Writes the rows of the Postgres query to a temporary CSV file and
+        returns its path
+        """
+        raw = (await conn.get_raw_connection()).driver_connection
+        fd, path = tempfile.mkstemp(suffix=".csv", dir=os.path.dirname(self.path))
+        os.close(fd)
+        try:
+            await raw.copy_from_query(
+                query, *args, output=path, format="csv", null=CSV_NULL
+            )
+        except Exception:
+            os.remove(path)
+            raise
+        return path
+
+    async def _copy_entries(self, conn) -> int:
+        """
+        Copies the entries above the watermark, batch by batch. Returns how
+        many were new
+        """
+        low = self.watermark - self.lookback
+        inserted = 0
+        while True:
+            path = await self._copy_out(conn, COPY_ENTRIES, low, self.batch_size)
+            try:
+                count, high, batch = await self._run(self._insert_entries, path, low)
+            finally:
+                os.remove(path)
+            inserted += batch
+            if high is not None:
+                self.watermark = max(self.watermark, high)
+            if count < self.batch_size:
+                return inserted
+            low = self.watermark
+
+    async def _apply_changes(self, conn, target: int) -> int:
+        """
+        Replaces the entries changed up to the target change. Returns how
+        many were replaced
+        """
+        replaced = 0
+        while self.change_seq < target:
+            rows = (
+                await conn.execute(
+                    CHANGES,
+                    {
+                        "seq": self.change_seq,
+                        "target": target,
+                        "limit": self.batch_size,
+                    },
+                )
+            ).all()
+            if not rows:
+                change_seq = target
+            else:
+                change_seq = rows[-1][0]
+            # Those above the watermark are copied with their current values
+            ids = sorted(
+                {entry_id for _, entry_id in rows if entry_id <= self.watermark}
+            )
+            path = None
+            if ids:
+                path = await self._copy_out(conn, COPY_CHANGED_ENTRIES, ids)
+            try:
+                await self._run(self._replace_entries, ids, path, change_seq)
+            finally:
+                if path is not None:
+                    os.remove(path)
+            self.change_seq = change_seq
+            replaced += len(ids)
+        return replaced
+
+    async def _copy_rollups(self, conn):
+        for table, query in COPY_ROLLUPS.items():
+            path = await self._copy_out(conn, query)
+            try:
+                await self._run(self._replace_rollups, table, path)
+            finally:
+                os.remove(path)
+
+    async def _copy_tombstones(self, conn) -> bool:
+        tombstones = [tuple(row) for row in await conn.execute(TOMBSTONES)]
+        if tombstones == self.tombstones:
+            return False
+        await self._run(self._replace_tombstones, tombstones)
+        self.tombstones = tombstones
+        return True
+
+    async def sync(self) -> bool:
+        """
+        Copies the new entries, applies the changes logged since the last
+        sync and copies the rollups and tombstones. Returns whether the
+        mirror changed
+        """
+        started = time.perf_counter()
+        if (
+            self.synced_at is not None
+            and time.time() - self.synced_at > self.change_retention
+        ):
+            logger.warning("The analytics mirror is too old, rebuilding it")
+            await self._run(self._reset)
+            self.watermark, self.change_seq, self.synced_at = 0, 0, None
+            self.tombstones = None
+            self.ready = False
+            self.rebuilds += 1
+
+        async with engine.connect() as conn:
+            conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+            target = await conn.scalar(MAX_CHANGE) or 0
+            if not self.watermark:
+                # Everything is copied: the changes logged before don't matter
+                await self._run(self._replace_entries, [], None, target)
+                self.change_seq = target
+            inserted = await self._copy_entries(conn)
+            replaced = await self._apply_changes(conn, target)
+            # The rollups only change along with deleted entries
+            if self.synced_at is None or replaced:
+                await self._copy_rollups(conn)
+            tombstones_changed = await self._copy_tombstones(conn)
+            if time.time() - self.pruned_at > PRUNE_INTERVAL_SECONDS:
+                await conn.execute(PRUNE_CHANGES, {"seconds": self.change_retention})
+                self.pruned_at = time.time()
+
+        self.synced_at = time.time()
+        await self._run(self._save_synced_at, self.synced_at)
+        self.syncs += 1
+        self.copied += inserted
+        self.changed += replaced
+        self.last_sync_seconds = round(time.perf_counter() - started, 4)
+        return bool(inserted or replaced or tombstones_changed)
+
+    async def run(self):
+        while True:
+            try:
+                if await self.sync():
+                    self.version += 1
+                if not self.ready:
+                    logger.info(
+                        "Analytics mirror %s ready (%d entries copied in %.1fs)",
+                        self.path,
+                        self.copied,
+                        self.last_sync_seconds,
+                    )
+                    self.ready = True
+            except Exception as e:
+                logger.error("Could not sync the analytics mirror: %s", e)
+            await asyncio.sleep(self.sync_interval)
+
+    @property
+    def etag_version(self) -> str:
+        return f"{self.instance}.{self.version}"
+
+    def to_dict(self) -> dict:
+        return {
+            "path": self.path,
+            "ready": self.ready,
+            "watermark": self.watermark,
+            "change_seq": self.change_seq,
+            "version": self.version,
+            "syncs": self.syncs,
+            "copied": self.copied,
+            "changed": self.changed,
+            "rebuilds": self.rebuilds,
+            "last_sync_seconds": self.last_sync_seconds,
+            "synced_at": self.synced_at,
+            "backends": {name: backend.value for name, backend in BACKENDS.items()},
+        }
+
+
+def open_mirror(root: str) -> AnalyticsMirror:
+    """
+    Opens the first mirror file under root not claimed by another process
+    """
+    os.makedirs(root, exist_ok=True)
+    for index in itertools.count():
+        lock = open(os.path.join(root, f"{index}.lock"), "w")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            continue
+        analytics_mirror.open(os.path.join(root, f"{index}.duckdb"))
+        # Held (and the file claimed) as long as the process lives
+        analytics_mirror.lock = lock
+        logger.info("Using the analytics mirror %s", analytics_mirror.path)
+        return analytics_mirror
+
+
+analytics_mirror = AnalyticsMirror(
+    ANALYTICS_SYNC_SECONDS,
+    ANALYTICS_SYNC_BATCH,
+    ANALYTICS_SYNC_LOOKBACK,
+    ANALYTICS_CHANGE_RETENTION_SECONDS,
+    ANALYTICS_THREADS,
+)
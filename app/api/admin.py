@@ -0,0 +1,185 @@
+import logging
+import os
+from typing import Optional
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response, status
+from app.data_versions import data_versions
+from app.db import pool_status
+from app.consumer.consumer_queue import ConsumerQueue
+from app.dedup import recent_ids
+from app.events import event_bus
+from app.funnels import user_bitmaps
+from app.geoip import geoip
+from app.hot_window import hot_window
+from app.live import live_dashboard
+from app.log_pipeline import log_stats
+from app.profiling import profiler
+from app.query_stats import query_stats
+from app.analytics import analytics_mirror
+from app.retention import retention_job
+from app.tombstones import tombstone_compactor
+from app.startup import startup
+
+admin_router = APIRouter()
+logger = logging.getLogger('app')
+
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+
+
+async def require_admin(x_admin_token: Optional[str] = Header(None)):
+    """
+    Rejects the request unless it carries the configured X-Admin-Token.
+    Admin endpoints are closed when ADMIN_TOKEN is not set
+    """
+    if not ADMIN_TOKEN:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Admin endpoints are disabled: ADMIN_TOKEN is not set",
+        )
+    if x_admin_token != ADMIN_TOKEN:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN, detail="Invalid admin token"
+        )
+
+
+@admin_router.get("/queries", response_model=dict)
+async def get_query_stats(limit: int = Query(10, ge=1, le=100)):
+    """
+    Returns the top-N normalized statements by total time and by p99 time
+    """
+    return {
+        "by_total": query_stats.top(limit, order_by="total"),
+        "by_p99": query_stats.top(limit, order_by="p99"),
+    }
+
+
+@admin_router.delete("/queries")
+async def reset_query_stats():
+    query_stats.reset()
+    return {"detail": "Query stats have been reset"}
+
+
+@admin_router.get("/profiles", response_model=dict)
+async def get_profiles():
+    """
+    Returns the phase breakdown of the last profiled requests and messages
+    """
+    return profiler.to_dict()
+
+
+@admin_router.get("/profiles/{id}")
+async def get_profile(id: str):
+    """
+    Returns the speedscope profile of a profiled call (open it in
+    https://www.speedscope.app/)
+    """
+    profile = profiler.get(id)
+    if profile is None or profile.speedscope is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Profile not found"
+        )
+    return Response(
+        profile.speedscope,
+        media_type="application/json",
+        headers={"Content-Disposition": f'attachment; filename="{id}.speedscope.json"'},
+    )
+
+
+@admin_router.delete("/profiles")
+async def reset_profiles():
+    profiler.reset()
+    return {"detail": "Profiles have been deleted"}
+
+
+@admin_router.get("/logging", response_model=dict)
+async def get_logging_stats():
+    """
+    Returns the number of log records enqueued, sampled out, rate limited
+    and dropped (queue full) per logger
+    """
+    return log_stats.to_dict()
+
+
+@admin_router.get("/pools", response_model=dict)
+async def get_pool_status():
+    """
+    Returns the connection pool metrics of each engine and the replica lag
+    """
+    return pool_status()
+
+
+@admin_router.get("/ingest", response_model=dict)
+async def get_ingest_stats():
+    """
+    Returns the counters of the ingest pipeline
+    """
+    return {
+        "dedup": recent_ids.to_dict(),
+        "geoip": geoip.to_dict() if geoip is not None else None,
+        "user_bitmaps": user_bitmaps.to_dict(),
+        "spool": (
+            ConsumerQueue.spool.to_dict() if ConsumerQueue.spool is not None else None
+        ),
+        "flow_control": (
+            ConsumerQueue.flow_controller.to_dict()
+            if ConsumerQueue.flow_controller is not None
+            else None
+        ),
+    }
+
+
+@admin_router.get("/data_versions", response_model=dict)
+async def get_data_versions():
+    """
+    Returns the data version of each aggregate family and the number of
+    conditional requests answered with a 304
+    """
+    return data_versions.to_dict()
+
+
+@admin_router.get("/retention", response_model=dict)
+async def get_retention_stats():
+    """
+    Returns the counters of the retention job
+    """
+    return retention_job.to_dict()
+
+
+@admin_router.get("/tombstones", response_model=dict)
+async def get_tombstone_stats():
+    """
+    Returns the counters of the compactor of deleted trainings
+    """
+    return tombstone_compactor.to_dict()
+
+
+@admin_router.get("/live", response_model=dict)
+async def get_live_stats():
+    """
+    Returns the event bus counters and the clients of the live dashboard
+    """
+    return {"events": event_bus.to_dict(), "dashboard": live_dashboard.to_dict()}
+
+
+@admin_router.get("/startup", response_model=dict)
+async def get_startup_report(imports: int = Query(15, ge=1, le=100)):
+    """
+    Returns the time spent starting the app, per phase and per imported module
+    """
+    return startup.to_dict(imports)
+
+
+@admin_router.get("/analytics", response_model=dict)
+async def get_analytics_stats():
+    """
+    Returns the state of the analytics mirror and the backend of each
+    history aggregate
+    """
+    return analytics_mirror.to_dict()
+
+
+@admin_router.get("/hot_window", response_model=dict)
+async def get_hot_window_stats():
+    """
+    Returns the size and state of the in-memory window of recent entries
+    """
+    return hot_window.to_dict()
@@ -1,7 +1,18 @@
 import logging
-from fastapi import APIRouter, Depends, status
-from app.db import get_session
-from app.models import Entry, EntryCreate, EntryUpdate
+from typing import Optional
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from app.db import get_read_session, get_session
+from app.events import ENTRIES_CHANGED, ENTRIES_INSERTED, event_bus
+from app.history_views import history_view_refresher
+from app.models import EntryCreate, EntryRead, EntryUpdate
+from app.serialization import FastJSONResponse, ResponseFormat, rows_response
+from app.timelines import (
+    TIMELINE_MAX_PAGE_SIZE,
+    TIMELINE_PAGE_SIZE,
+    TimelineKey,
+    TimelineOrder,
+    read_timeline,
+)
 from sqlalchemy.future import select
 from sqlalchemy.ext.asyncio import AsyncSession
 from starlette.responses import JSONResponse
@@ -9,7 +20,7 @@ from app.entries_utils import (
     add_db_entry,
     delete_all_db_entries,
     delete_db_entry,
-    get_db_entries,
+    get_db_entries_rows,
     get_db_entry_by_id,
     update_db_entry,
 )
@@ -20,25 +31,88 @@ entries_router = APIRouter()
 logger = logging.getLogger('app')
 
 
-@entries_router.post("/")
+@entries_router.post("/", response_model=EntryRead)
 async def add_entry(entry: EntryCreate, session: AsyncSession = Depends(get_session)):
     entry_obj = await add_db_entry(entry, session)
+    history_view_refresher.notify_changed()
+    event_bus.publish(ENTRIES_INSERTED, [entry_obj])
     return entry_obj
 
 
-@entries_router.get("/{id}", response_model=Entry)
-async def get_entry(id: int, session: AsyncSession = Depends(get_session)):
+async def _timeline_response(
+    session: AsyncSession,
+    key: TimelineKey,
+    value: str,
+    actions: Optional[str],
+    cursor: Optional[str],
+    limit: int,
+    order: TimelineOrder,
+):
+    actions = (
+        tuple(a.strip() for a in actions.split(",") if a.strip()) if actions else ()
+    )
+    try:
+        page = await read_timeline(session, key, value, actions, cursor, limit, order)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    return FastJSONResponse(page)
+
+
+@entries_router.get("/users/{user_id}/timeline", response_model=dict)
+async def get_user_timeline(
+    user_id: str,
+    actions: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(TIMELINE_PAGE_SIZE, ge=1, le=TIMELINE_MAX_PAGE_SIZE),
+    order: TimelineOrder = TimelineOrder.asc,
+    session: AsyncSession = Depends(get_read_session),
+):
+    """
+    Returns a page of the entries of the user in time order, optionally
+    only the comma-separated actions, and the cursor of the next page
+    """
+    return await _timeline_response(
+        session, TimelineKey.user_id, user_id, actions, cursor, limit, order
+    )
+
+
+@entries_router.get("/trainings/{training_id}/timeline", response_model=dict)
+async def get_training_timeline(
+    training_id: str,
+    actions: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(TIMELINE_PAGE_SIZE, ge=1, le=TIMELINE_MAX_PAGE_SIZE),
+    order: TimelineOrder = TimelineOrder.asc,
+    session: AsyncSession = Depends(get_read_session),
+):
+    """
+    Returns a page of the entries of the training in time order, optionally
+    only the comma-separated actions, and the cursor of the next page
+    """
+    return await _timeline_response(
+        session, TimelineKey.training_id, training_id, actions, cursor, limit, order
+    )
+
+
+@entries_router.get("/{id}", response_model=EntryRead)
+async def get_entry(id: int, session: AsyncSession = Depends(get_read_session)):
     entry = await get_db_entry_by_id(id=id, session=session)
     return entry
 
 
-@entries_router.get("/", response_model=list[Entry])
-async def get_entries(session: AsyncSession = Depends(get_session)):
-    entries = await get_db_entries(session=session)
-    return entries
+@entries_router.get("/", response_model=list[EntryRead])
+async def get_entries(
+    format: ResponseFormat = ResponseFormat.rows,
+    session: AsyncSession = Depends(get_read_session),
+):
+    """
+    Returns every entry, as objects or as column arrays (?format=columnar)
+    """
+    columns, rows = await get_db_entries_rows(session)
+    return rows_response(columns, rows, format)
 
 
-@entries_router.put("/{id}")
+@entries_router.put("/{id}", response_model=EntryRead)
 async def update_entry(
     id: int, updates: EntryUpdate, session: AsyncSession = Depends(get_session)
 ):
@@ -48,6 +122,8 @@ async def update_entry(
             status_code=status.HTTP_404_NOT_FOUND,
             content=f"Entry {id} not found",
         )
+    history_view_refresher.notify_changed()
+    event_bus.publish(ENTRIES_CHANGED)
     return entry
 
 
@@ -59,6 +135,8 @@ async def delete_entry(id: int, session: AsyncSession = Depends(get_session)):
             status_code=status.HTTP_404_NOT_FOUND,
             content=f"Entry {id} not found",
         )
+    history_view_refresher.notify_changed()
+    event_bus.publish(ENTRIES_CHANGED, (response.service,))
     return JSONResponse(
         status_code=status.HTTP_200_OK,
         content=f"Entry {id} deleted",
@@ -73,6 +151,8 @@ async def delete_entries(session: AsyncSession = Depends(get_session)):
             status_code=status.HTTP_204_NO_CONTENT,
             content="No entries to delete",
         )
+    history_view_refresher.notify_changed(len(entries))
+    event_bus.publish(ENTRIES_CHANGED)
     return JSONResponse(
         status_code=status.HTTP_200_OK,
         content="All entries have been deleted successfully",
@@ -0,0 +1,22 @@
+from fastapi import APIRouter, Response, status
+from app.startup import startup
+
+# Liveness: the process is up and serving. Readiness: the startup finished
+# (database initialized, pools and caches warm, consumer running), so it
+# can take traffic.
+
+health_router = APIRouter()
+
+
+@health_router.get("/live", response_model=dict)
+async def get_liveness():
+    return {"status": "alive"}
+
+
+@health_router.get("/ready", response_model=dict)
+async def get_readiness(response: Response):
+    if not startup.ready:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+        failed = any(phase["status"] == "failed" for phase in startup.phases)
+        return {"status": "failed" if failed else "starting", "phases": startup.phases}
+    return {"status": "ready"}
@@ -1,214 +1,260 @@
+import datetime as dt
 import logging
-from fastapi import APIRouter, Depends, status
-from app.db import get_session
-from app.definitions import (
-    ADD_TRAINING_TO_FAVS,
-    MEDIA_UPLOAD,
-    NEW_TRAINING,
-    SIGNUP,
-    TRAINING_SERVICE,
-    USER_SERVICE,
+from typing import Optional
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, status
+from app.aggregates import (
+    BLOCKED_USERS,
+    FAVORITE_TRAININGS_BY_USER,
+    FAVORITE_TRAININGS_PER_LOCATION,
+    NEW_TRAININGS_PER_MONTH,
+    TRAININGS_PER_TYPE,
+    TRAININGS_REQUESTS_COUNT,
+    TRAININGS_UPLOADS_BY_USER,
+    USERS_AUTH,
+    USERS_BY_LOCATION,
 )
-from app.models import Entry, EntryCreate, EntryUpdate
-from sqlalchemy.future import select
-from sqlalchemy import func
+from app.db import get_read_session
+from app.definitions import ACTIONS, NEW_TRAINING
+from app.funnels import (
+    DEFAULT_FUNNEL,
+    FUNNEL_MAX_DAYS,
+    FunnelBreakdown,
+    funnel,
+    retention,
+)
+from app.history_views import read_history_view, read_rates
+from app.serialization import FastJSONResponse, ResponseFormat
 from sqlalchemy.ext.asyncio import AsyncSession
-from starlette.responses import JSONResponse
-from collections import Counter
 
 # https://fastapi.tiangolo.com/advanced/async-sql-databases/ 😎
 
+# Every endpoint reads the materialized view of its aggregate (see
+# app/history_views.py). The X-Data-Refreshed-At header tells when it was
+# last refreshed, and the ETag its data version: polls sending it back in
+# If-None-Match get a 304 while it is current. The per-user endpoints can
+# also answer with key and count arrays (?format=columnar).
+#
+# With ?hours=N they only count the entries of the last N hours, from the
+# in-memory hot window when it covers them (see app/hot_window.py), as do
+# the per-minute request and error rates.
+#
+# The funnel endpoints intersect bitmaps of users instead (see
+# app/funnels.py).
+
 history_router = APIRouter()
 
 
 @history_router.get("/users_auth", response_model=dict)
-async def get_users_auth_requests_count(session: AsyncSession = Depends(get_session)):
+async def get_users_auth_requests_count(
+    request: Request,
+    hours: Optional[int] = None,
+    session: AsyncSession = Depends(get_read_session),
+):
     """
     Returns a dict with the number of requests per auth requests
     """
-    paths = (
-        "/login/",
-        "/login/google/",
-        "/signup/",
-        "/signup/google/",
-        "/login/forgot_password",
-    )
-
-    counts_query = (
-        select(func.count(), Entry.path)
-        .where(Entry.service == USER_SERVICE)
-        .where(Entry.path.in_(paths))
-        .group_by(Entry.path)
-    )
-
-    counts_result = await session.execute(counts_query)
-
-    counts = {path[1]: path[0] for path in counts_result}
-
-    return counts
+    return await read_history_view(USERS_AUTH, request, session, hours=hours)
 
 
 @history_router.get("/blocked_users", response_model=dict)
-async def get_blocked_users_count(session: AsyncSession = Depends(get_session)):
+async def get_blocked_users_count(
+    request: Request,
+    hours: Optional[int] = None,
+    session: AsyncSession = Depends(get_read_session),
+):
     """
     Returns a dict with the number of blocked users per YYYY-MM
     """
-    path = "/users/{user_id}/block"
-
-    counts_query = (
-        select(func.count(), func.substr(Entry.datetime, 0, 8))
-        .where(Entry.service == USER_SERVICE)
-        .where(Entry.path.like(path.replace("{user_id}", "%")))
-        .group_by(func.substr(Entry.datetime, 0, 8), Entry.datetime)
-    )
-
-    counts_result = await session.execute(counts_query)
-
-    counts = dict(Counter(date for _, date in counts_result))
-
-    return counts
+    return await read_history_view(BLOCKED_USERS, request, session, hours=hours)
 
 
 @history_router.get("/users_by_location", response_model=dict)
-async def get_users_by_location(session: AsyncSession = Depends(get_session)):
+async def get_users_by_location(
+    request: Request,
+    hours: Optional[int] = None,
+    session: AsyncSession = Depends(get_read_session),
+):
     """
     Returns a dict with the number of users per country.
     Empty string ("") indicates unknown locations.
     """
-
-    counts_query = (
-        select(func.count(), Entry.country)
-        .where(Entry.service == USER_SERVICE)
-        .where(Entry.action == SIGNUP)
-        .group_by(Entry.country)
-    )
-
-    counts_result = await session.execute(counts_query)
-
-    counts = {country: count for count, country in counts_result}
-
-    return counts
+    return await read_history_view(USERS_BY_LOCATION, request, session, hours=hours)
 
 
 @history_router.get("/trainings_requests_count", response_model=dict)
-async def get_trainings_requests_count(session: AsyncSession = Depends(get_session)):
+async def get_trainings_requests_count(
+    request: Request,
+    hours: Optional[int] = None,
+    session: AsyncSession = Depends(get_read_session),
+):
     """
     Returns a dict with the count of each training action
     """
-    actions = ("new_training", "media_upload")
-
-    counts_query = (
-        select(func.count(), Entry.action)
-        .where(Entry.service == TRAINING_SERVICE)
-        .where(Entry.action.in_(actions))
-        .group_by(Entry.action)
+    return await read_history_view(
+        TRAININGS_REQUESTS_COUNT, request, session, hours=hours
     )
 
-    counts_result = await session.execute(counts_query)
-
-    counts = {action[1]: action[0] for action in counts_result}
-
-    return counts
-
 
 @history_router.get("/new_trainings_per_month", response_model=dict)
-async def get_new_trainings_per_month(session: AsyncSession = Depends(get_session)):
+async def get_new_trainings_per_month(
+    request: Request,
+    hours: Optional[int] = None,
+    session: AsyncSession = Depends(get_read_session),
+):
     """
     Returns a dict with the number of new trainings per YYYY-MM
     """
-
-    counts_query = (
-        select(func.count(), func.substr(Entry.datetime, 0, 8))
-        .where(Entry.service == TRAINING_SERVICE)
-        .where(Entry.action == NEW_TRAINING)
-        .group_by(func.substr(Entry.datetime, 0, 8), Entry.datetime)
+    return await read_history_view(
+        NEW_TRAININGS_PER_MONTH, request, session, hours=hours
     )
 
-    counts_result = await session.execute(counts_query)
-
-    counts = dict(Counter(date for _, date in counts_result))
-
-    return counts
-
 
 @history_router.get("/trainings_uploads_by_user", response_model=dict)
-async def get_trainings_uploads_by_user(session: AsyncSession = Depends(get_session)):
+async def get_trainings_uploads_by_user(
+    request: Request,
+    hours: Optional[int] = None,
+    format: ResponseFormat = ResponseFormat.rows,
+    session: AsyncSession = Depends(get_read_session),
+):
     """
     Returns a dict with the number of trainings uploads by user
     """
-
-    counts_query = (
-        select(func.count(), Entry.user_id)
-        .where(Entry.service == TRAINING_SERVICE)
-        .where(Entry.action == MEDIA_UPLOAD)
-        .group_by(Entry.user_id)
+    return await read_history_view(
+        TRAININGS_UPLOADS_BY_USER, request, session, format, hours
     )
 
-    counts_result = await session.execute(counts_query)
-
-    counts = {user[1]: user[0] for user in counts_result}
-
-    return counts
-
 
 @history_router.get("/trainings_per_type", response_model=dict)
-async def get_trainings_per_type(session: AsyncSession = Depends(get_session)):
+async def get_trainings_per_type(
+    request: Request,
+    hours: Optional[int] = None,
+    session: AsyncSession = Depends(get_read_session),
+):
     """
     Returns a dict with the number of trainings per type
     """
-
-    counts_query = (
-        select(func.count(), Entry.training_type)
-        .where(Entry.service == TRAINING_SERVICE)
-        .where(Entry.action == NEW_TRAINING)
-        .group_by(Entry.training_type)
-    )
-
-    counts_result = await session.execute(counts_query)
-
-    counts = {training_type[1]: training_type[0] for training_type in counts_result}
-
-    return counts
+    return await read_history_view(TRAININGS_PER_TYPE, request, session, hours=hours)
 
 
 @history_router.get("/favorite_trainings_per_location", response_model=dict)
 async def get_favorite_trainings_per_location(
-    session: AsyncSession = Depends(get_session),
+    request: Request,
+    hours: Optional[int] = None,
+    session: AsyncSession = Depends(get_read_session),
 ):
     """
     Returns a dict with the number of favourite trainings per location.
     Empty string ("") indicates unknown locations.
     """
+    return await read_history_view(
+        FAVORITE_TRAININGS_PER_LOCATION, request, session, hours=hours
+    )
+
 
-    counts_query = (
-        select(func.count(), Entry.country)
-        .where(Entry.service == USER_SERVICE)
-        .where(Entry.action == ADD_TRAINING_TO_FAVS)
-        .group_by(Entry.country)
+@history_router.get("/favorite_trainings_by_user", response_model=dict)
+async def get_favorite_trainings_by_user(
+    request: Request,
+    hours: Optional[int] = None,
+    format: ResponseFormat = ResponseFormat.rows,
+    session: AsyncSession = Depends(get_read_session),
+):
+    """
+    Returns a dict with the number of favorite trainings by user
+    """
+    return await read_history_view(
+        FAVORITE_TRAININGS_BY_USER, request, session, format, hours
     )
 
-    counts_result = await session.execute(counts_query)
-    counts = {}
-    for user in counts_result:
-        counts[user["country"]] = user["count"]
 
-    return counts
+@history_router.get("/request_rate", response_model=dict)
+async def get_request_rate(
+    hours: int = 1,
+    service: Optional[str] = None,
+    session: AsyncSession = Depends(get_read_session),
+):
+    """
+    Returns the number of requests per minute (YYYY-MM-DD HH:MM) of the last
+    hours, optionally of a single service
+    """
+    rates, headers = await read_rates(session, hours, service)
+    return FastJSONResponse(
+        {"minutes": rates["minutes"], "requests": rates["requests"]},
+        headers=headers,
+    )
 
 
-@history_router.get("/favorite_trainings_by_user", response_model=dict)
-async def get_favorite_trainings_by_user(session: AsyncSession = Depends(get_session)):
+@history_router.get("/error_rate", response_model=dict)
+async def get_error_rate(
+    hours: int = 1,
+    service: Optional[str] = None,
+    session: AsyncSession = Depends(get_read_session),
+):
     """
-    Returns a dict with the number of favorite trainings by user
+    Returns the number of server errors (5xx) per minute of the last hours,
+    and their fraction of the requests, optionally of a single service
     """
+    rates, headers = await read_rates(session, hours, service)
+    return FastJSONResponse(
+        {
+            "minutes": rates["minutes"],
+            "errors": rates["errors"],
+            "error_rate": rates["error_rate"],
+        },
+        headers=headers,
+    )
+
 
-    counts_query = (
-        select(func.count(), Entry.user_id)
-        .where(Entry.service == USER_SERVICE)
-        .where(Entry.action == ADD_TRAINING_TO_FAVS)
-        .group_by(Entry.user_id)
+def _validate_actions(actions) -> tuple:
+    unknown = [action for action in actions if action not in ACTIONS]
+    if unknown:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unknown actions: {', '.join(unknown)}",
+        )
+    return tuple(actions)
+
+
+@history_router.get("/funnel", response_model=dict)
+async def get_funnel(
+    steps: str = ",".join(DEFAULT_FUNNEL),
+    since: Optional[dt.date] = None,
+    until: Optional[dt.date] = None,
+    by: Optional[FunnelBreakdown] = None,
+    session: AsyncSession = Depends(get_read_session),
+):
+    """
+    Returns how many users did each of the comma-separated actions, and
+    every previous one, between since and until (the last 30 days by
+    default), optionally per signup month or signup country
+    """
+    until = until or dt.datetime.utcnow().date()
+    since = since or until - dt.timedelta(days=29)
+    if not 0 <= (until - since).days < FUNNEL_MAX_DAYS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"The range must span 1 to {FUNNEL_MAX_DAYS} days",
+        )
+    steps = _validate_actions(step.strip() for step in steps.split(","))
+    return FastJSONResponse(
+        await funnel(session, steps, since, until, by.value if by else None)
     )
 
-    counts_result = await session.execute(counts_query)
-    counts = {user["user_id"]: user["count"] for user in counts_result}
 
-    return counts
+@history_router.get("/funnel/retention", response_model=dict)
+async def get_funnel_retention(
+    action: str = NEW_TRAINING,
+    since: Optional[str] = Query(None, regex=r"^\d{4}-\d{2}$"),
+    months: int = 6,
+    session: AsyncSession = Depends(get_read_session),
+):
+    """
+    Returns, per signup month cohort (from since, YYYY-MM, on), how many of
+    its users did the action in each of the following months
+    """
+    _validate_actions((action,))
+    if not 1 <= months <= 36:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="months must be between 1 and 36",
+        )
+    return FastJSONResponse(await retention(session, action, since or "", months))
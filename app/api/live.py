@@ -0,0 +1,60 @@
+import asyncio
+import logging
+from fastapi import APIRouter, Request, WebSocket
+from fastapi.responses import StreamingResponse
+from app.live import LIVE_KEEPALIVE_SECONDS, live_dashboard
+
+# Live counts of the /history aggregates, pushed instead of polled. Both
+# endpoints send a {"type": "snapshot", "data": {aggregate: {key: count}}}
+# message on connect and then {"type": "delta", "data": ...} messages with
+# the counts that changed (see app/live.py).
+
+live_router = APIRouter()
+logger = logging.getLogger('app')
+
+
+async def _send_updates(websocket: WebSocket, client: asyncio.Queue):
+    while True:
+        await websocket.send_text(await client.get())
+
+
+@live_router.websocket("/ws")
+async def live_websocket(websocket: WebSocket):
+    await websocket.accept()
+    client = live_dashboard.connect()
+    sender = asyncio.create_task(_send_updates(websocket, client))
+    try:
+        # Clients don't send anything: this only waits for the disconnect
+        while (await websocket.receive())["type"] != "websocket.disconnect":
+            pass
+    finally:
+        sender.cancel()
+        live_dashboard.disconnect(client)
+
+
+@live_router.get("/events")
+async def live_events(request: Request):
+    """
+    Server-Sent Events stream of the live counts
+    """
+    client = live_dashboard.connect()
+
+    async def stream():
+        try:
+            while not await request.is_disconnected():
+                try:
+                    message = await asyncio.wait_for(
+                        client.get(), timeout=LIVE_KEEPALIVE_SECONDS
+                    )
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"data: {message}\n\n"
+        finally:
+            live_dashboard.disconnect(client)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
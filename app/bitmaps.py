@@ -0,0 +1,189 @@
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+
+# Compressed bitmap of 32-bit integers, in the style of Roaring bitmaps
+# (https://roaringbitmap.org/): values are split by their high 16 bits into
+# containers holding their low 16 bits, either as a sorted array (up to
+# ARRAY_MAX values) or as a 65536-bit set stored in a Python int, whose
+# bitwise operators run in C. Sparse and dense sets both stay small and
+# unions and intersections only touch the containers they share.
+#
+# Serialized layout (little-endian): number of containers (uint32), then per
+# container its high bits (uint16), kind (uint8: 0 array, 1 bits), number of
+# values (uint32) and the values (uint16 each) or the 8192 bytes of bits.
+
+ARRAY_MAX = 4096
+BITS_BYTES = 65536 // 8
+ARRAY, BITS = 0, 1
+
+HEADER = struct.Struct("<I")
+CONTAINER = struct.Struct("<HBI")
+
+
+def _popcount(bits: int) -> int:
+    if hasattr(bits, "bit_count"):
+        return bits.bit_count()
+    return bin(bits).count("1")
+
+
+def _to_bits(values) -> int:
+    data = bytearray(BITS_BYTES)
+    for value in values:
+        data[value >> 3] |= 1 << (value & 7)
+    return int.from_bytes(data, "little")
+
+
+def _to_array(bits: int) -> array:
+    values = array("H")
+    data = bits.to_bytes(BITS_BYTES, "little")
+    for index, byte in enumerate(data):
+        while byte:
+            lowest = byte & -byte
+            values.append((index << 3) | (lowest.bit_length() - 1))
+            byte ^= lowest
+    return values
+
+
+def _copy(container):
+    return container if isinstance(container, int) else array("H", container)
+
+
+def _cardinality(container) -> int:
+    return _popcount(container) if isinstance(container, int) else len(container)
+
+
+def _optimize(bits: int):
+    return _to_array(bits) if _popcount(bits) <= ARRAY_MAX else bits
+
+
+def _union(a, b):
+    if isinstance(a, array) and isinstance(b, array):
+        values = sorted(set(a).union(b))
+        if len(values) <= ARRAY_MAX:
+            return array("H", values)
+        return _to_bits(values)
+    a = a if isinstance(a, int) else _to_bits(a)
+    b = b if isinstance(b, int) else _to_bits(b)
+    return a | b
+
+
+def _intersection(a, b):
+    if isinstance(a, array) and isinstance(b, array):
+        return array("H", sorted(set(a).intersection(b)))
+    if isinstance(a, int) and isinstance(b, int):
+        return _optimize(a & b)
+    values, bits = (a, b) if isinstance(a, array) else (b, a)
+    data = bits.to_bytes(BITS_BYTES, "little")
+    return array("H", (v for v in values if data[v >> 3] >> (v & 7) & 1))
+
+
+class RoaringBitmap:
+    __slots__ = ("containers",)
+
+    def __init__(self, values=()):
+        self.containers = {}
+        for value in values:
+            self.add(value)
+
+    def add(self, value: int):
+        high, low = value >> 16, value & 0xFFFF
+        container = self.containers.get(high)
+        if container is None:
+            self.containers[high] = array("H", (low,))
+        elif isinstance(container, int):
+            self.containers[high] = container | (1 << low)
+        else:
+            index = bisect_left(container, low)
+            if index < len(container) and container[index] == low:
+                return
+            container.insert(index, low)
+            if len(container) > ARRAY_MAX:
+                self.containers[high] = _to_bits(container)
+
+    def __contains__(self, value: int) -> bool:
+        container = self.containers.get(value >> 16)
+        if container is None:
+            return False
+        low = value & 0xFFFF
+        if isinstance(container, int):
+            return bool(container >> low & 1)
+        index = bisect_left(container, low)
+        return index < len(container) and container[index] == low
+
+    def __len__(self) -> int:
+        return sum(_cardinality(c) for c in self.containers.values())
+
+    def __iter__(self):
+        for high in sorted(self.containers):
+            container = self.containers[high]
+            if isinstance(container, int):
+                container = _to_array(container)
+            for low in container:
+                yield high << 16 | low
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, RoaringBitmap) and list(self) == list(other)
+
+    def __or__(self, other: "RoaringBitmap") -> "RoaringBitmap":
+        # Array containers are copied: add() changes them in place
+        result = RoaringBitmap()
+        result.containers = {h: _copy(c) for h, c in self.containers.items()}
+        for high, container in other.containers.items():
+            current = result.containers.get(high)
+            result.containers[high] = (
+                _copy(container) if current is None else _union(current, container)
+            )
+        return result
+
+    def __and__(self, other: "RoaringBitmap") -> "RoaringBitmap":
+        result = RoaringBitmap()
+        for high in self.containers.keys() & other.containers.keys():
+            container = _intersection(self.containers[high], other.containers[high])
+            if _cardinality(container):
+                result.containers[high] = container
+        return result
+
+    @classmethod
+    def union(cls, bitmaps) -> "RoaringBitmap":
+        result = cls()
+        for bitmap in bitmaps:
+            result = result | bitmap
+        return result
+
+    def serialize(self) -> bytes:
+        parts = [HEADER.pack(len(self.containers))]
+        for high in sorted(self.containers):
+            container = self.containers[high]
+            if isinstance(container, int):
+                parts.append(CONTAINER.pack(high, BITS, _popcount(container)))
+                parts.append(container.to_bytes(BITS_BYTES, "little"))
+            else:
+                parts.append(CONTAINER.pack(high, ARRAY, len(container)))
+                if sys.byteorder != "little":
+                    container = array("H", container)
+                    container.byteswap()
+                parts.append(container.tobytes())
+        return b"".join(parts)
+
+    @classmethod
+    def deserialize(cls, data: bytes) -> "RoaringBitmap":
+        result = cls()
+        (count,) = HEADER.unpack_from(data)
+        offset = HEADER.size
+        for _ in range(count):
+            high, kind, length = CONTAINER.unpack_from(data, offset)
+            offset += CONTAINER.size
+            if kind == BITS:
+                end = offset + BITS_BYTES
+                result.containers[high] = int.from_bytes(data[offset:end], "little")
+            else:
+                end = offset + 2 * length
+                container = array("H")
+                container.frombytes(data[offset:end])
+                if sys.byteorder != "little":
+                    container.byteswap()
+                result.containers[high] = container
+            offset = end
+        return result
@@ -1,13 +1,18 @@
+import asyncio
 import functools
+import logging
 import os
-import time
 import pika
-from app.consumer.message_queue_wrapper import MessageQueueWrapper
+from app.consumer.message_queue_wrapper import MessageQueueWrapper, validate_message
 from app.consumer.queue_settings import EXCHANGE, EXCHANGE_TYPE, QUEUE, ROUTING_KEY
-import app.main as main
+from app.dedup import message_id_of
+from app.spool import SPOOL_PREFETCH_COUNT
 
 from pika.adapters.asyncio_connection import AsyncioConnection
 
+logger = logging.getLogger('app')
+ack_logger = logging.getLogger('app.consumer.ack')
+
 # Este codigo fue extraido de los ejemplos de la documentacion de pika,
 # pero se lo adapto para que funcione con el resto del codigo de la aplicacion
 # de forma asincronica
@@ -32,6 +37,12 @@ class ConsumerQueue(object):
     """
 
     instance = None  # For Singleton pattern!
+    # Process that created the instance: a forked process gets its own
+    instance_pid = None
+    # Local spool (app/spool.py) the messages are written to, if enabled
+    spool = None
+    # Adaptive prefetch of the spooling consumer (app/consumer/flow_control.py)
+    flow_controller = None
 
     def __new__(cls, amqp_url):
         """Create a new instance of the consumer class, passing in the AMQP
@@ -40,8 +51,9 @@ class ConsumerQueue(object):
         :param str amqp_url: The AMQP url to connect with
 
         """
-        if cls.instance is None:
+        if cls.instance is None or cls.instance_pid != os.getpid():
             cls.instance = super().__new__(cls)
+            cls.instance_pid = os.getpid()
             cls.instance.should_reconnect = False
             cls.instance.was_consuming = False
 
@@ -52,9 +64,13 @@ class ConsumerQueue(object):
             cls.instance._url = amqp_url
             cls.instance._consuming = False
             cls.instance._reconnect_delay = 0
+            cls.instance._stopped = None
             # In production, experiment with higher prefetch values
-            # for higher consumer throughput
-            cls.instance._prefetch_count = 1
+            # for higher consumer throughput. With a spool, the acks wait
+            # for its next fsync, so many messages have to be in flight
+            cls.instance._prefetch_count = SPOOL_PREFETCH_COUNT if cls.spool else 1
+            if cls.flow_controller is not None:
+                cls.instance._prefetch_count = cls.flow_controller.prefetch
         return cls.instance
 
     def connect(cls):
@@ -65,7 +81,7 @@ class ConsumerQueue(object):
         :rtype: pika.adapters.asyncio_connection.AsyncioConnection
 
         """
-        main.logger.info('Connecting to %s', cls.instance._url)
+        logger.info('Connecting to %s', cls.instance._url)
         return AsyncioConnection(
             parameters=pika.URLParameters(cls.instance._url),
             on_open_callback=cls.instance.on_connection_open,
@@ -76,9 +92,9 @@ class ConsumerQueue(object):
     def close_connection(cls):
         cls.instance._consuming = False
         if cls.instance._connection.is_closing or cls.instance._connection.is_closed:
-            main.logger.info('Connection is closing or already closed')
+            logger.info('Connection is closing or already closed')
         else:
-            main.logger.info('Closing connection')
+            logger.info('Closing connection')
             cls.instance._connection.close()
 
     def on_connection_open(cls, _unused_connection):
@@ -90,7 +106,7 @@ class ConsumerQueue(object):
            The connection
 
         """
-        main.logger.info('Connection opened')
+        logger.info('Connection opened')
         cls.instance.open_channel()
 
     def on_connection_open_error(cls, _unused_connection, err):
@@ -102,7 +118,7 @@ class ConsumerQueue(object):
         :param Exception err: The error
 
         """
-        main.logger.error('Connection open failed: %s', err)
+        logger.error('Connection open failed: %s', err)
         cls.instance.reconnect()
 
     def on_connection_closed(cls, _unused_connection, reason):
@@ -117,15 +133,15 @@ class ConsumerQueue(object):
         """
         cls.instance._channel = None
         if cls.instance._closing:
-            cls.instance._connection.ioloop.stop()
+            cls.instance._stopped.set()
         else:
-            main.logger.warning('Connection closed, reconnect necessary: %s', reason)
+            logger.warning('Connection closed, reconnect necessary: %s', reason)
             cls.instance.reconnect()
 
     def reconnect(cls):
         """Will be invoked if the connection can't be opened or is
         closed. Indicates that a reconnect is necessary then stops the
-        ioloop.
+        consumer.
 
         """
         cls.instance.should_reconnect = True
@@ -137,7 +153,7 @@ class ConsumerQueue(object):
         on_channel_open callback will be invoked by pika.
 
         """
-        main.logger.info('Creating a new channel')
+        logger.info('Creating a new channel')
         cls.instance._connection.channel(on_open_callback=cls.instance.on_channel_open)
 
     def on_channel_open(cls, channel):
@@ -149,8 +165,11 @@ class ConsumerQueue(object):
         :param pika.channel.Channel channel: The channel object
 
         """
-        main.logger.info('Channel opened')
+        logger.info('Channel opened')
         cls.instance._channel = channel
+        if cls.flow_controller is not None:
+            # The unacked messages of a previous channel are redelivered
+            cls.flow_controller.delivered = cls.flow_controller.acked = 0
         cls.instance.add_on_channel_close_callback()
         cls.instance.setup_exchange(EXCHANGE)
 
@@ -159,7 +178,7 @@ class ConsumerQueue(object):
         RabbitMQ unexpectedly closes the channel.
 
         """
-        main.logger.info('Adding channel close callback')
+        logger.info('Adding channel close callback')
         cls.instance._channel.add_on_close_callback(cls.instance.on_channel_closed)
 
     def on_channel_closed(cls, channel, reason):
@@ -173,7 +192,7 @@ class ConsumerQueue(object):
         :param Exception reason: why the channel was closed
 
         """
-        main.logger.warning('Channel %i was closed: %s', channel, reason)
+        logger.warning('Channel %i was closed: %s', channel, reason)
         cls.instance.close_connection()
 
     def setup_exchange(cls, exchange_name):
@@ -184,7 +203,7 @@ class ConsumerQueue(object):
         :param str|unicode exchange_name: The name of the exchange to declare
 
         """
-        main.logger.info('Declaring exchange: %s', exchange_name)
+        logger.info('Declaring exchange: %s', exchange_name)
         # Note: using functools.partial is not required, it is demonstrating
         # how arbitrary data can be passed to the callback when it is called
         cb = functools.partial(
@@ -202,7 +221,7 @@ class ConsumerQueue(object):
         :param str|unicode userdata: Extra user data (exchange name)
 
         """
-        main.logger.info('Exchange declared: %s', userdata)
+        logger.info('Exchange declared: %s', userdata)
         cls.instance.setup_queue(QUEUE)
 
     def setup_queue(cls, queue_name):
@@ -213,7 +232,7 @@ class ConsumerQueue(object):
         :param str|unicode queue_name: The name of the queue to declare.
 
         """
-        main.logger.info('Declaring queue %s', queue_name)
+        logger.info('Declaring queue %s', queue_name)
         cb = functools.partial(cls.instance.on_queue_declareok, userdata=queue_name)
         cls.instance._channel.queue_declare(queue=queue_name, callback=cb)
 
@@ -229,7 +248,7 @@ class ConsumerQueue(object):
 
         """
         queue_name = userdata
-        main.logger.info('Binding %s to %s with %s', EXCHANGE, queue_name, ROUTING_KEY)
+        logger.info('Binding %s to %s with %s', EXCHANGE, queue_name, ROUTING_KEY)
         cb = functools.partial(cls.instance.on_bindok, userdata=queue_name)
         cls.instance._channel.queue_bind(
             queue_name, EXCHANGE, routing_key=ROUTING_KEY, callback=cb
@@ -243,7 +262,7 @@ class ConsumerQueue(object):
         :param str|unicode userdata: Extra user data (queue name)
 
         """
-        main.logger.info('Queue bound: %s', userdata)
+        logger.info('Queue bound: %s', userdata)
         cls.instance.set_qos()
 
     def set_qos(cls):
@@ -266,9 +285,41 @@ class ConsumerQueue(object):
         :param pika.frame.Method _unused_frame: The Basic.QosOk response frame
 
         """
-        main.logger.info('QOS set to: %d', cls.instance._prefetch_count)
+        logger.info('QOS set to: %d', cls.instance._prefetch_count)
         cls.instance.start_consuming()
 
+    def update_prefetch(cls, prefetch):
+        """Changes the prefetch count of the channel while consuming, as
+        retuned by the flow controller.
+
+        :param int prefetch: The new prefetch count
+
+        """
+        cls.instance._prefetch_count = prefetch
+        if cls.instance._channel is not None and cls.instance._channel.is_open:
+            logger.info('Updating QOS to: %d', prefetch)
+            cls.instance._channel.basic_qos(prefetch_count=prefetch)
+
+    def poll_queue_depth(cls):
+        """Asks RabbitMQ for the number of messages ready in the queue with a
+        passive Queue.Declare (which doesn't create or change the queue). The
+        on_queue_depth method is invoked with the answer.
+
+        """
+        if cls.instance._channel is not None and cls.instance._channel.is_open:
+            cls.instance._channel.queue_declare(
+                queue=QUEUE, passive=True, callback=cls.instance.on_queue_depth
+            )
+
+    def on_queue_depth(cls, frame):
+        """Invoked by pika when the passive Queue.Declare has completed.
+
+        :param pika.frame.Method frame: The Queue.DeclareOk response frame
+
+        """
+        if cls.flow_controller is not None:
+            cls.flow_controller.queue_depth = frame.method.message_count
+
     def start_consuming(cls):
         """This method sets up the consumer by first calling
         add_on_cancel_callback so that the object is notified if RabbitMQ
@@ -279,7 +330,7 @@ class ConsumerQueue(object):
         will invoke when a message is fully received.
 
         """
-        main.logger.info('Issuing consumer related RPC commands')
+        logger.info('Issuing consumer related RPC commands')
         cls.instance.add_on_cancel_callback()
         cls.instance._consumer_tag = cls.instance._channel.basic_consume(
             QUEUE, cls.instance.on_message
@@ -293,7 +344,7 @@ class ConsumerQueue(object):
         on_consumer_cancelled will be invoked by pika.
 
         """
-        main.logger.info('Adding consumer cancellation callback')
+        logger.info('Adding consumer cancellation callback')
         cls.instance._channel.add_on_cancel_callback(cls.instance.on_consumer_cancelled)
 
     def on_consumer_cancelled(cls, method_frame):
@@ -303,9 +354,7 @@ class ConsumerQueue(object):
         :param pika.frame.Method method_frame: The Basic.Cancel frame
 
         """
-        main.logger.info(
-            'Consumer was cancelled remotely, shutting down: %r', method_frame
-        )
+        logger.info('Consumer was cancelled remotely, shutting down: %r', method_frame)
         if cls.instance._channel:
             cls.instance._channel.close()
 
@@ -323,6 +372,26 @@ class ConsumerQueue(object):
         :param bytes body: The message body
 
         """
+        if cls.spool is not None:
+            message_id = message_id_of(properties, body)
+            # Acked as soon as it is spooled: a message that can't be applied
+            # would block the replay, so it is rejected (dead-lettered) first
+            try:
+                validate_message(body, getattr(properties, "content_encoding", None))
+            except (ValueError, TypeError) as e:
+                logger.error('Rejecting invalid message %s: %s', message_id, e)
+                channel.basic_nack(basic_deliver.delivery_tag, requeue=False)
+                return
+            if cls.flow_controller is not None:
+                cls.flow_controller.delivered += 1
+            # Acked once durable in the spool, the replayer stores it
+            written = cls.spool.append(message_id, body)
+            written.add_done_callback(
+                functools.partial(
+                    cls.instance.on_spooled, channel, basic_deliver.delivery_tag
+                )
+            )
+            return
         # recibiré mensajes y los proceso de forma asincrona
         cls.instance._connection.ioloop.create_task(
             MessageQueueWrapper(channel, basic_deliver, properties, body)
@@ -330,6 +399,27 @@ class ConsumerQueue(object):
         # !TODO ni idea para que son los ACK en esto, pero por las dudas..
         cls.instance.acknowledge_message(basic_deliver.delivery_tag)
 
+    def on_spooled(cls, channel, delivery_tag, written):
+        """Invoked once a message was written to the spool (or failed to):
+        acks it, or rejects it so that the broker redelivers it. If the
+        channel was closed meanwhile, the broker redelivers it anyway.
+
+        :param pika.channel.Channel channel: The channel of the delivery
+        :param int delivery_tag: The delivery tag from the Basic.Deliver frame
+        :param asyncio.Future written: The future returned by Spool.append
+
+        """
+        if cls.flow_controller is not None and channel is cls.instance._channel:
+            cls.flow_controller.acked += 1
+        if not channel.is_open:
+            return
+        if written.exception() is not None:
+            logger.error('Could not spool message %s', delivery_tag)
+            channel.basic_nack(delivery_tag, requeue=True)
+            return
+        ack_logger.info('Acknowledging message %s', delivery_tag)
+        channel.basic_ack(delivery_tag)
+
     def acknowledge_message(cls, delivery_tag):
         """Acknowledge the message delivery from RabbitMQ by sending a
         Basic.Ack RPC method for the delivery tag.
@@ -337,7 +427,7 @@ class ConsumerQueue(object):
         :param int delivery_tag: The delivery tag from the Basic.Deliver frame
 
         """
-        main.logger.info('Acknowledging message %s', delivery_tag)
+        ack_logger.info('Acknowledging message %s', delivery_tag)
         cls.instance._channel.basic_ack(delivery_tag)
 
     def stop_consuming(cls):
@@ -346,7 +436,7 @@ class ConsumerQueue(object):
 
         """
         if cls.instance._channel:
-            main.logger.info('Sending a Basic.Cancel RPC command to RabbitMQ')
+            logger.info('Sending a Basic.Cancel RPC command to RabbitMQ')
             cb = functools.partial(
                 cls.instance.on_cancelok, userdata=cls.instance._consumer_tag
             )
@@ -363,7 +453,7 @@ class ConsumerQueue(object):
 
         """
         cls.instance._consuming = False
-        main.logger.info(
+        logger.info(
             'RabbitMQ acknowledged the cancellation of the consumer: %s', userdata
         )
         cls.instance.close_channel()
@@ -373,45 +463,44 @@ class ConsumerQueue(object):
         Channel.Close RPC command.
 
         """
-        main.logger.info('Closing the channel')
+        logger.info('Closing the channel')
         cls.instance._channel.close()
 
-    def run(cls):
-        """Run the example consumer by connecting to RabbitMQ and then
-        starting the IOLoop to block and allow the AsyncioConnection to operate.
+    async def run(cls):
+        """Run the consumer by connecting to RabbitMQ on the running event
+        loop, and wait until it is stopped (or the connection is lost).
 
         """
+        cls.instance._stopped = asyncio.Event()
         cls.instance._connection = cls.instance.connect()
-        cls.instance._connection.ioloop.run_forever()
+        await cls.instance._stopped.wait()
 
     def stop(cls):
         """Cleanly shutdown the connection to RabbitMQ by stopping the consumer
         with RabbitMQ. When RabbitMQ confirms the cancellation, on_cancelok
         will be invoked by pika, which will then closing the channel and
-        connection. The IOLoop is started again because this method is invoked
-        when CTRL-C is pressed raising a KeyboardInterrupt exception. This
-        exception stops the IOLoop which needs to be running for pika to
-        communicate with RabbitMQ. All of the commands issued prior to starting
-        the IOLoop will be buffered but not processed.
+        connection. run() returns once the connection is closed.
 
         """
         if not cls.instance._closing:
             cls.instance._closing = True
-            main.logger.info('Stopping')
-            if cls.instance._consuming:
+            logger.info('Stopping')
+            if cls.instance._consuming and cls.instance._channel:
                 cls.instance.stop_consuming()
-                cls.instance._connection.ioloop.run_forever()
             else:
-                cls.instance._connection.ioloop.stop()
-            main.logger.info('Stopped')
+                cls.instance._stopped.set()
+                logger.info('Stopped')
 
-    def _maybe_reconnect(cls):
+    async def _maybe_reconnect(cls):
         if cls.instance.should_reconnect:
             cls.instance.stop()
             reconnect_delay = cls.instance._get_reconnect_delay()
-            main.logger.info('Reconnecting after %d seconds', reconnect_delay)
-            time.sleep(reconnect_delay)
-            cls.instance = ConsumerQueue(cls.instance._url)
+            logger.info('Reconnecting after %d seconds', reconnect_delay)
+            await asyncio.sleep(reconnect_delay)
+            url = cls.instance._url
+            # Start over with a fresh instance
+            ConsumerQueue.instance = None
+            ConsumerQueue(url)._reconnect_delay = reconnect_delay
 
     def _get_reconnect_delay(cls):
         if cls.instance.was_consuming:
@@ -427,16 +516,29 @@ def getConsumerQueue() -> ConsumerQueue:
     return ConsumerQueue(os.environ["CLOUDAMQP_URL"])
 
 
+def update_prefetch(prefetch: int):
+    if ConsumerQueue.instance is not None:
+        ConsumerQueue.instance.update_prefetch(prefetch)
+
+
+def poll_queue_depth():
+    if ConsumerQueue.instance is not None:
+        ConsumerQueue.instance.poll_queue_depth()
+
+
 async def runConsumerQueue():
     consumer = getConsumerQueue()
 
     while True:
+        logger.info('Starting the consumer')
         try:
-            main.logger.info('Starting cls.instance._consumer.run()')
-            consumer.run()
-        except KeyboardInterrupt:
-            main.logger.info('Stopping cls.instance._consumer.stop()')
+            await consumer.run()
+        except asyncio.CancelledError:
+            logger.info('Stopping the consumer')
             consumer.stop()
+            raise
+        if not consumer.should_reconnect:
+            logger.info('Consumer stopped')
             break
-        main.logger.info('Maybe reconnecting cls.instance._maybe_reconnect()')
-        consumer._maybe_reconnect()
+        logger.info('Maybe reconnecting cls.instance._maybe_reconnect()')
+        await consumer._maybe_reconnect()
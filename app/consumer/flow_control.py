@@ -0,0 +1,183 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from typing import Optional
+
+# Adaptive prefetch and replay batch size of a spooling consumer (see
+# app/spool.py), retuned every FLOW_CONTROL_INTERVAL_SECONDS with AIMD:
+#   - the replayed batches took longer than FLOW_TARGET_LATENCY_MS to commit
+#     (or failed): both are halved;
+#   - otherwise, while the broker has a backlog (queue depth from a passive
+#     Queue.Declare) and the unacked messages fill the prefetch window, the
+#     prefetch grows by FLOW_PREFETCH_STEP; while the batches come out full
+#     and commit well under the target, the batch size grows by
+#     FLOW_BATCH_STEP.
+# Both stay within their FLOW_MIN_* and FLOW_MAX_* bounds. The last
+# decisions are kept for GET /admin/ingest.
+
+FLOW_CONTROL = os.environ.get("FLOW_CONTROL", "true").lower() == "true"
+FLOW_CONTROL_INTERVAL_SECONDS = float(
+    os.environ.get("FLOW_CONTROL_INTERVAL_SECONDS", 5)
+)
+FLOW_TARGET_LATENCY_MS = float(os.environ.get("FLOW_TARGET_LATENCY_MS", 250))
+FLOW_MIN_PREFETCH = int(os.environ.get("FLOW_MIN_PREFETCH", 50))
+FLOW_MAX_PREFETCH = int(os.environ.get("FLOW_MAX_PREFETCH", 10000))
+FLOW_PREFETCH_STEP = int(os.environ.get("FLOW_PREFETCH_STEP", 100))
+FLOW_MIN_BATCH = int(os.environ.get("FLOW_MIN_BATCH", 50))
+FLOW_MAX_BATCH = int(os.environ.get("FLOW_MAX_BATCH", 5000))
+FLOW_BATCH_STEP = int(os.environ.get("FLOW_BATCH_STEP", 50))
+
+# Fraction of the prefetch window (or of the batch size) considered full,
+# and of the target latency under which the batches may grow
+SATURATION = 0.9
+HEADROOM = 0.8
+DECREASE_FACTOR = 0.5
+DECISIONS_KEPT = 20
+
+logger = logging.getLogger('app')
+
+
+class FlowController:
+    def __init__(
+        self,
+        prefetch: int,
+        batch_size: int,
+        target_latency: float = FLOW_TARGET_LATENCY_MS / 1000,
+        prefetch_bounds: tuple = (FLOW_MIN_PREFETCH, FLOW_MAX_PREFETCH),
+        batch_bounds: tuple = (FLOW_MIN_BATCH, FLOW_MAX_BATCH),
+        prefetch_step: int = FLOW_PREFETCH_STEP,
+        batch_step: int = FLOW_BATCH_STEP,
+        interval: float = FLOW_CONTROL_INTERVAL_SECONDS,
+    ):
+        self.prefetch = prefetch
+        self.batch_size = batch_size
+        self.target_latency = target_latency
+        self.prefetch_bounds = prefetch_bounds
+        self.batch_bounds = batch_bounds
+        self.prefetch_step = prefetch_step
+        self.batch_step = batch_step
+        self.interval = interval
+        # Called with the new prefetch, and the replayer whose batch size
+        # is tuned (see attach)
+        self.apply_prefetch = None
+        self.replayer = None
+        self.delivered = 0
+        self.acked = 0
+        self.queue_depth = None
+        # (seconds, records, failed) of the batches replayed since the last
+        # decision
+        self.commits = []
+        self.decisions = deque(maxlen=DECISIONS_KEPT)
+        self.increases = 0
+        self.decreases = 0
+
+    @property
+    def in_flight(self) -> int:
+        return self.delivered - self.acked
+
+    def attach(self, replayer, apply_prefetch=None):
+        """
+        Tunes the batch size of the replayer (whose apply is timed) and
+        calls apply_prefetch(prefetch) when the prefetch changes
+        """
+        self.replayer = replayer
+        self.apply_prefetch = apply_prefetch
+        replayer.batch_size = self.batch_size
+        apply = replayer.apply
+
+        async def timed(records):
+            started = time.perf_counter()
+            try:
+                await apply(records)
+            except Exception:
+                self.commits.append((time.perf_counter() - started, len(records), True))
+                raise
+            self.commits.append((time.perf_counter() - started, len(records), False))
+
+        replayer.apply = timed
+
+    def decide(self) -> Optional[str]:
+        """
+        Retunes the prefetch and batch size from the commits since the last
+        call. Returns "decrease", "increase" or None (unchanged)
+        """
+        commits, self.commits = self.commits, []
+        latency = max((seconds for seconds, _, _ in commits), default=None)
+        failed = any(failed for _, _, failed in commits)
+        prefetch, batch_size = self.prefetch, self.batch_size
+        if failed or (latency is not None and latency > self.target_latency):
+            prefetch = int(prefetch * DECREASE_FACTOR)
+            batch_size = int(batch_size * DECREASE_FACTOR)
+        else:
+            if self.queue_depth and self.in_flight >= SATURATION * prefetch:
+                prefetch += self.prefetch_step
+            full = [c for c in commits if c[1] >= SATURATION * batch_size]
+            if full and latency < HEADROOM * self.target_latency:
+                batch_size += self.batch_step
+        prefetch = min(max(prefetch, self.prefetch_bounds[0]), self.prefetch_bounds[1])
+        batch_size = min(max(batch_size, self.batch_bounds[0]), self.batch_bounds[1])
+
+        if (prefetch, batch_size) == (self.prefetch, self.batch_size):
+            return None
+        decision = (
+            "decrease"
+            if prefetch < self.prefetch or batch_size < self.batch_size
+            else "increase"
+        )
+        if decision == "decrease":
+            self.decreases += 1
+        else:
+            self.increases += 1
+        self.decisions.append(
+            {
+                "at": time.time(),
+                "decision": decision,
+                "prefetch": prefetch,
+                "batch_size": batch_size,
+                "latency_ms": None if latency is None else round(latency * 1000, 1),
+                "in_flight": self.in_flight,
+                "queue_depth": self.queue_depth,
+            }
+        )
+        logger.info(
+            "Flow control %s: prefetch %d -> %d, batch size %d -> %d",
+            decision,
+            self.prefetch,
+            prefetch,
+            self.batch_size,
+            batch_size,
+        )
+        if prefetch != self.prefetch and self.apply_prefetch is not None:
+            self.apply_prefetch(prefetch)
+        self.prefetch, self.batch_size = prefetch, batch_size
+        if self.replayer is not None:
+            self.replayer.batch_size = batch_size
+        return decision
+
+    async def run(self, poll_queue_depth=None):
+        """
+        Decides every interval, after asking poll_queue_depth() (if given)
+        to refresh the queue depth
+        """
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                if poll_queue_depth is not None:
+                    poll_queue_depth()
+                self.decide()
+            except Exception as e:
+                logger.error("Flow control failed: %s", e)
+
+    def to_dict(self) -> dict:
+        return {
+            "prefetch": self.prefetch,
+            "batch_size": self.batch_size,
+            "target_latency_ms": round(self.target_latency * 1000, 1),
+            "in_flight": self.in_flight,
+            "queue_depth": self.queue_depth,
+            "increases": self.increases,
+            "decreases": self.decreases,
+            "decisions": list(self.decisions),
+        }
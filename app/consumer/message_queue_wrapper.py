@@ -1,13 +1,16 @@
-import json
+import logging
 from app.entries_utils import (
-    add_db_entry,
+    add_db_entries,
     delete_db_all_entries_with_training_id,
     delete_db_entry_by_training_and_action,
     delete_db_entry_by_user_and_action,
     update_db_entry_location,
 )
-import app.main as main
+from app.consumer.payloads import decode_events, event_id
 from app.db import get_session
+from app.dedup import message_id_of, recent_ids
+from app.events import ENTRIES_CHANGED, ENTRIES_INSERTED, event_bus
+from app.history_views import history_view_refresher
 from app.definitions import (
     ADD_TRAINING_TO_FAVS,
     BLOCK,
@@ -21,6 +24,9 @@ from app.definitions import (
     USER_SERVICE,
 )
 from app.models import EntryCreate
+from app.profiling import PROFILE_QUEUE_SAMPLE_RATE, profiler
+
+logger = logging.getLogger('app.ingest')
 
 
 async def MessageQueueWrapper(channel, basic_deliver, properties, message):
@@ -30,10 +36,68 @@ async def MessageQueueWrapper(channel, basic_deliver, properties, message):
     :param pika.channel.Channel channel: The channel object
     :param pika.Spec.Basic.Deliver: basic_deliver method
     :param pika.Spec.BasicProperties: properties
-    :param bytes body: The message body
+    :param bytes body: The message body (an event or a batch of them, see
+        app/consumer/payloads.py)
+    """
+    message_id = message_id_of(properties, message)
+    if recent_ids.seen(message_id):
+        logger.info("[QUEUE] Dropped duplicate message %s", message_id)
+        return
+
+    try:
+        with profiler.sample("queue", "MessageQueueWrapper", PROFILE_QUEUE_SAMPLE_RATE):
+            encoding = getattr(properties, "content_encoding", None)
+            events, batched = decode_events(message, encoding)
+            if batched:
+                await process_batch(_batch_events(message_id, events))
+            else:
+                await process_message(events[0], message_id)
+    except Exception:
+        recent_ids.forget(message_id)
+        raise
+
+
+def validate_message(body: bytes, content_encoding: str = None):
+    """
+    Raises ValueError (or TypeError) unless the body decodes to events that
+    can be applied: its new entries are valid EntryCreate, and its training
+    deletes name a training
+    """
+    events, _ = decode_events(body, content_encoding)
+    for event in events:
+        if is_new_entry(event):
+            EntryCreate(**event)
+        elif _is_training_delete(event) and not event.get("training_id"):
+            raise ValueError("A delete_training message needs a training_id")
+
+
+def _is_training_delete(message: dict) -> bool:
+    return (
+        message.get("service") == TRAINING_SERVICE
+        and message.get("action") == DELETE_TRAINING
+    )
+
+
+def is_new_entry(message: dict) -> bool:
+    """
+    Returns whether the message is stored as a new entry (instead of
+    updating or deleting existing ones)
+    """
+    service = message.get("service")
+    action = message.get("action")
+    if service == USER_SERVICE:
+        return not (
+            action in (UNBLOCK, REMOVE_TRAINING_FROM_FAVS)
+            or (action == USER_EDIT and message.get("country"))
+        )
+    return service == TRAINING_SERVICE and action in (NEW_TRAINING, MEDIA_UPLOAD)
+
+
+async def process_message(message: dict, message_id: str):
+    """
+    Applies a metrics message to the database
     """
-    message = json.loads(message.decode('utf-8'))
-    main.logger.info(message)
+    logger.info(message)
 
     async for session in get_session():
         service = message.get("service")
@@ -41,24 +105,92 @@ async def MessageQueueWrapper(channel, basic_deliver, properties, message):
         user_id = message.get("user_id")
         action = message.get("action")
 
-        main.logger.info(f"[QUEUE] New message received from {service}")
+        logger.info("[QUEUE] New message received from %s", service)
 
-        if service == USER_SERVICE:
+        if is_new_entry(message):
+            await add_entry(EntryCreate(**message), message_id, session)
+        elif service == USER_SERVICE:
             if action == UNBLOCK:
                 await delete_db_entry_by_user_and_action(user_id, BLOCK, session)
-            elif action == USER_EDIT and country:
+            elif action == USER_EDIT:
                 await update_db_entry_location(user_id, country, session)
             elif action == REMOVE_TRAINING_FROM_FAVS:
                 training_id = message.get("training_id")
                 await delete_db_entry_by_training_and_action(
                     training_id, ADD_TRAINING_TO_FAVS, session
                 )
-            else:
-                await add_db_entry(EntryCreate(**message), session)
+            event_bus.publish(ENTRIES_CHANGED, (USER_SERVICE,))
+        elif _is_training_delete(message):
+            training_id = message.get("training_id")
+            await delete_db_all_entries_with_training_id(training_id, session)
+            event_bus.publish(ENTRIES_CHANGED)
 
-        if service == TRAINING_SERVICE:
-            if action in (NEW_TRAINING, MEDIA_UPLOAD):
-                await add_db_entry(EntryCreate(**message), session)
-            elif action == DELETE_TRAINING:
-                training_id = message.get("training_id")
-                await delete_db_all_entries_with_training_id(training_id, session)
+        history_view_refresher.notify_changed()
+
+
+def _batch_events(message_id: str, events: list) -> list:
+    return [(event_id(message_id, index), event) for index, event in enumerate(events)]
+
+
+async def process_batch(messages: list):
+    """
+    Applies (message id, message) pairs in order, bulk inserting each run of
+    new entries
+    """
+    entries, message_ids = [], []
+
+    async def insert_pending():
+        if not entries:
+            return
+        async for session in get_session():
+            inserted = await add_db_entries(entries, session, message_ids=message_ids)
+        recent_ids.dropped_db += len(entries) - inserted
+        # On a retry, which ones were already stored is unknown: the live
+        # counts are then resynced at the next refresh
+        if inserted == len(entries):
+            event_bus.publish(ENTRIES_INSERTED, list(entries))
+        history_view_refresher.notify_changed(inserted)
+        entries.clear()
+        message_ids.clear()
+
+    for message_id, message in messages:
+        if is_new_entry(message):
+            entries.append(EntryCreate(**message))
+            message_ids.append(message_id)
+            continue
+        await insert_pending()
+        await process_message(message, message_id)
+    await insert_pending()
+
+
+async def process_spooled(records: list):
+    """
+    Applies a batch of spooled (message id, body) records in order (see
+    process_batch). If it fails, the whole batch is retried: the entries
+    already stored are skipped by their message id
+    """
+    seen, messages = [], []
+    try:
+        with profiler.sample("queue", "process_spooled", PROFILE_QUEUE_SAMPLE_RATE):
+            for message_id, body in records:
+                if recent_ids.seen(message_id):
+                    continue
+                seen.append(message_id)
+                events, batched = decode_events(body)
+                if batched:
+                    messages.extend(_batch_events(message_id, events))
+                else:
+                    messages.append((message_id, events[0]))
+            await process_batch(messages)
+    except Exception:
+        for message_id in seen:
+            recent_ids.forget(message_id)
+        raise
+
+
+async def add_entry(entry: EntryCreate, message_id: str, session):
+    if not await add_db_entries([entry], session, message_ids=[message_id]):
+        recent_ids.dropped_db += 1
+        logger.info("[QUEUE] Message %s was already stored", message_id)
+        return
+    event_bus.publish(ENTRIES_INSERTED, [entry])
@@ -0,0 +1,95 @@
+import os
+import zlib
+import orjson
+
+# Bodies of the metrics messages. A message carries a single event (a JSON
+# object, as always) or a batch of them: a JSON array of objects, or NDJSON
+# (one object per line). The body may be compressed, with the AMQP
+# content_encoding set to gzip or zstd (zstd needs the zstandard package,
+# poetry install -E zstd). Compressed bodies are also recognized by their
+# magic bytes, since the spool only keeps the body.
+
+# Decompressed size limit of a message
+MAX_MESSAGE_BYTES = int(os.environ.get("MAX_MESSAGE_BYTES", 64 * 1024 * 1024))
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+IDENTITY_ENCODINGS = ("", "identity", "utf-8", "utf8")
+CHUNK_SIZE = 1024 * 1024
+
+
+def _encoding_of(body: bytes, content_encoding) -> str:
+    content_encoding = (content_encoding or "").strip().lower()
+    if content_encoding not in IDENTITY_ENCODINGS:
+        return content_encoding
+    if body[:2] == GZIP_MAGIC:
+        return "gzip"
+    if body[:4] == ZSTD_MAGIC:
+        return "zstd"
+    return "identity"
+
+
+def _gunzip(body: bytes, limit: int) -> bytes:
+    decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+    data = decompressor.decompress(body, limit + 1)
+    if len(data) > limit:
+        raise ValueError(f"Message larger than {limit} bytes once decompressed")
+    return data
+
+
+def _unzstd(body: bytes, limit: int) -> bytes:
+    try:
+        import zstandard
+    except ImportError:
+        raise ValueError("zstd messages need zstandard (poetry install -E zstd)")
+    chunks, size = [], 0
+    with zstandard.ZstdDecompressor().stream_reader(body) as reader:
+        while True:
+            chunk = reader.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > limit:
+                raise ValueError(f"Message larger than {limit} bytes once decompressed")
+            chunks.append(chunk)
+    return b"".join(chunks)
+
+
+def decompress(
+    body: bytes, content_encoding: str = None, limit: int = MAX_MESSAGE_BYTES
+) -> bytes:
+    encoding = _encoding_of(body, content_encoding)
+    if encoding == "identity":
+        return body
+    if encoding in ("gzip", "x-gzip"):
+        return _gunzip(body, limit)
+    if encoding == "zstd":
+        return _unzstd(body, limit)
+    raise ValueError(f"Unsupported content encoding: {content_encoding}")
+
+
+def decode_events(body: bytes, content_encoding: str = None) -> tuple:
+    """
+    Returns the events of a message body and whether it was a batch
+    """
+    body = decompress(body, content_encoding)
+    try:
+        decoded = orjson.loads(body)
+    except orjson.JSONDecodeError:
+        # NDJSON: one event per (non-empty) line
+        lines = [line for line in body.splitlines() if line.strip()]
+        if len(lines) < 2:
+            raise
+        decoded = [orjson.loads(line) for line in lines]
+    if isinstance(decoded, dict):
+        return [decoded], False
+    if not isinstance(decoded, list) or not all(isinstance(e, dict) for e in decoded):
+        raise ValueError("A message must be an event or a batch of events")
+    return decoded, True
+
+
+def event_id(message_id: str, index: int) -> str:
+    """
+    Returns the message id of an event of a batch
+    """
+    return f"{message_id}#{index}"
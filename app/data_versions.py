@@ -0,0 +1,230 @@
+import asyncio
+import datetime as dt
+import logging
+import os
+from typing import Iterable, Optional
+import orjson
+from sqlalchemy import text
+from app.aggregates import HISTORY_AGGREGATES
+from app.db import engine
+from app.events import (
+    ENTRIES_CHANGED,
+    ENTRIES_INSERTED,
+    HISTORY_REFRESHED,
+    event_bus,
+)
+
+# Monotonic data version of each aggregate family (the service whose entries
+# an aggregate counts), for the conditional GETs of /history.
+#
+# Every process counts the families its writes touched (from the event bus)
+# and adds them to data_version.changes, batched and always after the write
+# committed. Before refreshing the views, the refresher reads those counters;
+# once the refresh is done it publishes them as the families' versions and
+# NOTIFYs every process, which keep them in memory. So a version only moves
+# when the data served by the views may have changed, and answering a 304
+# needs no query. A write counted too late for a refresh is picked up by the
+# next one.
+#
+# The other processes don't run the refresher, so a notification (or a
+# periodic reload) that moves a version also publishes HISTORY_REFRESHED on
+# their event bus, for the live dashboard to resync. The refresher's process
+# already holds the new versions when its own notification arrives.
+
+DATA_VERSION_FLUSH_SECONDS = float(os.environ.get("DATA_VERSION_FLUSH_SECONDS", 0.5))
+# The versions are also reloaded this often, in case a notification was lost
+DATA_VERSION_RELOAD_SECONDS = float(os.environ.get("DATA_VERSION_RELOAD_SECONDS", 30))
+
+CHANNEL = "data_version"
+FAMILIES = tuple(sorted({aggregate.service for aggregate in HISTORY_AGGREGATES}))
+
+logger = logging.getLogger('app')
+
+
+class DataVersions:
+    def __init__(self, families: tuple, flush_interval: float, reload_interval: float):
+        self.families = families
+        self.flush_interval = flush_interval
+        self.reload_interval = reload_interval
+        # Families changed since the last flush
+        self.pending = set()
+        # family -> (version, time of the refresh that published it)
+        self.versions = {}
+        self.flushes = 0
+        self.notifications = 0
+        self.not_modified = 0
+
+    def mark_changed(self, families: Optional[Iterable[str]] = None):
+        """
+        Records that entries of the families (all of them if None) changed
+        """
+        if families is None:
+            self.pending.update(self.families)
+        else:
+            self.pending.update(f for f in families if f in self.families)
+
+    def on_event(self, kind: str, payload):
+        if kind == ENTRIES_INSERTED:
+            self.mark_changed({entry.service for entry in payload})
+        elif kind == ENTRIES_CHANGED:
+            self.mark_changed(payload)
+
+    def get(self, family: str) -> Optional[tuple]:
+        return self.versions.get(family)
+
+    async def init(self, conn):
+        await conn.execute(
+            text(
+                "INSERT INTO data_version (family, changes, version) "
+                "SELECT unnest(CAST(:families AS text[])), 0, 0 "
+                "ON CONFLICT DO NOTHING"
+            ),
+            {"families": list(self.families)},
+        )
+        await self.load(conn)
+
+    async def load(self, conn, announce: bool = False):
+        result = await conn.execute(
+            text("SELECT family, version, refreshed_at FROM data_version")
+        )
+        versions = {family: (version, at) for family, version, at in result}
+        if announce:
+            self._replace(versions)
+        else:
+            self.versions = versions
+
+    def _replace(self, versions: dict):
+        """
+        Sets the versions refreshed by another process, and tells the
+        subscribers of the event bus if any of them moved
+        """
+        moved = any(
+            version != self.versions.get(family, (None,))[0]
+            for family, (version, _) in versions.items()
+        )
+        self.versions = versions
+        if moved:
+            event_bus.publish(HISTORY_REFRESHED)
+
+    async def flush(self):
+        """
+        Adds the pending families to their changes counter
+        """
+        if not self.pending:
+            return
+        families, self.pending = self.pending, set()
+        try:
+            async with engine.begin() as conn:
+                await conn.execute(
+                    text(
+                        "UPDATE data_version SET changes = changes + 1 "
+                        "WHERE family = ANY(CAST(:families AS text[]))"
+                    ),
+                    {"families": sorted(families)},
+                )
+        except Exception:
+            self.pending |= families
+            raise
+        self.flushes += 1
+
+    async def snapshot(self, conn) -> dict:
+        """
+        Returns the changes counter of each family. Called before a refresh
+        """
+        await self.flush()
+        result = await conn.execute(text("SELECT family, changes FROM data_version"))
+        return dict(result.all())
+
+    async def publish(self, conn, changes: dict):
+        """
+        Publishes the counters read before a refresh as the versions of the
+        families, and notifies the other processes
+        """
+        families = sorted(changes)
+        await conn.execute(
+            text(
+                "UPDATE data_version SET version = seen.changes, refreshed_at = now() "
+                "FROM (SELECT unnest(CAST(:families AS text[])) AS family, "
+                "unnest(CAST(:changes AS bigint[])) AS changes) AS seen "
+                "WHERE data_version.family = seen.family "
+                "AND data_version.version <> seen.changes"
+            ),
+            {"families": families, "changes": [changes[f] for f in families]},
+        )
+        await self.load(conn)
+        await conn.execute(
+            text("SELECT pg_notify(:channel, :payload)"),
+            {"channel": CHANNEL, "payload": orjson.dumps(self.versions).decode()},
+        )
+
+    def _on_notification(self, connection, pid, channel, payload):
+        self.notifications += 1
+        self._replace(
+            {
+                family: (version, at and dt.datetime.fromisoformat(at))
+                for family, (version, at) in orjson.loads(payload).items()
+            }
+        )
+
+    async def run(self):
+        """
+        Counts the changes published on the event bus and flushes them every
+        DATA_VERSION_FLUSH_SECONDS
+        """
+        subscription = event_bus.subscribe()
+        dropped = 0
+        try:
+            while True:
+                self.on_event(*await subscription.get())
+                await asyncio.sleep(self.flush_interval)
+                while not subscription.empty():
+                    self.on_event(*subscription.get_nowait())
+                if subscription.dropped != dropped:
+                    dropped = subscription.dropped
+                    self.mark_changed()
+                try:
+                    await self.flush()
+                except Exception as e:
+                    logger.error("Could not flush the data versions: %s", e)
+        finally:
+            event_bus.unsubscribe(subscription)
+
+    async def listen(self):
+        """
+        Keeps the versions up to date from the refresher's notifications (on
+        a connection of the primary: notifications don't reach replicas)
+        """
+        while True:
+            try:
+                async with engine.connect() as conn:
+                    conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+                    raw = (await conn.get_raw_connection()).driver_connection
+                    await raw.add_listener(CHANNEL, self._on_notification)
+                    try:
+                        while True:
+                            await self.load(conn, announce=True)
+                            await asyncio.sleep(self.reload_interval)
+                    finally:
+                        await raw.remove_listener(CHANNEL, self._on_notification)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("Data versions listener failed (%s), reconnecting", e)
+                await asyncio.sleep(self.reload_interval)
+
+    def to_dict(self) -> dict:
+        return {
+            "versions": {
+                family: {"version": version, "refreshed_at": at}
+                for family, (version, at) in self.versions.items()
+            },
+            "pending": sorted(self.pending),
+            "flushes": self.flushes,
+            "notifications": self.notifications,
+            "not_modified": self.not_modified,
+        }
+
+
+data_versions = DataVersions(
+    FAMILIES, DATA_VERSION_FLUSH_SECONDS, DATA_VERSION_RELOAD_SECONDS
+)
@@ -1,21 +1,169 @@
+import asyncio
+import logging
 import os
+import time
 from sqlmodel import SQLModel
+from sqlalchemy import text
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
+from app import models  # registers the tables in SQLModel.metadata
+from app.entry_storage import create_entry_storage
+from app.query_stats import instrument_engine
 
 
 DATABASE_URL = os.environ.get("DATABASE_URL")
+# Optional read-only database (replica) for the analytics queries
+DATABASE_READ_URL = os.environ.get("DATABASE_READ_URL")
+# Fall back to the primary when the replica lags behind more than this
+REPLICA_MAX_LAG_SECONDS = os.environ.get("REPLICA_MAX_LAG_SECONDS")
+REPLICA_LAG_CHECK_INTERVAL = float(os.environ.get("REPLICA_LAG_CHECK_INTERVAL", 5))
+# Serializes the schema changes of the processes starting at the same time
+SCHEMA_LOCK_ID = 802_038
+
+# 0 when the replica has replayed everything it received (or is not a replica)
+REPLICA_LAG_QUERY = text(
+    """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(
+            EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0
+        )
+    END
+    """
+)
+
+logger = logging.getLogger('app')
 
 engine = create_async_engine(DATABASE_URL, echo=True, future=True)
+instrument_engine(engine)
+
+if DATABASE_READ_URL:
+    read_engine = create_async_engine(
+        DATABASE_READ_URL,
+        echo=True,
+        future=True,
+        execution_options={"postgresql_readonly": True},
+    )
+    instrument_engine(read_engine)
+else:
+    read_engine = engine
+
+async_session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+async_read_session = sessionmaker(
+    read_engine, class_=AsyncSession, expire_on_commit=False
+)
+
+
+class ReplicaMonitor:
+    """
+    Periodically checks the replication lag of the read engine and decides
+    whether read sessions should fall back to the primary
+    """
+
+    def __init__(self, max_lag: float, interval: float):
+        self.max_lag = max_lag
+        self.interval = interval
+        self.lag = None
+        self.healthy = True
+        self.checked_at = 0.0
+        self.fallbacks = 0
+        self._lock = None
+
+    async def check(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if time.monotonic() - self.checked_at < self.interval:
+                return
+            try:
+                async with read_engine.connect() as conn:
+                    self.lag = float(await conn.scalar(REPLICA_LAG_QUERY))
+                self.healthy = self.lag <= self.max_lag
+            except Exception as e:
+                logger.warning("Could not check replica lag: %s", e)
+                self.healthy = False
+            self.checked_at = time.monotonic()
+
+    async def use_replica(self) -> bool:
+        if time.monotonic() - self.checked_at >= self.interval:
+            await self.check()
+        if not self.healthy:
+            self.fallbacks += 1
+        return self.healthy
+
+    def to_dict(self) -> dict:
+        return {
+            "lag_seconds": self.lag,
+            "max_lag_seconds": self.max_lag,
+            "healthy": self.healthy,
+            "fallbacks": self.fallbacks,
+        }
+
+
+replica_monitor = (
+    ReplicaMonitor(float(REPLICA_MAX_LAG_SECONDS), REPLICA_LAG_CHECK_INTERVAL)
+    if DATABASE_READ_URL and REPLICA_MAX_LAG_SECONDS
+    else None
+)
+
+
+async def lock_schema(conn):
+    """
+    Waits for the schema lock, held until the end of the transaction
+    """
+    await conn.execute(
+        text("SELECT pg_advisory_xact_lock(:id)"), {"id": SCHEMA_LOCK_ID}
+    )
 
 
 async def init_db():
+    tables = [
+        table
+        for table in SQLModel.metadata.sorted_tables
+        if not table.info.get("is_view")
+    ]
     async with engine.begin() as conn:
+        await lock_schema(conn)
         # await conn.run_sync(SQLModel.metadata.drop_all)
-        await conn.run_sync(SQLModel.metadata.create_all)
+        await conn.run_sync(SQLModel.metadata.create_all, tables=tables)
+        await create_entry_storage(conn)
 
 
 async def get_session() -> AsyncSession:
-    async_session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
     async with async_session() as session:
         yield session
+
+
+async def get_read_session() -> AsyncSession:
+    """
+    Session for read-only queries. Uses the read engine (if configured)
+    unless it is lagging behind, in which case it uses the primary
+    """
+    maker = async_read_session
+    if replica_monitor is not None and not await replica_monitor.use_replica():
+        maker = async_session
+    async with maker() as session:
+        yield session
+
+
+def pool_status() -> dict:
+    """
+    Returns the connection pool metrics of each engine
+    """
+    engines = {"primary": engine}
+    if read_engine is not engine:
+        engines["read"] = read_engine
+
+    status = {}
+    for name, target in engines.items():
+        pool = target.sync_engine.pool
+        status[name] = {
+            "size": pool.size(),
+            "checked_in": pool.checkedin(),
+            "checked_out": pool.checkedout(),
+            "overflow": pool.overflow(),
+        }
+    if replica_monitor is not None:
+        status["replica"] = replica_monitor.to_dict()
+    return status
@@ -0,0 +1,63 @@
+import hashlib
+import os
+from collections import OrderedDict
+
+# Fast path of the idempotent ingestion: ids of recently processed messages.
+# The unique entry_compact.message_id column is the source of truth, so this
+# only has to catch the (common) redeliveries of recent messages.
+
+DEDUP_CACHE_SIZE = int(os.environ.get("DEDUP_CACHE_SIZE", 100000))
+
+
+def message_id_of(properties, body: bytes) -> str:
+    """
+    Returns the producer message id of the AMQP properties or, if the
+    producer didn't set one, a hash of the body
+    """
+    message_id = getattr(properties, "message_id", None)
+    if message_id:
+        return str(message_id)
+    return "sha1:" + hashlib.sha1(body).hexdigest()
+
+
+class RecentIds:
+    """
+    Bounded LRU set of message ids, with counters of the duplicates dropped
+    by it and by the database unique constraint
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._ids = OrderedDict()
+        self.dropped_cache = 0
+        self.dropped_db = 0
+
+    def seen(self, message_id: str) -> bool:
+        """
+        Returns whether the id was already seen, remembering it otherwise
+        """
+        if message_id in self._ids:
+            self._ids.move_to_end(message_id)
+            self.dropped_cache += 1
+            return True
+        self._ids[message_id] = None
+        if len(self._ids) > self.max_size:
+            self._ids.popitem(last=False)
+        return False
+
+    def forget(self, message_id: str):
+        """
+        Forgets an id whose processing failed, so a redelivery is processed
+        """
+        self._ids.pop(message_id, None)
+
+    def to_dict(self) -> dict:
+        return {
+            "size": len(self._ids),
+            "max_size": self.max_size,
+            "dropped_duplicates_cache": self.dropped_cache,
+            "dropped_duplicates_db": self.dropped_db,
+        }
+
+
+recent_ids = RecentIds(DEDUP_CACHE_SIZE)
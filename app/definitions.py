@@ -15,3 +15,19 @@ DELETE_TRAINING = "delete_training"
 MEDIA_UPLOAD = "media_upload"
 ADD_TRAINING_TO_FAVS = "add_training_to_favs"
 REMOVE_TRAINING_FROM_FAVS = "remove_training_from_favs"
+
+ACTIONS = (
+    USER_EDIT,
+    SIGNUP,
+    GOOGLE_SIGNUP,
+    BLOCK,
+    UNBLOCK,
+    LOGIN,
+    GOOGLE_LOGIN,
+    PASSWORD_EDIT,
+    NEW_TRAINING,
+    DELETE_TRAINING,
+    MEDIA_UPLOAD,
+    ADD_TRAINING_TO_FAVS,
+    REMOVE_TRAINING_FROM_FAVS,
+)
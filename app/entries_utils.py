@@ -3,6 +3,10 @@ import json
 from fastapi import APIRouter
 from sqlalchemy import and_, or_
 from app.definitions import BLOCK, GOOGLE_SIGNUP, NEW_TRAINING, SIGNUP
+from app.entry_storage import PUBLIC_ENTRY_COLUMNS, insert_entries
+from app.geoip import resolve_country
+from app.route_templates import route_template
+from app.tombstones import add_tombstone
 from app.models import Entry, EntryCreate, EntryUpdate
 from sqlalchemy.future import select
 from sqlalchemy.ext.asyncio import AsyncSession
@@ -15,6 +19,7 @@ logger = logging.getLogger('app')
 
 
 async def add_db_entry(entry: EntryCreate, session: AsyncSession):
+    resolve_country(entry)
     entry = Entry(
         service=entry.service,
         path=entry.path,
@@ -29,6 +34,7 @@ async def add_db_entry(entry: EntryCreate, session: AsyncSession):
         action=entry.action,
         training_id=entry.training_id,
         training_type=entry.training_type,
+        path_template=route_template(entry.path),
     )
     session.add(entry)
     await session.commit()
@@ -36,6 +42,21 @@ async def add_db_entry(entry: EntryCreate, session: AsyncSession):
     return entry
 
 
+async def add_db_entries(entries: list, session: AsyncSession, message_ids=None):
+    """
+    Bulk inserts entries, bypassing the ORM. Used by the ingest path.
+    Returns the number of inserted entries: the ones whose message id was
+    already stored are skipped
+    """
+    if not entries:
+        return 0
+    for entry in entries:
+        resolve_country(entry)
+    inserted = await insert_entries(entries, session, message_ids)
+    await session.commit()
+    return inserted
+
+
 async def get_db_entry_by_id(id: int, session: AsyncSession):
     result = await session.execute(select(Entry).where(Entry.id == id))
     entry = result.scalars().first()
@@ -48,6 +69,16 @@ async def get_db_entries(session: AsyncSession):
     return [entry for entry in entries]
 
 
+async def get_db_entries_rows(session: AsyncSession):
+    """
+    Returns the column names and the row tuples of every entry, without
+    building ORM objects (nor the columns derived at ingest)
+    """
+    columns = [c for c in Entry.__table__.columns if c.name in PUBLIC_ENTRY_COLUMNS]
+    result = await session.execute(select(*columns))
+    return list(result.keys()), result.all()
+
+
 async def update_db_entry(id: int, updates: EntryUpdate, session: AsyncSession):
     entry = await session.get(Entry, id)
     if not entry:
@@ -55,6 +86,7 @@ async def update_db_entry(id: int, updates: EntryUpdate, session: AsyncSession):
 
     for key, value in updates.dict(exclude_unset=True).items():
         setattr(entry, key, value)
+    entry.path_template = route_template(entry.path)
 
     await session.commit()
     await session.refresh(entry)
@@ -139,17 +171,8 @@ async def delete_db_all_entries_with_training_id(
     training_id: str, session: AsyncSession
 ):
     """
-    Deletes all entries with the specified training ID
+    Deletes all entries with the specified training ID. They are hidden at
+    once by a tombstone and removed later by the compactor, so nothing is
+    returned. Raises ValueError if the training ID is missing or empty
     """
-    result = await session.execute(
-        select(Entry).where(Entry.training_id == training_id)
-    )
-
-    entries = result.scalars().all()
-
-    for entry in entries:
-        await session.delete(entry)
-
-    await session.commit()
-
-    return entries
+    await add_tombstone(training_id, session)
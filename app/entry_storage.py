@@ -0,0 +1,298 @@
+import hashlib
+import logging
+from typing import Optional
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.route_templates import route_template
+
+# Entries are stored in "entry_compact", with the low cardinality columns
+# dictionary-encoded as ids of "entry_term". The "entry" view decodes them,
+# so the Entry model and every query over it keep working unchanged; writes
+# through the view are redirected to entry_compact by INSTEAD OF triggers.
+# The joins are LEFT JOINs on a unique key, so the planner drops the ones a
+# query doesn't use.
+# The ingest path skips the view and writes the codes directly, resolving
+# them through an in-process cache (see TermCache). The history aggregates
+# skip it too: they resolve their filter values to ids and filter
+# entry_compact on them, so its indexes are used (see
+# HistoryAggregate.encoded_where_sql).
+
+ENCODED_COLUMNS = (
+    "service",
+    "path",
+    "url",
+    "method",
+    "country",
+    "action",
+    "training_type",
+)
+# Derived at ingest from the other columns (path_template: the route template
+# of the path, see app/route_templates.py) and encoded the same way
+DERIVED_COLUMNS = ("path_template",)
+# Columns stored as entry_term ids (<column>_id in entry_compact)
+TERM_COLUMNS = ENCODED_COLUMNS + DERIVED_COLUMNS
+
+logger = logging.getLogger('app')
+
+# Columns of the entry view, in order
+ENTRY_COLUMNS = (
+    "id",
+    "service",
+    "path",
+    "url",
+    "method",
+    "status_code",
+    "datetime",
+    "response_time",
+    "user_id",
+    "ip",
+    "country",
+    "action",
+    "training_id",
+    "training_type",
+    "path_template",
+)
+# Columns returned by the API: the derived ones are only used internally
+PUBLIC_ENTRY_COLUMNS = tuple(c for c in ENTRY_COLUMNS if c not in DERIVED_COLUMNS)
+_view_columns = ", ".join(
+    f"t_{column}.value AS {column}" if column in TERM_COLUMNS else f"e.{column}"
+    for column in ENTRY_COLUMNS
+)
+_view_joins = " ".join(
+    f"LEFT JOIN entry_term t_{column} ON t_{column}.id = e.{column}_id"
+    for column in TERM_COLUMNS
+)
+_encoded_values = ", ".join(f"entry_term_id(NEW.{column})" for column in TERM_COLUMNS)
+_encoded_assignments = ", ".join(
+    f"{column}_id = entry_term_id(NEW.{column})" for column in TERM_COLUMNS
+)
+_encoded_ids = ", ".join(f"{column}_id" for column in TERM_COLUMNS)
+
+# Columns added to entry_compact after it was first created
+ENTRY_COMPACT_UPGRADES = (
+    "ALTER TABLE entry_compact ADD COLUMN IF NOT EXISTS message_id text",
+    "CREATE UNIQUE INDEX IF NOT EXISTS entry_compact_message_id "
+    "ON entry_compact (message_id)",
+    "ALTER TABLE entry_compact ADD COLUMN IF NOT EXISTS path_template_id integer "
+    "REFERENCES entry_term (id)",
+    "CREATE INDEX IF NOT EXISTS entry_compact_path_template "
+    "ON entry_compact (path_template_id)",
+    # Entries left for the route template backfill (empty once it is done)
+    "CREATE INDEX IF NOT EXISTS entry_compact_without_path_template "
+    "ON entry_compact (id) WHERE path_template_id IS NULL",
+    # For the retention job
+    "CREATE INDEX IF NOT EXISTS entry_compact_datetime ON entry_compact (datetime)",
+    # For the activity timelines (see app/timelines.py)
+    "CREATE INDEX IF NOT EXISTS entry_compact_user_timeline "
+    "ON entry_compact (user_id, datetime, id) INCLUDE (action_id)",
+    "CREATE INDEX IF NOT EXISTS entry_compact_training_timeline "
+    "ON entry_compact (training_id, datetime, id) INCLUDE (action_id) "
+    "WHERE training_id <> ''",
+)
+
+# Condition on entry_compact (aliased e) hiding the entries of deleted
+# trainings until they are compacted (see app/tombstones.py)
+VISIBLE_ENTRY = """NOT EXISTS (
+        SELECT 1 FROM training_tombstone d
+        WHERE d.training_id = e.training_id AND e.id <= d.max_id
+    )"""
+
+ENTRY_VIEW_DDL = (
+    """
+    CREATE OR REPLACE FUNCTION entry_term_id(term text) RETURNS integer AS $$
+    DECLARE
+        term_id integer;
+    BEGIN
+        IF term IS NULL THEN
+            RETURN NULL;
+        END IF;
+        SELECT id INTO term_id FROM entry_term WHERE value = term;
+        IF term_id IS NULL THEN
+            INSERT INTO entry_term (value) VALUES (term)
+            ON CONFLICT (value) DO NOTHING RETURNING id INTO term_id;
+        END IF;
+        IF term_id IS NULL THEN
+            SELECT id INTO term_id FROM entry_term WHERE value = term;
+        END IF;
+        RETURN term_id;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    f"""
+    CREATE VIEW entry AS SELECT {_view_columns} FROM entry_compact e {_view_joins}
+    WHERE {VISIBLE_ENTRY}
+    """,
+    f"""
+    CREATE OR REPLACE FUNCTION entry_view_write() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            INSERT INTO entry_compact (
+                id, status_code, datetime, response_time, user_id, ip,
+                training_id, {_encoded_ids}
+            ) VALUES (
+                COALESCE(NEW.id, nextval(pg_get_serial_sequence('entry_compact', 'id'))),
+                NEW.status_code, NEW.datetime, NEW.response_time, NEW.user_id,
+                NEW.ip, COALESCE(NEW.training_id, ''), {_encoded_values}
+            ) RETURNING id INTO NEW.id;
+            RETURN NEW;
+        ELSIF TG_OP = 'UPDATE' THEN
+            UPDATE entry_compact SET
+                status_code = NEW.status_code, datetime = NEW.datetime,
+                response_time = NEW.response_time, user_id = NEW.user_id,
+                ip = NEW.ip, training_id = NEW.training_id, {_encoded_assignments}
+            WHERE id = OLD.id;
+            RETURN NEW;
+        END IF;
+        DELETE FROM entry_compact WHERE id = OLD.id;
+        RETURN OLD;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE TRIGGER entry_view_write INSTEAD OF INSERT OR UPDATE OR DELETE ON entry
+    FOR EACH ROW EXECUTE FUNCTION entry_view_write()
+    """,
+)
+ENTRY_VIEW_HASH = hashlib.sha1("".join(ENTRY_VIEW_DDL).encode('utf-8')).hexdigest()
+
+
+async def create_entry_storage(conn):
+    """
+    Upgrades entry_compact and creates the "entry" view and its triggers,
+    recreating them (and every view depending on them) when their definition
+    changed
+    """
+    kind = await conn.scalar(
+        text("SELECT relkind FROM pg_class WHERE oid = to_regclass('entry')")
+    )
+    if kind == "r":
+        raise RuntimeError(
+            'Found a legacy "entry" table, run '
+            "`python -m app.migrations.dictionary_encode_entries` first"
+        )
+    for statement in ENTRY_COMPACT_UPGRADES:
+        await conn.execute(text(statement))
+
+    current_hash = await conn.scalar(
+        text("SELECT obj_description(to_regclass('entry'), 'pg_class')")
+    )
+    if current_hash == ENTRY_VIEW_HASH:
+        return
+
+    logger.info('Creating the "entry" view')
+    await conn.execute(text("DROP VIEW IF EXISTS entry CASCADE"))
+    for statement in ENTRY_VIEW_DDL:
+        await conn.execute(text(statement))
+    await conn.execute(text(f"COMMENT ON VIEW entry IS '{ENTRY_VIEW_HASH}'"))
+
+
+class TermCache:
+    """
+    In-process cache of the entry_term dictionary (value <-> id). Terms are
+    only ever added, so cached ids never go stale
+    """
+
+    def __init__(self):
+        self.ids = {}
+        self.values = {}
+
+    def _add(self, rows):
+        for term_id, value in rows:
+            self.ids[value] = term_id
+            self.values[term_id] = value
+
+    async def load(self, session: AsyncSession):
+        result = await session.execute(text("SELECT id, value FROM entry_term"))
+        self._add(result)
+
+    async def resolve(self, values, session: AsyncSession):
+        """
+        Makes sure every value (but None, stored as NULL) has an id, creating
+        the missing terms. They are committed on their own connection, so a
+        rollback of the session can't leave ids in the cache that don't exist
+        """
+        missing = [
+            value
+            for value in set(values)
+            if value is not None and value not in self.ids
+        ]
+        if not missing:
+            return
+        async with session.bind.begin() as conn:
+            await conn.execute(
+                text(
+                    "INSERT INTO entry_term (value) "
+                    "SELECT unnest(CAST(:values AS text[])) "
+                    "ON CONFLICT (value) DO NOTHING"
+                ),
+                {"values": missing},
+            )
+            result = await conn.execute(
+                text(
+                    "SELECT id, value FROM entry_term "
+                    "WHERE value = ANY(CAST(:values AS text[]))"
+                ),
+                {"values": missing},
+            )
+            self._add(result)
+
+    def encode(self, value: Optional[str]) -> Optional[int]:
+        if value is None:
+            return None
+        return self.ids[value]
+
+    def decode(self, term_id: int) -> str:
+        return self.values[term_id]
+
+
+terms = TermCache()
+
+INSERT_ENTRIES = text(
+    f"""
+    INSERT INTO entry_compact (
+        status_code, datetime, response_time, user_id, ip, training_id,
+        message_id, {_encoded_ids}
+    )
+    SELECT * FROM unnest(
+        CAST(:status_code AS integer[]), CAST(:datetime AS text[]),
+        CAST(:response_time AS double precision[]), CAST(:user_id AS text[]),
+        CAST(:ip AS text[]), CAST(:training_id AS text[]),
+        CAST(:message_id AS text[]),
+        {", ".join(f"CAST(:{column}_id AS integer[])" for column in TERM_COLUMNS)}
+    )
+    ON CONFLICT DO NOTHING
+    RETURNING id
+    """
+)
+
+
+async def insert_entries(entries: list, session: AsyncSession, message_ids=None):
+    """
+    Inserts the entries into entry_compact with a single statement, passing
+    each column as an array. Entries whose message id was already stored are
+    skipped; returns the number of inserted entries
+    """
+    encoded = {
+        column: [getattr(entry, column) for entry in entries]
+        for column in ENCODED_COLUMNS
+    }
+    encoded["path_template"] = [route_template(path) for path in encoded["path"]]
+    await terms.resolve(
+        (value for values in encoded.values() for value in values), session
+    )
+    params = {
+        column: [getattr(entry, column) for entry in entries]
+        for column in (
+            "status_code",
+            "datetime",
+            "response_time",
+            "user_id",
+            "ip",
+            "training_id",
+        )
+    }
+    for column, values in encoded.items():
+        params[f"{column}_id"] = [terms.encode(value) for value in values]
+    params["message_id"] = message_ids or [None] * len(entries)
+    result = await session.execute(INSERT_ENTRIES, params)
+    return len(result.all())
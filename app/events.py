@@ -0,0 +1,68 @@
+import asyncio
+import os
+
+# In-process event bus: the ingest path publishes what it committed and the
+# subscribers (e.g. the live aggregators of app/live.py) consume it from
+# their own queue. Publishing never blocks: a subscriber that falls behind
+# loses events and is told so through its `dropped` counter.
+
+EVENT_QUEUE_SIZE = int(os.environ.get("EVENT_QUEUE_SIZE", 10000))
+
+# Entries were inserted (payload: list of entries)
+ENTRIES_INSERTED = "entries_inserted"
+# Entries were updated or deleted (payload: the services whose entries
+# changed, or None when it could be any)
+ENTRIES_CHANGED = "entries_changed"
+# The history materialized views were refreshed (payload: None)
+HISTORY_REFRESHED = "history_refreshed"
+
+
+class Subscription:
+    __slots__ = ("queue", "dropped")
+
+    def __init__(self, max_size: int):
+        self.queue = asyncio.Queue(maxsize=max_size)
+        self.dropped = 0
+
+    async def get(self):
+        return await self.queue.get()
+
+    def get_nowait(self):
+        return self.queue.get_nowait()
+
+    def empty(self) -> bool:
+        return self.queue.empty()
+
+
+class EventBus:
+    def __init__(self, queue_size: int):
+        self.queue_size = queue_size
+        self.subscriptions = []
+        self.published = 0
+
+    def subscribe(self) -> Subscription:
+        subscription = Subscription(self.queue_size)
+        self.subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        if subscription in self.subscriptions:
+            self.subscriptions.remove(subscription)
+
+    def publish(self, kind: str, payload=None):
+        self.published += 1
+        for subscription in self.subscriptions:
+            try:
+                subscription.queue.put_nowait((kind, payload))
+            except asyncio.QueueFull:
+                subscription.dropped += 1
+
+    def to_dict(self) -> dict:
+        return {
+            "published": self.published,
+            "subscribers": len(self.subscriptions),
+            "dropped": sum(s.dropped for s in self.subscriptions),
+        }
+
+
+event_bus = EventBus(EVENT_QUEUE_SIZE)
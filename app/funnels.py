@@ -0,0 +1,328 @@
+import asyncio
+import datetime as dt
+import logging
+import os
+from collections import defaultdict
+from enum import Enum
+from typing import Optional
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.bitmaps import RoaringBitmap
+from app.db import engine
+from app.definitions import (
+    ADD_TRAINING_TO_FAVS,
+    MEDIA_UPLOAD,
+    NEW_TRAINING,
+    SIGNUP,
+)
+from app.events import ENTRIES_INSERTED, event_bus
+
+# Users as compressed bitmaps of their ordinals (see app/bitmaps.py), for
+# funnel and retention cohort queries answered with bitmap intersections
+# instead of self-joins over the entries:
+#   action:<action>:<YYYY-MM-DD>  users who did the action that day
+#   signup_month:<YYYY-MM>        users who signed up that month
+#   country:<country>             users by the country they signed up from
+#
+# User ids are mapped to dense ordinals by the user_ordinal table. The
+# bitmaps are kept in user_bitmap and updated from the entries published on
+# the event bus, merged every FUNNEL_FLUSH_SECONDS. Entries stored before
+# are indexed by `python -m app.migrations.backfill_user_bitmaps`.
+
+FUNNEL_FLUSH_SECONDS = float(os.environ.get("FUNNEL_FLUSH_SECONDS", 5))
+FUNNEL_ORDINAL_CACHE_SIZE = int(os.environ.get("FUNNEL_ORDINAL_CACHE_SIZE", 200000))
+FUNNEL_MAX_DAYS = int(os.environ.get("FUNNEL_MAX_DAYS", 366))
+
+DEFAULT_FUNNEL = (SIGNUP, NEW_TRAINING, MEDIA_UPLOAD, ADD_TRAINING_TO_FAVS)
+
+
+class FunnelBreakdown(str, Enum):
+    signup_month = "signup_month"
+    country = "country"
+
+
+logger = logging.getLogger('app')
+
+
+def bitmap_names(action: str, datetime: str, country: str) -> list:
+    """
+    Returns the names of the bitmaps an entry adds its user to
+    """
+    names = [f"action:{action}:{datetime[:10]}"]
+    if action == SIGNUP:
+        names.append(f"signup_month:{datetime[:7]}")
+        names.append(f"country:{country or ''}")
+    return names
+
+
+def day_range(since: dt.date, until: dt.date) -> list:
+    return [
+        (since + dt.timedelta(days=i)).isoformat()
+        for i in range((until - since).days + 1)
+    ]
+
+
+def _action_users(bitmaps: dict, action: str, days) -> RoaringBitmap:
+    return RoaringBitmap.union(
+        bitmaps[name]
+        for name in (f"action:{action}:{day}" for day in days)
+        if name in bitmaps
+    )
+
+
+def _month_days(month: str) -> list:
+    first = dt.date.fromisoformat(f"{month}-01")
+    following = (first + dt.timedelta(days=31)).replace(day=1)
+    return day_range(first, following - dt.timedelta(days=1))
+
+
+def _add_months(month: str, months: int) -> str:
+    year, number = divmod(int(month[:4]) * 12 + int(month[5:7]) - 1 + months, 12)
+    return f"{year:04d}-{number + 1:02d}"
+
+
+class UserBitmaps:
+    def __init__(self, flush_interval: float, ordinal_cache_size: int):
+        self.flush_interval = flush_interval
+        self.ordinal_cache_size = ordinal_cache_size
+        # (user id, action, datetime, country) of the entries not flushed
+        self.pending = []
+        self.ordinals = {}
+        self.flushes = 0
+        self.dropped = 0
+
+    def add(self, entries):
+        for entry in entries:
+            if entry.user_id:
+                self.pending.append(
+                    (entry.user_id, entry.action, entry.datetime, entry.country)
+                )
+
+    async def resolve_ordinals(self, user_ids) -> dict:
+        """
+        Returns the ordinal of each user id, creating the missing ones. They
+        are committed on their own, so the cache never holds rolled back ones
+        """
+        if len(self.ordinals) > self.ordinal_cache_size:
+            self.ordinals = {}
+        missing = [user_id for user_id in set(user_ids) if user_id not in self.ordinals]
+        if missing:
+            async with engine.begin() as conn:
+                await conn.execute(
+                    text(
+                        "INSERT INTO user_ordinal (user_id) "
+                        "SELECT unnest(CAST(:user_ids AS text[])) "
+                        "ON CONFLICT (user_id) DO NOTHING"
+                    ),
+                    {"user_ids": missing},
+                )
+                result = await conn.execute(
+                    text(
+                        "SELECT user_id, ordinal FROM user_ordinal "
+                        "WHERE user_id = ANY(CAST(:user_ids AS text[]))"
+                    ),
+                    {"user_ids": missing},
+                )
+                self.ordinals.update(result.all())
+        return {user_id: self.ordinals[user_id] for user_id in user_ids}
+
+    async def flush(self):
+        """
+        Merges the pending entries into the stored bitmaps
+        """
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, []
+        try:
+            ordinals = await self.resolve_ordinals([row[0] for row in pending])
+            updates = defaultdict(RoaringBitmap)
+            for user_id, action, datetime, country in pending:
+                for name in bitmap_names(action, datetime, country):
+                    updates[name].add(ordinals[user_id])
+            async with engine.begin() as conn:
+                await merge_bitmaps(conn, updates)
+        except Exception:
+            self.pending = pending + self.pending
+            raise
+        self.flushes += 1
+
+    async def run(self):
+        subscription = event_bus.subscribe()
+        try:
+            while True:
+                kind, payload = await subscription.get()
+                if kind == ENTRIES_INSERTED:
+                    self.add(payload)
+                await asyncio.sleep(self.flush_interval)
+                while not subscription.empty():
+                    kind, payload = subscription.get_nowait()
+                    if kind == ENTRIES_INSERTED:
+                        self.add(payload)
+                if subscription.dropped != self.dropped:
+                    logger.warning(
+                        "The user bitmaps missed %d events",
+                        subscription.dropped - self.dropped,
+                    )
+                    self.dropped = subscription.dropped
+                try:
+                    await self.flush()
+                except Exception as e:
+                    logger.error("Could not flush the user bitmaps: %s", e)
+        finally:
+            event_bus.unsubscribe(subscription)
+
+    def to_dict(self) -> dict:
+        return {
+            "pending": len(self.pending),
+            "cached_ordinals": len(self.ordinals),
+            "flushes": self.flushes,
+            "dropped_events": self.dropped,
+        }
+
+
+async def merge_bitmaps(conn, updates: dict):
+    """
+    ORs the bitmaps into the stored ones. The rows are created first and
+    then locked in name order, so concurrent merges serialize instead of
+    overwriting each other
+    """
+    names = sorted(updates)
+    await conn.execute(
+        text(
+            "INSERT INTO user_bitmap (name, bitmap) "
+            "SELECT unnest(CAST(:names AS text[])), :empty "
+            "ON CONFLICT (name) DO NOTHING"
+        ),
+        {"names": names, "empty": RoaringBitmap().serialize()},
+    )
+    result = await conn.execute(
+        text(
+            "SELECT name, bitmap FROM user_bitmap "
+            "WHERE name = ANY(CAST(:names AS text[])) ORDER BY name FOR UPDATE"
+        ),
+        {"names": names},
+    )
+    rows = result.all()
+    names = [name for name, _ in rows]
+    merged = [
+        (updates[name] | RoaringBitmap.deserialize(bitmap)).serialize()
+        for name, bitmap in rows
+    ]
+    await conn.execute(
+        text(
+            "UPDATE user_bitmap SET bitmap = merged.bitmap "
+            "FROM (SELECT unnest(CAST(:names AS text[])) AS name, "
+            "unnest(CAST(:bitmaps AS bytea[])) AS bitmap) AS merged "
+            "WHERE user_bitmap.name = merged.name"
+        ),
+        {"names": names, "bitmaps": merged},
+    )
+
+
+async def load_bitmaps(session: AsyncSession, names=None, prefix: str = None) -> dict:
+    """
+    Returns the stored bitmaps with the given names or name prefix
+    """
+    if prefix is not None:
+        result = await session.execute(
+            text(
+                "SELECT name, bitmap FROM user_bitmap "
+                "WHERE left(name, length(:prefix)) = :prefix"
+            ),
+            {"prefix": prefix},
+        )
+    else:
+        result = await session.execute(
+            text(
+                "SELECT name, bitmap FROM user_bitmap "
+                "WHERE name = ANY(CAST(:names AS text[]))"
+            ),
+            {"names": list(names)},
+        )
+    return {name: RoaringBitmap.deserialize(bitmap) for name, bitmap in result}
+
+
+async def funnel(
+    session: AsyncSession,
+    steps: tuple,
+    since: dt.date,
+    until: dt.date,
+    by: Optional[str] = None,
+) -> dict:
+    """
+    Returns how many users did each step (and every previous one) between
+    since and until, overall and per signup month or country. Steps are not
+    ordered in time within the range
+    """
+    days = day_range(since, until)
+    names = [f"action:{step}:{day}" for step in steps for day in days]
+    bitmaps = await load_bitmaps(session, names)
+    users = [_action_users(bitmaps, step, days) for step in steps]
+
+    def counts(cohort: Optional[RoaringBitmap]) -> list:
+        result = []
+        current = cohort
+        for step_users in users:
+            current = step_users if current is None else current & step_users
+            result.append(len(current))
+        return result
+
+    response = {
+        "steps": list(steps),
+        "since": since.isoformat(),
+        "until": until.isoformat(),
+        "users": counts(None),
+    }
+    if by:
+        groups = await load_bitmaps(session, prefix=f"{by}:")
+        response["by"] = {
+            name[len(by) + 1 :]: counts(cohort)
+            for name, cohort in sorted(groups.items())
+        }
+    return response
+
+
+async def retention(
+    session: AsyncSession, action: str, since_month: str, months: int
+) -> dict:
+    """
+    Returns, for each signup month cohort from since_month on, how many of
+    its users did the action in each of the following months (the first
+    one being the signup month)
+    """
+    cohorts = {
+        name[len("signup_month:") :]: bitmap
+        for name, bitmap in (
+            await load_bitmaps(session, prefix="signup_month:")
+        ).items()
+        if name[len("signup_month:") :] >= since_month
+    }
+    active_months = sorted(
+        {_add_months(c, offset) for c in cohorts for offset in range(months)}
+    )
+    names = [
+        f"action:{action}:{day}"
+        for month in active_months
+        for day in _month_days(month)
+    ]
+    bitmaps = await load_bitmaps(session, names)
+    active = {
+        month: _action_users(bitmaps, action, _month_days(month))
+        for month in active_months
+    }
+    return {
+        "action": action,
+        "cohorts": {
+            cohort: {
+                "users": len(users),
+                "active": [
+                    len(users & active[_add_months(cohort, offset)])
+                    for offset in range(months)
+                ],
+            }
+            for cohort, users in sorted(cohorts.items())
+        },
+    }
+
+
+user_bitmaps = UserBitmaps(FUNNEL_FLUSH_SECONDS, FUNNEL_ORDINAL_CACHE_SIZE)
@@ -0,0 +1,173 @@
+import argparse
+import csv
+import logging
+import mmap
+import os
+import socket
+import struct
+import sys
+from array import array
+from bisect import bisect_right
+from functools import lru_cache
+from typing import Optional
+
+# Country of an IPv4 address, from a local database of sorted IP ranges
+# which is memory-mapped (shared between processes and loaded lazily by the
+# OS) and binary searched. No network calls.
+#
+# File layout (little-endian):
+#   header:    magic (8 bytes), number of ranges N (uint32)
+#   starts:    N x uint32, first address of each range, sorted
+#   ends:      N x uint32, last address of each range
+#   countries: N x uint16, index of the country name of each range
+#   names:     country names, "\n"-separated UTF-8
+#
+# Build it from a CSV of ranges (e.g. the free IP2Location LITE DB1 or
+# DB-IP Lite country databases), whose addresses can be dotted or integers:
+#   python -m app.geoip ranges.csv geoip.bin [--country-column -1]
+
+GEOIP_DATABASE_PATH = os.environ.get("GEOIP_DATABASE_PATH")
+GEOIP_CACHE_SIZE = int(os.environ.get("GEOIP_CACHE_SIZE", 65536))
+
+MAGIC = b"GEOIPv4\x00"
+HEADER = struct.Struct("<8sI")
+
+logger = logging.getLogger('app')
+
+
+def _address(value: str) -> Optional[int]:
+    try:
+        return int.from_bytes(socket.inet_aton(value), "big")
+    except (OSError, TypeError):
+        return None
+
+
+class GeoIPDatabase:
+    def __init__(self, path: str, cache_size: int = GEOIP_CACHE_SIZE):
+        if sys.byteorder != "little":
+            raise RuntimeError("The GeoIP database requires a little-endian host")
+        with open(path, "rb") as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a GeoIP database")
+
+        data = memoryview(self._mmap)
+        offset = HEADER.size
+        self._starts = data[offset : offset + 4 * count].cast("I")
+        offset += 4 * count
+        self._ends = data[offset : offset + 4 * count].cast("I")
+        offset += 4 * count
+        self._countries = data[offset : offset + 2 * count].cast("H")
+        offset += 2 * count
+        self.names = bytes(data[offset:]).decode("utf-8").split("\n")
+        self.size = count
+        self.lookup = lru_cache(maxsize=cache_size)(self._lookup)
+
+    def _lookup(self, ip: str) -> Optional[str]:
+        """
+        Returns the country of the IPv4 address, or None if it is unknown
+        (or not an IPv4 address)
+        """
+        address = _address(ip)
+        if address is None:
+            return None
+        index = bisect_right(self._starts, address) - 1
+        if index < 0 or address > self._ends[index]:
+            return None
+        return self.names[self._countries[index]]
+
+    def to_dict(self) -> dict:
+        cache = self.lookup.cache_info()
+        return {
+            "ranges": self.size,
+            "cache_hits": cache.hits,
+            "cache_misses": cache.misses,
+            "cache_size": cache.currsize,
+        }
+
+
+def build(ranges: list, path: str):
+    """
+    Writes a database file from (start, end, country) tuples of non
+    overlapping ranges
+    """
+    ranges = sorted(ranges)
+    names = sorted({country for _, _, country in ranges})
+    index = {name: i for i, name in enumerate(names)}
+    with open(path, "wb") as file:
+        file.write(HEADER.pack(MAGIC, len(ranges)))
+        for column, typecode in ((0, "I"), (1, "I"), (2, "H")):
+            values = array(
+                typecode,
+                (index[r[2]] if column == 2 else r[column] for r in ranges),
+            )
+            if sys.byteorder != "little":
+                values.byteswap()
+            values.tofile(file)
+        file.write("\n".join(names).encode("utf-8"))
+
+
+def _parse_address(value: str) -> Optional[int]:
+    return int(value) if value.isdigit() else _address(value)
+
+
+def read_ranges_csv(path: str, country_column: int = -1) -> list:
+    """
+    Reads the IPv4 ranges of a CSV of start,end,...,country rows. IPv6 rows
+    and rows without a country are skipped
+    """
+    ranges = []
+    with open(path, newline="", encoding="utf-8") as file:
+        for row in csv.reader(file):
+            if len(row) < 3:
+                continue
+            start, end = _parse_address(row[0]), _parse_address(row[1])
+            country = row[country_column].strip()
+            if start is None or end is None or end > 0xFFFFFFFF or country in ("", "-"):
+                continue
+            ranges.append((start, end, country))
+    return ranges
+
+
+def _open_database() -> Optional[GeoIPDatabase]:
+    if not GEOIP_DATABASE_PATH:
+        return None
+    try:
+        return GeoIPDatabase(GEOIP_DATABASE_PATH)
+    except (OSError, ValueError, RuntimeError) as e:
+        logger.error("Could not open the GeoIP database: %s", e)
+        return None
+
+
+geoip = _open_database()
+
+
+def resolve_country(entry):
+    """
+    Fills the country of the entry from its ip when the producer left it
+    empty. Returns the entry
+    """
+    if geoip is not None and not entry.country:
+        country = geoip.lookup(entry.ip)
+        if country:
+            entry.country = country
+    return entry
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Build the GeoIP database from a CSV of IPv4 ranges"
+    )
+    parser.add_argument("csv", help="start,end,...,country rows")
+    parser.add_argument("output")
+    parser.add_argument(
+        "--country-column",
+        type=int,
+        default=-1,
+        help="Index of the column with the country name (default: the last)",
+    )
+    args = parser.parse_args()
+    ranges = read_ranges_csv(args.csv, args.country_column)
+    build(ranges, args.output)
+    print(f"Wrote {len(ranges)} ranges to {args.output}")
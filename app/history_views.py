@@ -0,0 +1,342 @@
+import asyncio
+import datetime as dt
+import email.utils
+import hashlib
+import logging
+import os
+import time
+from typing import Optional
+from fastapi import HTTPException, Request, Response, status
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.aggregates import HISTORY_AGGREGATES, HistoryAggregate
+from app.analytics import BACKENDS, HistoryBackend, analytics_mirror
+from app.data_versions import data_versions
+from app.db import engine, lock_schema
+from app.events import HISTORY_REFRESHED, event_bus
+from app.hot_window import HOT_WINDOW_HOURS, format_timestamp, hot_window, rate_series
+from app.serialization import FastJSONResponse, ResponseFormat, rows_response
+
+# Each /history aggregate is precomputed in a materialized view, refreshed
+# CONCURRENTLY in the background so readers are never blocked.
+# https://www.postgresql.org/docs/current/sql-refreshmaterializedview.html
+#
+# The responses carry an ETag built from the data version of the aggregate
+# family (see app/data_versions.py), so that unchanged polls get a 304
+# answered from memory.
+#
+# Aggregates configured with the duckdb backend are computed on the local
+# analytics mirror instead, once it is in sync (see app/analytics.py).
+#
+# The counts of the last hours (and the per-minute rates) come from the hot
+# window when it covers them (see app/hot_window.py), from the entries
+# otherwise. The X-Data-Source header tells which.
+
+HISTORY_VIEWS_REFRESH_SECONDS = float(
+    os.environ.get("HISTORY_VIEWS_REFRESH_SECONDS", 60)
+)
+# Refresh earlier once this many entries were ingested (0 disables it)
+HISTORY_VIEWS_REFRESH_ENTRIES = int(
+    os.environ.get("HISTORY_VIEWS_REFRESH_ENTRIES", 1000)
+)
+
+FRESHNESS_HEADER = "X-Data-Refreshed-At"
+SOURCE_HEADER = "X-Data-Source"
+# Only one process refreshes the views at a time
+REFRESH_LOCK_ID = 802_029
+
+logger = logging.getLogger('app')
+
+
+def view_name(aggregate: HistoryAggregate) -> str:
+    return f"history_{aggregate.name}"
+
+
+def view_sql(aggregate: HistoryAggregate) -> str:
+    return (
+        f"SELECT key, count, now() AS refreshed_at "
+        f"FROM ({aggregate.all_time_sql(encoded=True)}) AS counts"
+    )
+
+
+def _definition_hash(aggregate: HistoryAggregate) -> str:
+    return hashlib.sha1(view_sql(aggregate).encode('utf-8')).hexdigest()
+
+
+async def create_history_views(conn):
+    """
+    Creates the materialized views (and their unique index, required by
+    REFRESH CONCURRENTLY). Views whose definition changed are recreated
+    """
+    for aggregate in HISTORY_AGGREGATES:
+        name = view_name(aggregate)
+        definition_hash = _definition_hash(aggregate)
+        current_hash = await conn.scalar(
+            text("SELECT obj_description(to_regclass(:name), 'pg_class')"),
+            {"name": name},
+        )
+        if current_hash == definition_hash:
+            continue
+
+        logger.info("Creating materialized view %s", name)
+        await conn.execute(text(f"DROP MATERIALIZED VIEW IF EXISTS {name}"))
+        await conn.execute(
+            text(f"CREATE MATERIALIZED VIEW {name} AS {view_sql(aggregate)}")
+        )
+        await conn.execute(text(f"CREATE UNIQUE INDEX {name}_key ON {name} (key)"))
+        await conn.execute(
+            text(f"COMMENT ON MATERIALIZED VIEW {name} IS '{definition_hash}'")
+        )
+
+
+async def init_history_views():
+    async with engine.begin() as conn:
+        await lock_schema(conn)
+        await create_history_views(conn)
+
+
+async def refresh_history_views():
+    """
+    Refreshes every view, unless another process is already doing it
+    """
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        locked = await conn.scalar(
+            text("SELECT pg_try_advisory_lock(:id)"), {"id": REFRESH_LOCK_ID}
+        )
+        if not locked:
+            return False
+        try:
+            changes = await data_versions.snapshot(conn)
+            for aggregate in HISTORY_AGGREGATES:
+                await conn.execute(
+                    text(
+                        f"REFRESH MATERIALIZED VIEW CONCURRENTLY {view_name(aggregate)}"
+                    )
+                )
+            await data_versions.publish(conn, changes)
+        finally:
+            await conn.execute(
+                text("SELECT pg_advisory_unlock(:id)"), {"id": REFRESH_LOCK_ID}
+            )
+    return True
+
+
+def _etag(aggregate: HistoryAggregate, version, format: ResponseFormat) -> str:
+    # The view definition is part of the tag: changing it changes the data
+    return (
+        f'"{aggregate.name}-{_definition_hash(aggregate)[:8]}-{version}-{format.value}"'
+    )
+
+
+def validators(aggregate: HistoryAggregate, format: ResponseFormat) -> Optional[dict]:
+    """
+    Returns the ETag and Last-Modified headers of the aggregate's current
+    data, or None while its version is unknown
+    """
+    current = data_versions.get(aggregate.service)
+    if current is None:
+        return None
+    version, refreshed_at = current
+    headers = {"ETag": _etag(aggregate, version, format), "Cache-Control": "no-cache"}
+    if refreshed_at is not None:
+        headers["Last-Modified"] = email.utils.format_datetime(
+            refreshed_at.astimezone(dt.timezone.utc), usegmt=True
+        )
+    return headers
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in (tag.removeprefix("W/") for tag in tags)
+
+
+async def read_history_view(
+    aggregate: HistoryAggregate,
+    request: Request,
+    session: AsyncSession,
+    format: ResponseFormat = ResponseFormat.rows,
+    hours: Optional[int] = None,
+) -> Response:
+    """
+    Returns the {key: count} dict of the aggregate (or its key and count
+    columns), with the freshness header set to the time of the last refresh
+    of its view. Answers 304, without querying, when the client already has
+    the current version. With hours, only counts the last hours (see
+    read_recent)
+    """
+    if hours is not None:
+        return await read_recent(aggregate, session, _since(hours), format)
+    if BACKENDS[aggregate.name] == HistoryBackend.duckdb and analytics_mirror.ready:
+        return await read_analytics_mirror(aggregate, request, format)
+
+    headers = validators(aggregate, format)
+    if headers and etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+        data_versions.not_modified += 1
+        return Response(status_code=304, headers=headers)
+
+    result = await session.execute(
+        text(f"SELECT key, count, refreshed_at FROM {view_name(aggregate)}")
+    )
+    rows = result.all()
+    headers = headers or {}
+    if rows:
+        headers[FRESHNESS_HEADER] = rows[0][2].isoformat()
+    return _counts_response([row[:2] for row in rows], format, headers)
+
+
+async def read_analytics_mirror(
+    aggregate: HistoryAggregate,
+    request: Request,
+    format: ResponseFormat = ResponseFormat.rows,
+) -> Response:
+    """
+    Same as read_history_view, computing the aggregate on the analytics
+    mirror. Its ETag follows the mirror's version and the freshness header
+    its last sync
+    """
+    synced_at = dt.datetime.fromtimestamp(analytics_mirror.synced_at, dt.timezone.utc)
+    headers = {
+        "ETag": _etag(aggregate, analytics_mirror.etag_version, format),
+        "Cache-Control": "no-cache",
+        FRESHNESS_HEADER: synced_at.isoformat(),
+    }
+    if etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+        data_versions.not_modified += 1
+        return Response(status_code=304, headers=headers)
+    rows = await analytics_mirror.query(aggregate.all_time_sql())
+    return _counts_response(rows, format, headers)
+
+
+def _since(hours: int) -> int:
+    if not 1 <= hours <= HOT_WINDOW_HOURS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"hours must be between 1 and {HOT_WINDOW_HOURS}",
+        )
+    return int(time.time()) - hours * 3600
+
+
+def _from_hot_window(since: int) -> bool:
+    return hot_window.ready and hot_window.window.covers(since)
+
+
+async def read_recent(
+    aggregate: HistoryAggregate,
+    session: AsyncSession,
+    since: int,
+    format: ResponseFormat = ResponseFormat.rows,
+) -> Response:
+    """
+    Returns the counts of the aggregate over the entries since the
+    timestamp, from the hot window if it covers them (and can compute the
+    aggregate), from the entries otherwise. They are live: no ETag
+    """
+    if _from_hot_window(since) and hot_window.window.supports(aggregate):
+        counts = hot_window.window.counts(aggregate, since)
+        rows = list(counts.items())
+        headers = {SOURCE_HEADER: "hot_window"}
+    else:
+        query = aggregate.sql(since=format_timestamp(since), encoded=True)
+        rows = (await session.execute(text(query))).all()
+        headers = {SOURCE_HEADER: "database"}
+    return _counts_response(rows, format, headers)
+
+
+async def read_rates(
+    session: AsyncSession, hours: int, service: Optional[str] = None
+) -> tuple:
+    """
+    Returns the per-minute requests and errors of the last hours (see
+    app.hot_window.rate_series) and the response headers
+    """
+    since = _since(hours)
+    until = int(time.time())
+    if _from_hot_window(since):
+        rates = hot_window.window.series(since, until, service)
+        return rates, {SOURCE_HEADER: "hot_window"}
+
+    start = since - since % 60
+    query = (
+        "SELECT replace(substr(datetime, 1, 16), 'T', ' ') AS minute, count(*), "
+        "count(*) FILTER (WHERE status_code >= 500) FROM entry "
+        "WHERE datetime >= :since AND datetime <= :until"
+    )
+    params = {"since": format_timestamp(since), "until": format_timestamp(until)}
+    if service is not None:
+        query += " AND service = :service"
+        params["service"] = service
+    result = await session.execute(text(f"{query} GROUP BY minute"), params)
+    counts = {minute: (requests, errors) for minute, requests, errors in result}
+    minutes = [format_timestamp(minute)[:16] for minute in range(start, until + 1, 60)]
+    rates = rate_series(
+        start,
+        [counts.get(minute, (0, 0))[0] for minute in minutes],
+        [counts.get(minute, (0, 0))[1] for minute in minutes],
+    )
+    return rates, {SOURCE_HEADER: "database"}
+
+
+def _counts_response(rows: list, format: ResponseFormat, headers: dict) -> Response:
+    if format == ResponseFormat.columnar:
+        return rows_response(("key", "count"), rows, format, headers)
+    return FastJSONResponse({key: count for key, count in rows}, headers=headers)
+
+
+class HistoryViewRefresher:
+    """
+    Background task refreshing the views every HISTORY_VIEWS_REFRESH_SECONDS,
+    or earlier after HISTORY_VIEWS_REFRESH_ENTRIES changes were ingested (or
+    at once, see refresh_now)
+    """
+
+    def __init__(self, interval: float, max_pending: int):
+        self.interval = interval
+        self.max_pending = max_pending
+        self.pending = 0
+        self._wakeup = None
+        self._tasks = set()
+
+    def notify_changed(self, count: int = 1):
+        self.pending += count
+        if self.max_pending and self.pending >= self.max_pending and self._wakeup:
+            self._wakeup.set()
+
+    def refresh_now(self):
+        """
+        Refreshes the views without waiting, e.g. after deleting entries the
+        views must stop counting. In a process which doesn't run the
+        refresher, the views are refreshed by a one-off task
+        """
+        if self._wakeup:
+            self._wakeup.set()
+            return
+        task = asyncio.create_task(self._refresh())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _refresh(self):
+        pending, self.pending = self.pending, 0
+        try:
+            if await refresh_history_views():
+                logger.info("History views refreshed (%d pending changes)", pending)
+                event_bus.publish(HISTORY_REFRESHED)
+        except Exception as e:
+            logger.error("Could not refresh history views: %s", e)
+
+    async def run(self):
+        self._wakeup = asyncio.Event()
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self._refresh()
+
+
+history_view_refresher = HistoryViewRefresher(
+    HISTORY_VIEWS_REFRESH_SECONDS, HISTORY_VIEWS_REFRESH_ENTRIES
+)
@@ -0,0 +1,452 @@
+import asyncio
+import datetime as dt
+import logging
+import os
+import time
+from typing import Optional
+from sqlalchemy import text
+from app.aggregates import HistoryAggregate
+from app.db import async_read_session
+from app.events import ENTRIES_CHANGED, ENTRIES_INSERTED, event_bus
+from app.route_templates import route_template
+
+try:
+    import numpy as np
+except ImportError:  # optional: poetry install -E window
+    np = None
+
+# In-memory window of the recent entries (the last HOT_WINDOW_HOURS, at
+# most HOT_WINDOW_CAPACITY of them), so that the questions about the last
+# hours or days (/history/*?hours=N, the per-minute request and error
+# rates) are answered without querying the database.
+#
+# It is a ring buffer of NumPy columns: the timestamp, response time and
+# status code, and the dictionary codes of the other columns the aggregates
+# filter or group by. Aggregations are vectorized over the columns (masks,
+# bincount, unique). Rows are only read back one by one through WindowRecord,
+# a __slots__ view of a slot that decodes its values when accessed.
+#
+# It is loaded from the database on startup and appended the entries
+# published on the event bus. Updates and deletes can't be applied to it:
+# after one, it is reloaded, at most every HOT_WINDOW_RELOAD_SECONDS.
+# Processes that don't ingest reload it that often too, to see the entries
+# ingested by the others.
+
+HOT_WINDOW_HOURS = int(os.environ.get("HOT_WINDOW_HOURS", 168))
+# Entries kept at most (0 disables the window)
+HOT_WINDOW_CAPACITY = int(os.environ.get("HOT_WINDOW_CAPACITY", 1000000))
+HOT_WINDOW_RELOAD_SECONDS = float(os.environ.get("HOT_WINDOW_RELOAD_SECONDS", 300))
+HOT_WINDOW_LOAD_BATCH = 50000
+
+# Dictionary-encoded columns (path_template is derived from path)
+ENCODED_COLUMNS = ("service", "action", "country", "path", "training_type", "user_id")
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+LOAD_WINDOW = text(
+    f"SELECT datetime, response_time, status_code, {', '.join(ENCODED_COLUMNS)} "
+    "FROM entry WHERE datetime >= :since"
+)
+
+logger = logging.getLogger('app')
+
+
+def window_enabled() -> bool:
+    return HOT_WINDOW_CAPACITY > 0 and np is not None
+
+
+def _timestamp(datetime: str) -> Optional[int]:
+    try:
+        parsed = dt.datetime.fromisoformat(datetime)
+    except (TypeError, ValueError):
+        return None
+    # Naive datetimes (the entries' format) are in UTC
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=dt.timezone.utc)
+    return int(parsed.astimezone(dt.timezone.utc).timestamp())
+
+
+def format_timestamp(timestamp: int) -> str:
+    return dt.datetime.fromtimestamp(int(timestamp), dt.timezone.utc).strftime(
+        DATETIME_FORMAT
+    )
+
+
+class Dictionary:
+    """
+    Codes of the values of a column, in order of appearance
+    """
+
+    __slots__ = ("values", "codes")
+
+    def __init__(self):
+        self.values = []
+        self.codes = {}
+
+    def encode(self, value) -> int:
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def codes_of(self, values) -> list:
+        return [self.codes[value] for value in values if value in self.codes]
+
+    def matching(self, predicate) -> list:
+        return [code for code, value in enumerate(self.values) if predicate(value)]
+
+
+class WindowRecord:
+    """
+    View of a slot of the window, with the attributes of an entry
+    """
+
+    __slots__ = ("_window", "_slot")
+
+    def __init__(self, window: "HotWindow", slot: int):
+        self._window = window
+        self._slot = slot
+
+    def __getattr__(self, name: str):
+        return self._window.value(name, self._slot)
+
+    def __repr__(self) -> str:
+        return f"WindowRecord({self.datetime!r}, {self.service!r}, {self.action!r})"
+
+
+class HotWindow:
+    def __init__(self, capacity: int, hours: int):
+        self.capacity = capacity
+        self.hours = hours
+        self.timestamps = np.zeros(capacity, dtype=np.int64)
+        self.response_times = np.zeros(capacity, dtype=np.float32)
+        self.status_codes = np.zeros(capacity, dtype=np.int16)
+        self.columns = {
+            column: np.zeros(capacity, dtype=np.int32) for column in ENCODED_COLUMNS
+        }
+        self.dictionaries = {column: Dictionary() for column in ENCODED_COLUMNS}
+        # Route template code of each path code
+        self.templates = Dictionary()
+        self.path_templates = []
+        self.size = 0
+        self.next = 0
+        # Entries up to this timestamp may be missing: it only covers the
+        # ranges after it
+        self.complete_since = 0
+
+    def _template_codes(self):
+        paths = self.dictionaries["path"].values
+        for path in paths[len(self.path_templates) :]:
+            self.path_templates.append(self.templates.encode(route_template(path)))
+        return np.array(self.path_templates, dtype=np.int32)
+
+    def _slots(self):
+        if self.size == self.capacity:
+            return slice(None)
+        return slice(0, self.size)
+
+    def _take(self) -> int:
+        slot = self.next
+        if self.size == self.capacity:
+            self.complete_since = max(self.complete_since, int(self.timestamps[slot]))
+        else:
+            self.size += 1
+        self.next = (slot + 1) % self.capacity
+        return slot
+
+    def append(self, entries):
+        for entry in entries:
+            timestamp = _timestamp(entry.datetime)
+            if timestamp is None:
+                continue
+            slot = self._take()
+            self.timestamps[slot] = timestamp
+            self.response_times[slot] = entry.response_time or 0
+            self.status_codes[slot] = entry.status_code or 0
+            for column in ENCODED_COLUMNS:
+                self.columns[column][slot] = self.dictionaries[column].encode(
+                    getattr(entry, column)
+                )
+
+    def load(self, rows: list):
+        """
+        Appends (datetime, response_time, status_code, *encoded columns)
+        rows, the columns converted at once
+        """
+        if not rows:
+            return
+        columns = list(zip(*rows))
+        try:
+            timestamps = np.array(columns[0], dtype="datetime64[s]").astype(np.int64)
+        except ValueError:
+            # Not all in the YYYY-MM-DD HH:MM:SS form numpy parses
+            timestamps = np.array(
+                [_timestamp(value) or 0 for value in columns[0]], dtype=np.int64
+            )
+        values = {
+            column: np.array(
+                [self.dictionaries[column].encode(v) for v in columns[3 + index]],
+                dtype=np.int32,
+            )
+            for index, column in enumerate(ENCODED_COLUMNS)
+        }
+        response_times = np.array(
+            [value or 0 for value in columns[1]], dtype=np.float32
+        )
+        status_codes = np.array([value or 0 for value in columns[2]], dtype=np.int16)
+        # Written in contiguous runs, wrapping around the end
+        written = 0
+        while written < len(rows):
+            start = self.next
+            count = min(len(rows) - written, self.capacity - start)
+            end = start + count
+            if self.size == self.capacity:
+                self.complete_since = max(
+                    self.complete_since, int(self.timestamps[start:end].max())
+                )
+            batch = slice(written, written + count)
+            self.timestamps[start:end] = timestamps[batch]
+            self.response_times[start:end] = response_times[batch]
+            self.status_codes[start:end] = status_codes[batch]
+            for column in ENCODED_COLUMNS:
+                self.columns[column][start:end] = values[column][batch]
+            self.size = min(self.capacity, self.size + count)
+            self.next = end % self.capacity
+            written += count
+
+    def covers(self, since: int) -> bool:
+        return since > self.complete_since
+
+    def value(self, column: str, slot: int):
+        if column in self.columns:
+            return self.dictionaries[column].values[self.columns[column][slot]]
+        if column == "path_template":
+            return route_template(self.value("path", slot))
+        if column == "datetime":
+            return format_timestamp(self.timestamps[slot])
+        if column == "response_time":
+            return float(self.response_times[slot])
+        if column == "status_code":
+            return int(self.status_codes[slot])
+        raise AttributeError(column)
+
+    def records(self, since: int = 0) -> list:
+        """
+        Returns views of the entries since the timestamp, in time order
+        """
+        slots = np.flatnonzero(self.timestamps[self._slots()] >= since)
+        order = np.argsort(self.timestamps[slots], kind="stable")
+        return [WindowRecord(self, int(slot)) for slot in slots[order]]
+
+    def supports(self, aggregate: HistoryAggregate) -> bool:
+        return aggregate.key in ENCODED_COLUMNS + ("path_template", "month") and (
+            aggregate.count_distinct in (None, "datetime")
+        )
+
+    def _mask(self, aggregate: HistoryAggregate, since: int):
+        slots = self._slots()
+        mask = self.timestamps[slots] >= since
+        filters = [("service", (aggregate.service,)), ("action", aggregate.actions)]
+        filters.append(("path", aggregate.paths))
+        for column, values in filters:
+            if values:
+                codes = self.dictionaries[column].codes_of(values)
+                mask &= np.isin(self.columns[column][slots], codes)
+        if aggregate.path_templates or aggregate.path_like:
+            templates = self._template_codes()
+            paths = self.dictionaries["path"]
+            accepted = np.ones(len(paths.values), dtype=bool)
+            if aggregate.path_templates:
+                accepted &= np.isin(
+                    templates, self.templates.codes_of(aggregate.path_templates)
+                )
+            if aggregate.path_like:
+                accepted &= np.isin(
+                    np.arange(len(paths.values)),
+                    paths.matching(
+                        lambda path: aggregate._path_pattern.match(path or "")
+                    ),
+                )
+            mask &= accepted[self.columns["path"][slots]]
+        return mask
+
+    def _keys(self, aggregate: HistoryAggregate, mask) -> tuple:
+        """
+        Returns the key code of each masked entry and the values of the codes
+        """
+        slots = self._slots()
+        if aggregate.key == "month":
+            months = (
+                self.timestamps[slots][mask]
+                .astype("datetime64[s]")
+                .astype("datetime64[M]")
+            )
+            codes = (months - np.datetime64("1970-01", "M")).astype(np.int64)
+            first = int(codes.min()) if len(codes) else 0
+            labels = np.arange(first, int(codes.max()) + 1 if len(codes) else first)
+            values = [str(np.datetime64(int(m), "M")) for m in labels]
+            return codes - first, values
+        if aggregate.key == "path_template":
+            templates = self._template_codes()
+            codes = templates[self.columns["path"][slots][mask]]
+            return codes, self.templates.values
+        return (
+            self.columns[aggregate.key][slots][mask],
+            self.dictionaries[aggregate.key].values,
+        )
+
+    def counts(self, aggregate: HistoryAggregate, since: int) -> dict:
+        """
+        Returns the {key: count} of the aggregate over the entries since the
+        timestamp
+        """
+        mask = self._mask(aggregate, since)
+        codes, values = self._keys(aggregate, mask)
+        if aggregate.count_distinct == "datetime":
+            timestamps = self.timestamps[self._slots()][mask]
+            pairs = np.unique(np.stack([codes.astype(np.int64), timestamps]), axis=1)
+            codes = pairs[0]
+        counts = np.bincount(codes, minlength=len(values)) if len(codes) else []
+        return {values[code]: int(count) for code, count in enumerate(counts) if count}
+
+    def series(self, since: int, until: int, service: Optional[str] = None) -> dict:
+        """
+        Returns the number of requests and of server errors (5xx) per minute
+        between the timestamps
+        """
+        slots = self._slots()
+        start = since - since % 60
+        minutes = (until - start) // 60 + 1
+        timestamps = self.timestamps[slots]
+        mask = (timestamps >= since) & (timestamps <= until)
+        if service is not None:
+            codes = self.dictionaries["service"].codes_of((service,))
+            mask &= np.isin(self.columns["service"][slots], codes)
+        buckets = (timestamps[mask] - start) // 60
+        errors = self.status_codes[slots][mask] >= 500
+        return rate_series(
+            start,
+            np.bincount(buckets, minlength=minutes).tolist(),
+            np.bincount(buckets[errors], minlength=minutes).tolist(),
+        )
+
+
+def rate_series(start: int, requests: list, errors: list) -> dict:
+    """
+    Returns the per-minute series of requests and errors counted from the
+    start timestamp (a whole minute)
+    """
+    return {
+        "minutes": [
+            format_timestamp(start + 60 * m)[:16] for m in range(len(requests))
+        ],
+        "requests": requests,
+        "errors": errors,
+        "error_rate": [round(e / r, 4) if r else 0.0 for e, r in zip(errors, requests)],
+    }
+
+
+class HotWindowKeeper:
+    """
+    Loads the window and keeps it current with the event bus
+    """
+
+    def __init__(self, capacity: int, hours: int, reload_interval: float):
+        self.capacity = capacity
+        self.hours = hours
+        self.reload_interval = reload_interval
+        self.window = None
+        self.loaded_at = None
+        self.loads = 0
+        self.load_seconds = None
+        self._stale = False
+        self._pending = None
+
+    @property
+    def ready(self) -> bool:
+        return self.window is not None
+
+    async def load(self):
+        """
+        Builds a new window from the database and swaps it in. The entries
+        published meanwhile are appended to it
+        """
+        started = time.perf_counter()
+        self._pending = []
+        since = format_timestamp(time.time() - self.hours * 3600)
+        window = HotWindow(self.capacity, self.hours)
+        window.complete_since = _timestamp(since) - 1
+        try:
+            async with async_read_session() as session:
+                result = await session.stream(LOAD_WINDOW, {"since": since})
+                async for rows in result.partitions(HOT_WINDOW_LOAD_BATCH):
+                    window.load(rows)
+                    # Let the requests through between batches
+                    await asyncio.sleep(0)
+            window.append(self._pending)
+        finally:
+            self._pending = None
+        self.window = window
+        self.loaded_at = time.time()
+        self.loads += 1
+        self.load_seconds = round(time.perf_counter() - started, 4)
+        self._stale = False
+
+    def apply(self, kind: str, payload):
+        if kind == ENTRIES_INSERTED:
+            if self._pending is not None:
+                self._pending.extend(payload)
+            if self.window is not None:
+                self.window.append(payload)
+        elif kind == ENTRIES_CHANGED:
+            self._stale = True
+
+    async def run(self, ingests: bool = True):
+        """
+        Applies the events of the bus. Reloads the window after updates or
+        deletes (or, if the process doesn't ingest, anyway) at most every
+        reload interval
+        """
+        subscription = event_bus.subscribe()
+        try:
+            while True:
+                try:
+                    kind, payload = await asyncio.wait_for(
+                        subscription.get(), timeout=self.reload_interval
+                    )
+                    self.apply(kind, payload)
+                except asyncio.TimeoutError:
+                    pass
+                if subscription.dropped:
+                    subscription.dropped = 0
+                    self._stale = True
+                due = time.time() - (self.loaded_at or 0) >= self.reload_interval
+                if due and (self._stale or not ingests):
+                    try:
+                        await self.load()
+                    except Exception as e:
+                        logger.error("Could not reload the hot window: %s", e)
+        finally:
+            event_bus.unsubscribe(subscription)
+
+    def to_dict(self) -> dict:
+        return {
+            "enabled": window_enabled(),
+            "ready": self.ready,
+            "hours": self.hours,
+            "capacity": self.capacity,
+            "size": self.window.size if self.window is not None else 0,
+            "complete_since": (
+                format_timestamp(self.window.complete_since)
+                if self.window is not None
+                else None
+            ),
+            "loads": self.loads,
+            "load_seconds": self.load_seconds,
+            "stale": self._stale,
+        }
+
+
+hot_window = HotWindowKeeper(
+    HOT_WINDOW_CAPACITY, HOT_WINDOW_HOURS, HOT_WINDOW_RELOAD_SECONDS
+)
@@ -0,0 +1,64 @@
+import builtins
+import sys
+import time
+
+# Times the modules imported while the app starts, by wrapping
+# builtins.__import__ (only the first import of a module is timed). It is
+# started at the top of app.main, so that everything it imports is
+# accounted for, and stopped once the startup finished (see
+# app/startup.py).
+
+
+class ImportTimer:
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.stopped_at = None
+        # module -> (seconds, self seconds excluding the nested imports)
+        self.times = {}
+        self.total = 0.0
+        self._stack = []
+        self._original = None
+
+    def start(self):
+        if self._original is None:
+            self._original = builtins.__import__
+            builtins.__import__ = self._import
+
+    def stop(self):
+        if self._original is not None:
+            builtins.__import__ = self._original
+            self._original = None
+            self.stopped_at = time.perf_counter()
+
+    def _import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        if level or name in sys.modules:
+            return self._original(name, globals, locals, fromlist, level)
+        started = time.perf_counter()
+        self._stack.append(0.0)
+        try:
+            return self._original(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.perf_counter() - started
+            nested = self._stack.pop()
+            if self._stack:
+                self._stack[-1] += elapsed
+            else:
+                self.total += elapsed
+            self.times[name] = (elapsed, elapsed - nested)
+
+    def top(self, limit: int) -> list:
+        """
+        Returns the `limit` modules with the highest self time
+        """
+        slowest = sorted(self.times.items(), key=lambda item: item[1][1], reverse=True)
+        return [
+            {
+                "module": name,
+                "seconds": round(seconds, 4),
+                "self_seconds": round(self_seconds, 4),
+            }
+            for name, (seconds, self_seconds) in slowest[:limit]
+        ]
+
+
+import_timer = ImportTimer()
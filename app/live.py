@@ -0,0 +1,179 @@
+import asyncio
+import json
+import logging
+import os
+from datetime import datetime
+from sqlalchemy import text
+from app.aggregates import HISTORY_AGGREGATES, HistoryAggregate
+from app.db import async_read_session
+from app.events import ENTRIES_INSERTED, HISTORY_REFRESHED, event_bus
+from app.history_views import view_name
+
+# Live /history counts pushed to the dashboards (see app/api/live.py).
+# The counts are loaded from the materialized views and kept current by
+# applying the entries published on the event bus, so a single stream (and
+# no query per dashboard) serves every connected client. Updates and
+# deletes can't be applied incrementally: they show up after the next
+# refresh of the views, when the counts are reloaded.
+
+LIVE_PUSH_INTERVAL_MS = int(os.environ.get("LIVE_PUSH_INTERVAL_MS", 500))
+# Messages buffered per client before it is reset to a fresh snapshot
+LIVE_CLIENT_QUEUE_SIZE = int(os.environ.get("LIVE_CLIENT_QUEUE_SIZE", 100))
+LIVE_KEEPALIVE_SECONDS = float(os.environ.get("LIVE_KEEPALIVE_SECONDS", 15))
+
+logger = logging.getLogger('app')
+
+
+class LiveAggregate:
+    """
+    Counts of a HistoryAggregate, incremented with each matching entry.
+    For count_distinct aggregates only the values seen since the last load
+    are remembered: new entries are assumed not to repeat a value of the
+    older ones, which holds for the datetimes they count
+    """
+
+    def __init__(self, aggregate: HistoryAggregate):
+        self.aggregate = aggregate
+        self.counts = {}
+        self._seen = {}
+
+    def load(self, counts: dict):
+        self.counts = dict(counts)
+        self._seen = {}
+
+    def apply(self, entry):
+        """
+        Counts the entry; returns the key whose count changed, or None
+        """
+        if not self.aggregate.matches(entry):
+            return None
+        key = self.aggregate.key_of(entry)
+        if self.aggregate.count_distinct:
+            value = getattr(entry, self.aggregate.count_distinct)
+            seen = self._seen.setdefault(key, set())
+            if value in seen:
+                return None
+            seen.add(value)
+        self.counts[key] = self.counts.get(key, 0) + 1
+        return key
+
+
+class LiveDashboard:
+    """
+    Applies the events of the bus to the live aggregates and pushes the
+    changed counts to every client at most once per interval. Clients get a
+    snapshot of every aggregate when they connect and after each reload;
+    messages are JSON encoded once and shared by all the clients
+    """
+
+    def __init__(self, aggregates, interval: float, client_queue_size: int):
+        self.aggregates = {
+            aggregate.name: LiveAggregate(aggregate) for aggregate in aggregates
+        }
+        self.interval = interval
+        self.client_queue_size = client_queue_size
+        self.clients = set()
+        self.synced_at = None
+        self.pushes = 0
+        self.resets = 0
+        self._changed = {}
+        self._needs_sync = True
+
+    def snapshot(self) -> str:
+        return json.dumps(
+            {
+                "type": "snapshot",
+                "synced_at": self.synced_at,
+                "data": {name: live.counts for name, live in self.aggregates.items()},
+            }
+        )
+
+    def connect(self) -> asyncio.Queue:
+        client = asyncio.Queue(maxsize=self.client_queue_size)
+        client.put_nowait(self.snapshot())
+        self.clients.add(client)
+        return client
+
+    def disconnect(self, client: asyncio.Queue):
+        self.clients.discard(client)
+
+    def apply(self, kind: str, payload):
+        if kind == ENTRIES_INSERTED:
+            for entry in payload:
+                for name, live in self.aggregates.items():
+                    key = live.apply(entry)
+                    if key is not None:
+                        self._changed.setdefault(name, set()).add(key)
+        elif kind == HISTORY_REFRESHED:
+            self._needs_sync = True
+
+    async def sync(self):
+        """
+        Reloads the counts from the materialized views
+        """
+        async with async_read_session() as session:
+            for live in self.aggregates.values():
+                result = await session.execute(
+                    text(f"SELECT key, count FROM {view_name(live.aggregate)}")
+                )
+                live.load(dict(result.all()))
+        self.synced_at = datetime.utcnow().isoformat()
+
+    def _broadcast(self, message: str):
+        snapshot = None
+        for client in self.clients:
+            try:
+                client.put_nowait(message)
+            except asyncio.QueueFull:
+                # The client fell behind: a snapshot supersedes what it missed
+                while not client.empty():
+                    client.get_nowait()
+                snapshot = snapshot or self.snapshot()
+                client.put_nowait(snapshot)
+                self.resets += 1
+        self.pushes += 1
+
+    async def flush(self):
+        if self._needs_sync:
+            await self.sync()
+            self._needs_sync = False
+            self._changed = {}
+            self._broadcast(self.snapshot())
+            return
+        if not self._changed:
+            return
+        data = {
+            name: {key: self.aggregates[name].counts[key] for key in keys}
+            for name, keys in self._changed.items()
+        }
+        self._changed = {}
+        self._broadcast(json.dumps({"type": "delta", "data": data}))
+
+    async def run(self):
+        subscription = event_bus.subscribe()
+        while True:
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error("Could not push live updates: %s", e)
+            self.apply(*await subscription.get())
+            # Coalesce everything published during the interval in one push
+            await asyncio.sleep(self.interval)
+            while not subscription.empty():
+                self.apply(*subscription.get_nowait())
+            if subscription.dropped:
+                subscription.dropped = 0
+                self._needs_sync = True
+
+    def to_dict(self) -> dict:
+        return {
+            "clients": len(self.clients),
+            "synced_at": self.synced_at,
+            "pushes": self.pushes,
+            "resets": self.resets,
+        }
+
+
+live_dashboard = LiveDashboard(
+    HISTORY_AGGREGATES, LIVE_PUSH_INTERVAL_MS / 1000, LIVE_CLIENT_QUEUE_SIZE
+)
@@ -1,4 +1,11 @@
 # log_config.py
+import os
+
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "default")  # "default" or "json"
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", 10000))
+
+# Hot path loggers: "logger=sample_rate[/max_per_second]"
+LOG_SAMPLING = os.environ.get("LOG_SAMPLING", "app.ingest=1/50,app.consumer.ack=0.01")
 
 logconfig = {
     "version": 1,
@@ -9,10 +16,14 @@ logconfig = {
             "fmt": "%(levelprefix)s %(asctime)s [%(filename)s:%(lineno)-d] %(message)s",
             "datefmt": "%Y-%m-%d %H:%M:%S",
         },
+        "json": {
+            "()": "app.log_pipeline.JsonFormatter",
+            "datefmt": "%Y-%m-%dT%H:%M:%S%z",
+        },
     },
     "handlers": {
         "default": {
-            "formatter": "default",
+            "formatter": LOG_FORMAT,
             "class": "logging.StreamHandler",
             "stream": "ext://sys.stderr",
         },
@@ -0,0 +1,189 @@
+import json
+import logging
+import queue
+import random
+import threading
+import time
+from collections import Counter
+from logging.handlers import QueueHandler, QueueListener
+
+# Non-blocking logging: records are enqueued by the caller and written to the
+# real handlers (stderr) by a background QueueListener thread.
+# https://docs.python.org/3/howto/logging-cookbook.html#dealing-with-handlers-that-block
+
+
+class LogStats:
+    """
+    Counters of records that were sampled out, rate limited or dropped
+    because the queue was full, per logger name
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.sampled = Counter()
+        self.rate_limited = Counter()
+        self.dropped = Counter()
+        self.enqueued = 0
+
+    def count(self, counter: Counter, name: str):
+        with self._lock:
+            counter[name] += 1
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                "enqueued": self.enqueued,
+                "sampled": dict(self.sampled),
+                "rate_limited": dict(self.rate_limited),
+                "dropped": dict(self.dropped),
+            }
+
+
+log_stats = LogStats()
+
+
+class _TokenBucket:
+    __slots__ = ("rate", "tokens", "updated_at")
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = rate
+        self.updated_at = time.monotonic()
+
+    def take(self) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps a fraction of the records of each configured logger (and its
+    children), up to an optional number of records per second. Warnings and
+    errors always pass.
+
+    :param dict rules: logger name -> (sample_rate, max_per_second or None)
+    """
+
+    def __init__(self, rules: dict):
+        super().__init__()
+        self.rules = rules
+        self._buckets = {
+            name: _TokenBucket(limit) for name, (_, limit) in rules.items() if limit
+        }
+        self._rule_for = {}
+
+    def _match(self, name: str):
+        if name not in self._rule_for:
+            candidates = [
+                rule
+                for rule in self.rules
+                if name == rule or name.startswith(rule + ".")
+            ]
+            self._rule_for[name] = max(candidates, key=len) if candidates else None
+        return self._rule_for[name]
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        rule = self._match(record.name)
+        if rule is None:
+            return True
+
+        sample_rate, _ = self.rules[rule]
+        if sample_rate < 1 and random.random() >= sample_rate:
+            log_stats.count(log_stats.sampled, record.name)
+            return False
+        bucket = self._buckets.get(rule)
+        if bucket is not None and not bucket.take():
+            log_stats.count(log_stats.rate_limited, record.name)
+            return False
+        return True
+
+
+class CountingQueueHandler(QueueHandler):
+    """
+    QueueHandler over a bounded queue that drops (and counts) records instead
+    of blocking the caller when the writer falls behind
+    """
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+            log_stats.enqueued += 1
+        except queue.Full:
+            log_stats.count(log_stats.dropped, record.name)
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats records as one JSON object per line
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "timestamp": self.formatTime(record, self.datefmt),
+            "level": record.levelname,
+            "logger": record.name,
+            "location": f"{record.filename}:{record.lineno}",
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            payload["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            payload["exception"] = record.exc_text
+        return json.dumps(payload, default=str)
+
+
+def parse_sampling_rules(spec: str) -> dict:
+    """
+    Parses "logger=sample_rate[/max_per_second],..." into filter rules,
+    e.g. "app.ingest=0.1/50,app.consumer.ack=0.01"
+    """
+    rules = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, value = item.partition("=")
+        rate, _, limit = value.partition("/")
+        rules[name.strip()] = (float(rate or 1), float(limit) if limit else None)
+    return rules
+
+
+_listener = None
+
+
+def start_queue_logging(logger_name: str, rules: dict, queue_size: int):
+    """
+    Moves the handlers of the given logger behind a QueueListener thread, so
+    that callers only pay for filtering and enqueueing the record
+    """
+    global _listener
+    if _listener is not None:
+        return _listener
+
+    target = logging.getLogger(logger_name)
+    handlers = list(target.handlers)
+    records = queue.Queue(maxsize=queue_size)
+
+    queue_handler = CountingQueueHandler(records)
+    queue_handler.addFilter(SamplingFilter(rules))
+    for handler in handlers:
+        target.removeHandler(handler)
+    target.addHandler(queue_handler)
+
+    _listener = QueueListener(records, *handlers, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+
+def stop_queue_logging():
+    """
+    Flushes the pending records and stops the writer thread
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -1,34 +1,54 @@
+from app.import_timer import import_timer
+
+import_timer.start()  # first: times the imports below
 import asyncio
 import logging
 from logging.config import dictConfig
-from fastapi import FastAPI
-from app.consumer.consumer_queue import runConsumerQueue
-from .log_config import logconfig
+from fastapi import Depends, FastAPI
+from .log_config import LOG_QUEUE_SIZE, LOG_SAMPLING, logconfig
+from app.log_pipeline import (
+    parse_sampling_rules,
+    start_queue_logging,
+    stop_queue_logging,
+)
 from dotenv import load_dotenv
-from app.db import init_db
+from app.profiling import ProfilingMiddleware
+from app.startup import startup
 from app.api.entries import entries_router
+from app.api.health import health_router
 from app.api.history import history_router
+from app.api.admin import ADMIN_TOKEN, admin_router, require_admin
+from app.api.live import live_router
 
 
 dictConfig(logconfig)
+start_queue_logging('app', parse_sampling_rules(LOG_SAMPLING), LOG_QUEUE_SIZE)
 load_dotenv()
 
 
 app = FastAPI()
+app.add_middleware(ProfilingMiddleware, admin_token=ADMIN_TOKEN)
 logger = logging.getLogger('app')
 
 
 @app.on_event("startup")
 async def on_startup():
-    try:
-        app.task_publisher_manager = asyncio.create_task(runConsumerQueue())
-        await init_db()
-        app.logger = logger
-    except Exception as e:
-        logger.error(e)
-        logger.error("Could not connect to Postgres")
+    app.logger = logger
+    logger.info("Imports took %.2fs", import_timer.total)
+    app.startup = asyncio.create_task(startup.run())
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    stop_queue_logging()
 
 
+app.include_router(
+    health_router,
+    prefix="/health",
+    tags=["Health - Metrics Microservice"],
+)
+
 app.include_router(
     entries_router,
     prefix="/entries",
@@ -40,3 +60,16 @@ app.include_router(
     prefix="/history",
     tags=["History - Metrics Microservice"],
 )
+
+app.include_router(
+    live_router,
+    prefix="/live",
+    tags=["Live - Metrics Microservice"],
+)
+
+app.include_router(
+    admin_router,
+    prefix="/admin",
+    tags=["Admin - Metrics Microservice"],
+    dependencies=[Depends(require_admin)],
+)
@@ -0,0 +1,88 @@
+import argparse
+import asyncio
+import logging
+from logging.config import dictConfig
+from sqlalchemy import text
+from app.db import engine
+from app.geoip import GEOIP_DATABASE_PATH, geoip
+from app.log_config import logconfig
+
+# Fills the empty countries of the stored entries from their ip, with the
+# GeoIP database used at ingest (GEOIP_DATABASE_PATH), in batches of ids.
+# Safe to re-run: only rows that still have no country are looked up.
+#
+# Usage: python -m app.migrations.backfill_countries [--batch-size N]
+
+logger = logging.getLogger('app')
+
+SELECT_BATCH = text(
+    """
+    SELECT e.id, e.ip FROM entry_compact e
+    LEFT JOIN entry_term t ON t.id = e.country_id
+    WHERE e.id > :last_id AND COALESCE(t.value, '') = ''
+    ORDER BY e.id LIMIT :batch_size
+    """
+)
+INSERT_TERMS = text(
+    "INSERT INTO entry_term (value) SELECT unnest(CAST(:values AS text[])) "
+    "ON CONFLICT (value) DO NOTHING"
+)
+UPDATE_COUNTRIES = text(
+    """
+    UPDATE entry_compact e SET country_id = t.id
+    FROM unnest(CAST(:ids AS integer[]), CAST(:countries AS text[]))
+        AS v (id, country)
+    JOIN entry_term t ON t.value = v.country
+    WHERE e.id = v.id
+    """
+)
+
+
+async def backfill(batch_size: int):
+    if geoip is None:
+        logger.error("No GeoIP database (GEOIP_DATABASE_PATH=%s)", GEOIP_DATABASE_PATH)
+        return
+
+    last_id = 0
+    scanned = updated = 0
+    while True:
+        async with engine.begin() as conn:
+            rows = (
+                await conn.execute(
+                    SELECT_BATCH, {"last_id": last_id, "batch_size": batch_size}
+                )
+            ).all()
+            if not rows:
+                break
+            ids, countries = [], []
+            for id, ip in rows:
+                country = geoip.lookup(ip)
+                if country:
+                    ids.append(id)
+                    countries.append(country)
+            if ids:
+                await conn.execute(INSERT_TERMS, {"values": sorted(set(countries))})
+                result = await conn.execute(
+                    UPDATE_COUNTRIES, {"ids": ids, "countries": countries}
+                )
+                updated += result.rowcount
+        scanned += len(rows)
+        last_id = rows[-1][0]
+        logger.info(
+            "Scanned %d rows, %d countries filled (up to id %d)",
+            scanned,
+            updated,
+            last_id,
+        )
+
+    logger.info("Backfill finished, %d countries filled", updated)
+
+
+if __name__ == "__main__":
+    dictConfig(logconfig)
+    parser = argparse.ArgumentParser(
+        description="Fill the empty countries of the entries from their ip"
+    )
+    parser.add_argument("--batch-size", type=int, default=10000)
+    args = parser.parse_args()
+    asyncio.run(backfill(args.batch_size))
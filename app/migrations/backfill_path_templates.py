@@ -0,0 +1,86 @@
+import argparse
+import asyncio
+import logging
+from logging.config import dictConfig
+from sqlalchemy import text
+from app.db import engine, init_db
+from app.log_config import logconfig
+from app.route_templates import route_template
+
+# Sets the route template of the entries stored before it was computed at
+# ingest, in batches of ids. Safe to re-run: only rows without a template
+# are updated. The app also runs it at startup (see app/startup.py), which
+# costs a lookup in a partial index once every entry has a template.
+#
+# Usage: python -m app.migrations.backfill_path_templates [--batch-size N]
+
+logger = logging.getLogger('app')
+
+BATCH_SIZE = 10000
+
+SELECT_BATCH = text(
+    """
+    SELECT e.id, t.value FROM entry_compact e
+    JOIN entry_term t ON t.id = e.path_id
+    WHERE e.id > :last_id AND e.path_template_id IS NULL
+    ORDER BY e.id LIMIT :batch_size
+    """
+)
+INSERT_TERMS = text(
+    "INSERT INTO entry_term (value) SELECT unnest(CAST(:values AS text[])) "
+    "ON CONFLICT (value) DO NOTHING"
+)
+UPDATE_TEMPLATES = text(
+    """
+    UPDATE entry_compact e SET path_template_id = t.id
+    FROM unnest(CAST(:ids AS integer[]), CAST(:templates AS text[]))
+        AS v (id, template)
+    JOIN entry_term t ON t.value = v.template
+    WHERE e.id = v.id
+    """
+)
+
+
+async def backfill_path_templates(batch_size: int = BATCH_SIZE) -> int:
+    """
+    Sets the route template of every entry stored without one. Returns how
+    many were set
+    """
+    last_id = 0
+    updated = 0
+    while True:
+        async with engine.begin() as conn:
+            rows = (
+                await conn.execute(
+                    SELECT_BATCH, {"last_id": last_id, "batch_size": batch_size}
+                )
+            ).all()
+            if not rows:
+                break
+            ids = [id for id, _ in rows]
+            templates = [route_template(path) for _, path in rows]
+            await conn.execute(INSERT_TERMS, {"values": sorted(set(templates))})
+            result = await conn.execute(
+                UPDATE_TEMPLATES, {"ids": ids, "templates": templates}
+            )
+        updated += result.rowcount
+        last_id = ids[-1]
+        logger.info("Set %d route templates (up to id %d)", updated, last_id)
+    return updated
+
+
+async def backfill(batch_size: int):
+    # Adds the path_template_id column if the app didn't start since
+    await init_db()
+    updated = await backfill_path_templates(batch_size)
+    logger.info("Backfill finished, %d route templates set", updated)
+
+
+if __name__ == "__main__":
+    dictConfig(logconfig)
+    parser = argparse.ArgumentParser(
+        description="Set the route template of the entries stored without one"
+    )
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+    asyncio.run(backfill(args.batch_size))
@@ -0,0 +1,62 @@
+import argparse
+import asyncio
+import logging
+from logging.config import dictConfig
+from sqlalchemy import text
+from app.db import engine, init_db
+from app.funnels import UserBitmaps
+from app.log_config import logconfig
+
+# Adds the entries stored before the user bitmaps were maintained at ingest
+# (see app/funnels.py), in batches of ids. Safe to re-run: bitmaps are only
+# ever OR-ed.
+#
+# Usage: python -m app.migrations.backfill_user_bitmaps [--batch-size N]
+
+logger = logging.getLogger('app')
+
+SELECT_BATCH = text(
+    """
+    SELECT id, user_id, action, datetime, country FROM entry
+    WHERE id > :last_id ORDER BY id LIMIT :batch_size
+    """
+)
+
+
+async def backfill(batch_size: int):
+    # Creates the bitmap tables if the app didn't start since
+    await init_db()
+
+    bitmaps = UserBitmaps(flush_interval=0, ordinal_cache_size=batch_size * 10)
+    last_id = 0
+    indexed = 0
+    while True:
+        async with engine.connect() as conn:
+            rows = (
+                await conn.execute(
+                    SELECT_BATCH, {"last_id": last_id, "batch_size": batch_size}
+                )
+            ).all()
+        if not rows:
+            break
+        bitmaps.pending.extend(
+            (user_id, action, datetime, country)
+            for _, user_id, action, datetime, country in rows
+            if user_id
+        )
+        await bitmaps.flush()
+        indexed += len(rows)
+        last_id = rows[-1][0]
+        logger.info("Indexed %d entries (up to id %d)", indexed, last_id)
+
+    logger.info("Backfill finished, %d entries indexed", indexed)
+
+
+if __name__ == "__main__":
+    dictConfig(logconfig)
+    parser = argparse.ArgumentParser(
+        description="Add the stored entries to the user bitmaps"
+    )
+    parser.add_argument("--batch-size", type=int, default=10000)
+    args = parser.parse_args()
+    asyncio.run(backfill(args.batch_size))
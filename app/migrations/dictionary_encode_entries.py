@@ -0,0 +1,117 @@
+import argparse
+import asyncio
+import logging
+from logging.config import dictConfig
+from sqlalchemy import text
+from app.db import engine, init_db
+from app.aggregates import HISTORY_AGGREGATES
+from app.entry_storage import ENCODED_COLUMNS
+from app.history_views import init_history_views, view_name
+from app.log_config import logconfig
+
+# Moves the rows of the legacy "entry" table (full strings per row) into the
+# dictionary-encoded entry_compact table, in batches of ids. Safe to re-run:
+# rows that were already moved are skipped.
+#
+# Usage: python -m app.migrations.dictionary_encode_entries [--batch-size N]
+
+logger = logging.getLogger('app')
+
+LEGACY_TABLE = "entry_legacy"
+
+_encoded_ids = ", ".join(f"{column}_id" for column in ENCODED_COLUMNS)
+_encoded_values = ", ".join(f"t_{column}.id" for column in ENCODED_COLUMNS)
+_joins = " ".join(
+    f"JOIN entry_term t_{column} ON t_{column}.value = l.{column}"
+    for column in ENCODED_COLUMNS
+)
+
+BATCH_END = text(
+    f"SELECT max(id) FROM (SELECT id FROM {LEGACY_TABLE} WHERE id > :last_id "
+    "ORDER BY id LIMIT :batch_size) AS batch"
+)
+INSERT_TERMS = text(
+    f"""
+    INSERT INTO entry_term (value)
+    SELECT DISTINCT unnest(ARRAY[{", ".join(ENCODED_COLUMNS)}])
+    FROM {LEGACY_TABLE} WHERE id > :last_id AND id <= :batch_end
+    ON CONFLICT (value) DO NOTHING
+    """
+)
+MOVE_ROWS = text(
+    f"""
+    INSERT INTO entry_compact (
+        id, status_code, datetime, response_time, user_id, ip, training_id,
+        {_encoded_ids}
+    )
+    SELECT l.id, l.status_code, l.datetime, l.response_time, l.user_id, l.ip,
+        COALESCE(l.training_id, ''), {_encoded_values}
+    FROM {LEGACY_TABLE} l {_joins}
+    WHERE l.id > :last_id AND l.id <= :batch_end
+    ON CONFLICT (id) DO NOTHING
+    """
+)
+
+
+async def rename_legacy_table():
+    async with engine.begin() as conn:
+        kind = await conn.scalar(
+            text("SELECT relkind FROM pg_class WHERE oid = to_regclass('entry')")
+        )
+        if kind == "r":
+            logger.info('Renaming the legacy "entry" table to %s', LEGACY_TABLE)
+            await conn.execute(text(f"ALTER TABLE entry RENAME TO {LEGACY_TABLE}"))
+            # They would keep reading the legacy table, recreated by init_history_views
+            for aggregate in HISTORY_AGGREGATES:
+                await conn.execute(
+                    text(f"DROP MATERIALIZED VIEW IF EXISTS {view_name(aggregate)}")
+                )
+        return await conn.scalar(text(f"SELECT to_regclass('{LEGACY_TABLE}')"))
+
+
+async def migrate(batch_size: int, keep_legacy: bool):
+    if not await rename_legacy_table():
+        logger.info("Nothing to migrate")
+        return
+    await init_db()
+
+    last_id = 0
+    moved = 0
+    while True:
+        async with engine.begin() as conn:
+            batch_end = await conn.scalar(
+                BATCH_END, {"last_id": last_id, "batch_size": batch_size}
+            )
+            if batch_end is None:
+                break
+            params = {"last_id": last_id, "batch_end": batch_end}
+            await conn.execute(INSERT_TERMS, params)
+            result = await conn.execute(MOVE_ROWS, params)
+        moved += result.rowcount
+        last_id = batch_end
+        logger.info("Moved %d rows (up to id %d)", moved, last_id)
+
+    async with engine.begin() as conn:
+        await conn.execute(
+            text(
+                "SELECT setval(pg_get_serial_sequence('entry_compact', 'id'), "
+                "(SELECT COALESCE(max(id), 0) + 1 FROM entry_compact), false)"
+            )
+        )
+        if not keep_legacy:
+            await conn.execute(text(f"DROP TABLE {LEGACY_TABLE}"))
+    await init_history_views()
+    logger.info("Migration finished, %d rows moved", moved)
+
+
+if __name__ == "__main__":
+    dictConfig(logconfig)
+    parser = argparse.ArgumentParser(
+        description="Dictionary-encode the rows of the legacy entry table"
+    )
+    parser.add_argument("--batch-size", type=int, default=10000)
+    parser.add_argument(
+        "--keep-legacy", action="store_true", help="Don't drop the legacy table"
+    )
+    args = parser.parse_args()
+    asyncio.run(migrate(args.batch_size, args.keep_legacy))
@@ -1,4 +1,6 @@
+import datetime as dt
 from typing import Dict, Optional
+from sqlalchemy import Column, DateTime, Index, LargeBinary, String, func
 from sqlmodel import SQLModel, Field
 
 
@@ -19,13 +21,177 @@ class EntryBase(SQLModel):
 
 
 class Entry(EntryBase, table=True):
+    """
+    Read and written through the "entry" view over EntryRecord (see
+    app/entry_storage.py), so it is not created as a table
+    """
+
+    __table_args__ = {"info": {"is_view": True}}
+
+    id: int = Field(default=None, primary_key=True)
+    # Route template of the path, set at ingest (see app/route_templates.py)
+    path_template: Optional[str] = None
+
+
+class EntryTerm(SQLModel, table=True):
+    """
+    Dictionary of the distinct values of the low cardinality Entry columns
+    """
+
+    __tablename__ = "entry_term"
+
     id: int = Field(default=None, primary_key=True)
+    value: str = Field(sa_column=Column(String, unique=True, nullable=False))
+
+
+class EntryRecord(SQLModel, table=True):
+    """
+    Physical storage of the entries, with the low cardinality columns stored
+    as EntryTerm ids
+    """
+
+    __tablename__ = "entry_compact"
+    __table_args__ = (Index("entry_compact_service_action", "service_id", "action_id"),)
+
+    id: int = Field(default=None, primary_key=True)
+    service_id: int = Field(foreign_key="entry_term.id")
+    path_id: int = Field(foreign_key="entry_term.id")
+    url_id: int = Field(foreign_key="entry_term.id")
+    method_id: int = Field(foreign_key="entry_term.id")
+    status_code: int
+    datetime: str
+    response_time: float
+    user_id: str
+    ip: str
+    country_id: int = Field(foreign_key="entry_term.id")
+    action_id: int = Field(foreign_key="entry_term.id")
+    training_id: str = ""
+    training_type_id: int = Field(foreign_key="entry_term.id")
+    # Producer message id (or hash of the message), for idempotent ingestion
+    message_id: Optional[str] = Field(default=None, sa_column=Column(String))
+    path_template_id: Optional[int] = Field(default=None, foreign_key="entry_term.id")
+
+
+class EntryRollup(SQLModel, table=True):
+    """
+    Counts of the entries removed by the retention job, per bucket (see
+    app/retention.py)
+    """
+
+    __tablename__ = "entry_rollup"
+
+    service: str = Field(primary_key=True)
+    action: str = Field(primary_key=True)
+    path_template: str = Field(primary_key=True)
+    country: str = Field(primary_key=True)
+    training_type: str = Field(primary_key=True)
+    month: str = Field(primary_key=True)  # YYYY-MM
+    count: int = 0
+    distinct_datetimes: int = 0
+
+
+class EntryRollupDatetime(SQLModel, table=True):
+    """
+    Distinct datetimes of the entries removed by the retention job, per
+    service, action, route template and month, for the aggregates counting
+    distinct datetimes (see app/retention.py)
+    """
+
+    __tablename__ = "entry_rollup_datetime"
+
+    service: str = Field(primary_key=True)
+    action: str = Field(primary_key=True)
+    path_template: str = Field(primary_key=True)
+    month: str = Field(primary_key=True)  # YYYY-MM
+    datetime: str = Field(primary_key=True)
+
+
+class TrainingTombstone(SQLModel, table=True):
+    """
+    Deleted training whose entries (those up to max_id) are hidden until the
+    compactor removes them (see app/tombstones.py)
+    """
+
+    __tablename__ = "training_tombstone"
+
+    training_id: str = Field(primary_key=True)
+    max_id: int
+    deleted_at: Optional[dt.datetime] = Field(
+        default=None, sa_column=Column(DateTime(timezone=True))
+    )
+
+
+class EntryChange(SQLModel, table=True):
+    """
+    Entry updated or deleted, logged by a trigger for the analytics mirrors
+    (see app/analytics.py)
+    """
+
+    __tablename__ = "entry_change"
+
+    seq: int = Field(default=None, primary_key=True)
+    entry_id: int
+    changed_at: Optional[dt.datetime] = Field(
+        default=None,
+        sa_column=Column(
+            DateTime(timezone=True),
+            nullable=False,
+            server_default=func.now(),
+            index=True,
+        ),
+    )
+
+
+class UserOrdinal(SQLModel, table=True):
+    """
+    Dense number of each user id, for the user bitmaps (see app/funnels.py)
+    """
+
+    __tablename__ = "user_ordinal"
+
+    ordinal: int = Field(default=None, primary_key=True)
+    user_id: str = Field(sa_column=Column(String, unique=True, nullable=False))
+
+
+class UserBitmap(SQLModel, table=True):
+    """
+    Serialized bitmap of user ordinals (see app/bitmaps.py)
+    """
+
+    __tablename__ = "user_bitmap"
+
+    name: str = Field(primary_key=True)
+    bitmap: bytes = Field(sa_column=Column(LargeBinary, nullable=False))
+
+
+class DataVersion(SQLModel, table=True):
+    """
+    Changes counter and published version of an aggregate family (see
+    app/data_versions.py)
+    """
+
+    __tablename__ = "data_version"
+
+    family: str = Field(primary_key=True)
+    changes: int = 0
+    version: int = 0
+    refreshed_at: Optional[dt.datetime] = Field(
+        default=None, sa_column=Column(DateTime(timezone=True))
+    )
 
 
 class EntryCreate(EntryBase):
     pass
 
 
+class EntryRead(EntryBase):
+    """
+    An entry as returned by the API, without the columns derived at ingest
+    """
+
+    id: int
+
+
 class EntryUpdate(SQLModel):
     service: Optional[str]
     path: Optional[str]
@@ -0,0 +1,231 @@
+import logging
+import os
+import random
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+# Opt-in profiling of single requests and ingest messages, to see where the
+# time of a slow call goes. A request is profiled when it carries
+# `X-Profile: 1` and the admin token (the header is ignored while
+# ADMIN_TOKEN is unset), or for a PROFILE_SAMPLE_RATE fraction of the
+# requests under PROFILE_SAMPLE_PATH; a PROFILE_QUEUE_SAMPLE_RATE fraction
+# of the consumed messages too.
+#
+# A profiled call is run under pyinstrument's sampling profiler (every
+# PROFILE_INTERVAL_MS, poetry install -E profiling), whose speedscope
+# profile (https://www.speedscope.app/) is kept with a breakdown of its
+# time: SQL statements (timed by app/query_stats.py), JSON encoding (by
+# app/serialization.py) and the rest (handler, ORM, validation). The last
+# PROFILES_KEPT are listed by GET /admin/profiles. Profiled responses carry
+# X-Profile-Id and a Server-Timing header with the breakdown.
+#
+# Only one call is profiled at a time per process: the sampler is
+# process-wide. Without pyinstrument, only the breakdown is recorded.
+
+PROFILE_HEADER = "x-profile"
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", 0))
+PROFILE_SAMPLE_PATH = os.environ.get("PROFILE_SAMPLE_PATH", "/history/")
+PROFILE_QUEUE_SAMPLE_RATE = float(os.environ.get("PROFILE_QUEUE_SAMPLE_RATE", 0))
+PROFILE_INTERVAL_MS = float(os.environ.get("PROFILE_INTERVAL_MS", 1))
+PROFILES_KEPT = int(os.environ.get("PROFILES_KEPT", 20))
+
+logger = logging.getLogger('app')
+
+# Profile of the call being run in this context, if any
+_current = ContextVar("profile", default=None)
+
+
+class Profile:
+    __slots__ = ("id", "kind", "name", "started_at", "seconds", "phases", "speedscope")
+
+    def __init__(self, kind: str, name: str):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.name = name
+        self.started_at = time.time()
+        self.seconds = None
+        # name: [seconds, calls]
+        self.phases = {}
+        self.speedscope = None
+
+    def add(self, phase: str, seconds: float):
+        totals = self.phases.setdefault(phase, [0.0, 0])
+        totals[0] += seconds
+        totals[1] += 1
+
+    def breakdown(self) -> dict:
+        """
+        Returns the milliseconds and calls of each phase, and the rest
+        """
+        phases = {
+            phase: {"ms": round(seconds * 1000, 3), "calls": calls}
+            for phase, (seconds, calls) in self.phases.items()
+        }
+        if self.seconds is not None:
+            timed = sum(seconds for seconds, _ in self.phases.values())
+            phases["other"] = {"ms": round((self.seconds - timed) * 1000, 3)}
+        return phases
+
+    def server_timing(self) -> str:
+        return ", ".join(
+            f"{phase};dur={values['ms']}" for phase, values in self.breakdown().items()
+        )
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "name": self.name,
+            "started_at": self.started_at,
+            "total_ms": None if self.seconds is None else round(self.seconds * 1000, 3),
+            "phases": self.breakdown(),
+            "has_profile": self.speedscope is not None,
+        }
+
+
+def active() -> bool:
+    return _current.get() is not None
+
+
+def record_phase(phase: str, seconds: float):
+    """
+    Adds the time of a phase to the profile of the current call, if any
+    """
+    profile = _current.get()
+    if profile is not None:
+        profile.add(phase, seconds)
+
+
+class Profiler:
+    def __init__(self, interval: float, kept: int):
+        self.interval = interval
+        self.profiles = deque(maxlen=kept)
+        self.busy = False
+        self.captured = 0
+        self.skipped = 0
+        self._warned = False
+
+    def _sampler(self):
+        try:
+            from pyinstrument import Profiler as Sampler
+        except ImportError:
+            if not self._warned:
+                self._warned = True
+                logger.warning(
+                    "Profiling without pyinstrument (poetry install -E profiling): "
+                    "only the phase breakdown is recorded"
+                )
+            return None
+        return Sampler(interval=self.interval)
+
+    @contextmanager
+    def capture(self, kind: str, name: str):
+        """
+        Profiles the calls run within. Yields the Profile, or None when
+        another call is already being profiled
+        """
+        if self.busy:
+            self.skipped += 1
+            yield None
+            return
+        self.busy = True
+        profile = Profile(kind, name)
+        token = _current.set(profile)
+        sampler = self._sampler()
+        if sampler is not None:
+            sampler.start()
+        started = time.perf_counter()
+        try:
+            yield profile
+        finally:
+            profile.seconds = time.perf_counter() - started
+            _current.reset(token)
+            self.busy = False
+            if sampler is not None:
+                sampler.stop()
+                profile.speedscope = _speedscope(sampler)
+            self.profiles.append(profile)
+            self.captured += 1
+
+    @contextmanager
+    def sample(self, kind: str, name: str, rate: float):
+        """
+        Same as capture, for a fraction (rate) of the calls
+        """
+        if rate > 0 and random.random() < rate:
+            with self.capture(kind, name) as profile:
+                yield profile
+        else:
+            yield None
+
+    def get(self, id: str) -> Optional[Profile]:
+        return next((p for p in self.profiles if p.id == id), None)
+
+    def reset(self):
+        self.profiles.clear()
+
+    def to_dict(self) -> dict:
+        return {
+            "captured": self.captured,
+            "skipped": self.skipped,
+            "profiles": [profile.to_dict() for profile in reversed(self.profiles)],
+        }
+
+
+def _speedscope(sampler) -> Optional[str]:
+    from pyinstrument.renderers import SpeedscopeRenderer
+
+    try:
+        return sampler.output(renderer=SpeedscopeRenderer())
+    except Exception as e:
+        logger.warning("Could not render the profile: %s", e)
+        return None
+
+
+profiler = Profiler(PROFILE_INTERVAL_MS / 1000, PROFILES_KEPT)
+
+
+class ProfilingMiddleware:
+    """
+    ASGI middleware profiling the requests asked for (or sampled)
+    """
+
+    def __init__(self, app, admin_token: Optional[str] = None):
+        self.app = app
+        self.admin_token = admin_token
+
+    def _wanted(self, scope) -> bool:
+        headers = dict(scope["headers"])
+        if headers.get(PROFILE_HEADER.encode()) in (b"1", b"true"):
+            token = headers.get(b"x-admin-token")
+            return bool(self.admin_token) and token == self.admin_token.encode()
+        return (
+            PROFILE_SAMPLE_RATE > 0
+            and scope["path"].startswith(PROFILE_SAMPLE_PATH)
+            and random.random() < PROFILE_SAMPLE_RATE
+        )
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self._wanted(scope):
+            return await self.app(scope, receive, send)
+
+        with profiler.capture("http", f"{scope['method']} {scope['path']}") as profile:
+            if profile is None:
+                return await self.app(scope, receive, send)
+            started = time.perf_counter()
+
+            async def send_with_headers(message):
+                if message["type"] == "http.response.start":
+                    # The body is rendered by now
+                    profile.seconds = time.perf_counter() - started
+                    message["headers"] = list(message.get("headers", [])) + [
+                        (b"x-profile-id", profile.id.encode()),
+                        (b"server-timing", profile.server_timing().encode()),
+                    ]
+                await send(message)
+
+            await self.app(scope, receive, send_with_headers)
@@ -0,0 +1,209 @@
+import asyncio
+import logging
+import os
+import random
+import re
+import time
+from collections import deque
+from functools import lru_cache
+from sqlalchemy import event
+from app.profiling import record_phase
+
+# Statement timing hooks for the async engines, grouped by normalized SQL.
+# https://docs.sqlalchemy.org/en/14/faq/performance.html#query-profiling
+
+SLOW_QUERY_THRESHOLD_MS = float(os.environ.get("SLOW_QUERY_THRESHOLD_MS", 500))
+SLOW_QUERY_EXPLAIN_SAMPLE_RATE = float(
+    os.environ.get("SLOW_QUERY_EXPLAIN_SAMPLE_RATE", 0.1)
+)
+SLOW_QUERY_EXPLAIN_COOLDOWN = float(os.environ.get("SLOW_QUERY_EXPLAIN_COOLDOWN", 60))
+QUERY_STATS_SAMPLES = int(os.environ.get("QUERY_STATS_SAMPLES", 1000))
+QUERY_STATS_MAX_STATEMENTS = int(os.environ.get("QUERY_STATS_MAX_STATEMENTS", 500))
+
+EXPLAIN_PREFIX = "EXPLAIN (ANALYZE, BUFFERS) "
+MAX_LOGGED_PARAMS_LENGTH = 500
+
+logger = logging.getLogger('app')
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+_BIND_PARAM = re.compile(r"%\(\w+\)s|%s|\$\d+|(?<!:):\w+")
+_VALUES_LIST = re.compile(r"\((?:\s*\?\s*,)+\s*\?\s*\)")
+_WHITESPACE = re.compile(r"\s+")
+
+
+@lru_cache(maxsize=2048)
+def normalize_statement(statement: str) -> str:
+    """
+    Returns the statement with literals and bind parameters replaced by "?",
+    so that executions which only differ in their values are grouped together
+    """
+    normalized = _STRING_LITERAL.sub("?", statement)
+    normalized = _BIND_PARAM.sub("?", normalized)
+    normalized = _NUMBER_LITERAL.sub("?", normalized)
+    normalized = _VALUES_LIST.sub("(?, ...)", normalized)
+    return _WHITESPACE.sub(" ", normalized).strip()
+
+
+class QueryStat:
+    __slots__ = (
+        "statement",
+        "calls",
+        "total",
+        "max",
+        "samples",
+        "slow_calls",
+        "last_plan",
+        "last_explained_at",
+    )
+
+    def __init__(self, statement: str):
+        self.statement = statement
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = deque(maxlen=QUERY_STATS_SAMPLES)
+        self.slow_calls = 0
+        self.last_plan = None
+        self.last_explained_at = 0.0
+
+    def record(self, elapsed: float):
+        self.calls += 1
+        self.total += elapsed
+        self.samples.append(elapsed)
+        if elapsed > self.max:
+            self.max = elapsed
+
+    def percentile(self, q: float) -> float:
+        """
+        Returns the q-th percentile (0-100) over the most recent samples
+        """
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        index = min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))
+        return ordered[index]
+
+    def to_dict(self) -> dict:
+        return {
+            "statement": self.statement,
+            "calls": self.calls,
+            "total_ms": round(self.total * 1000, 3),
+            "mean_ms": round(self.total / self.calls * 1000, 3) if self.calls else 0,
+            "p50_ms": round(self.percentile(50) * 1000, 3),
+            "p99_ms": round(self.percentile(99) * 1000, 3),
+            "max_ms": round(self.max * 1000, 3),
+            "slow_calls": self.slow_calls,
+            "last_plan": self.last_plan,
+        }
+
+
+class QueryStats:
+    """
+    In-process registry of statement timings, keyed by normalized SQL
+    """
+
+    def __init__(self):
+        self._stats = {}
+
+    def record(self, statement: str, elapsed: float) -> QueryStat:
+        key = normalize_statement(statement)
+        stat = self._stats.get(key)
+        if stat is None:
+            if len(self._stats) >= QUERY_STATS_MAX_STATEMENTS:
+                # Evict the cheapest statement so ad-hoc SQL can't grow us forever
+                cheapest = min(self._stats.values(), key=lambda s: s.total)
+                del self._stats[cheapest.statement]
+            stat = self._stats[key] = QueryStat(key)
+        stat.record(elapsed)
+        return stat
+
+    def top(self, limit: int = 10, order_by: str = "total") -> list:
+        if order_by == "p99":
+            ranked = sorted(
+                self._stats.values(), key=lambda s: s.percentile(99), reverse=True
+            )
+        else:
+            ranked = sorted(self._stats.values(), key=lambda s: s.total, reverse=True)
+        return [stat.to_dict() for stat in ranked[:limit]]
+
+    def reset(self):
+        self._stats.clear()
+
+
+query_stats = QueryStats()
+_explain_tasks = set()
+
+
+def _format_parameters(parameters) -> str:
+    formatted = repr(parameters)
+    if len(formatted) > MAX_LOGGED_PARAMS_LENGTH:
+        return formatted[:MAX_LOGGED_PARAMS_LENGTH] + "...]"
+    return formatted
+
+
+def _should_explain(stat: QueryStat, statement: str, executemany: bool) -> bool:
+    # EXPLAIN ANALYZE executes the statement, so never do it for writes
+    if executemany or statement.lstrip()[:6].upper() != "SELECT":
+        return False
+    if time.monotonic() - stat.last_explained_at < SLOW_QUERY_EXPLAIN_COOLDOWN:
+        return False
+    return random.random() < SLOW_QUERY_EXPLAIN_SAMPLE_RATE
+
+
+async def _explain(engine, stat: QueryStat, statement: str, parameters):
+    try:
+        async with engine.connect() as conn:
+            result = await conn.exec_driver_sql(EXPLAIN_PREFIX + statement, parameters)
+            stat.last_plan = "\n".join(row[0] for row in result)
+        logger.warning("[SLOW QUERY] Plan for %s\n%s", stat.statement, stat.last_plan)
+    except Exception as e:
+        logger.warning("[SLOW QUERY] Could not explain %s: %s", stat.statement, e)
+
+
+def _schedule_explain(engine, stat: QueryStat, statement: str, parameters):
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return
+    stat.last_explained_at = time.monotonic()
+    task = loop.create_task(_explain(engine, stat, statement, parameters))
+    _explain_tasks.add(task)
+    task.add_done_callback(_explain_tasks.discard)
+
+
+def instrument_engine(engine):
+    """
+    Registers the timing hooks on an AsyncEngine. Statements slower than
+    SLOW_QUERY_THRESHOLD_MS are logged with their parameters and a sampled
+    fraction of them is explained in the background
+    """
+
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def before_cursor_execute(
+        conn, cursor, statement, parameters, context, executemany
+    ):
+        conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+    @event.listens_for(engine.sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_start_time"].pop()
+        if statement.startswith(EXPLAIN_PREFIX):
+            return
+
+        record_phase("sql", elapsed)
+        stat = query_stats.record(statement, elapsed)
+        if elapsed * 1000 < SLOW_QUERY_THRESHOLD_MS:
+            return
+
+        stat.slow_calls += 1
+        logger.warning(
+            "[SLOW QUERY] %.1f ms: %s | params: %s",
+            elapsed * 1000,
+            stat.statement,
+            _format_parameters(parameters),
+        )
+        if _should_explain(stat, statement, executemany):
+            _schedule_explain(engine, stat, statement, parameters)
+
+    return engine
@@ -0,0 +1,188 @@
+import asyncio
+import datetime as dt
+import logging
+import os
+from typing import Optional
+from sqlalchemy import text
+from app.db import engine
+
+# Retention of the raw entries: the entries older than RETENTION_DAYS are
+# rolled up into entry_rollup (counts per service, action, route template,
+# country, training type and month) and deleted, in small batches with a
+# pause between them. The history views count the rollups too (see
+# HistoryAggregate.uses_rollups), so their all-time charts are unchanged;
+# the aggregates keyed by user, GET /entries and the funnel backfill lose the
+# old entries, and the corrections (unblock, user_edit, unfavorite, deleted
+# trainings) can't reach the rolled up ones.
+#
+# A batch rolls up and deletes its entries in a single statement, so the
+# views never count an entry twice or miss it. The aggregates counting
+# distinct datetimes (to drop duplicated messages) can't add up the buckets,
+# which may share a datetime: the distinct datetimes per service, action,
+# route template and month are also kept in entry_rollup_datetime, and
+# counted again along with the retained entries. Each bucket still keeps its
+# distinct_datetimes, with batches cut between two datetimes so that they
+# are never split.
+
+# Opt-in: the raw entries are lost for good (see the README)
+RETENTION_DAYS = int(os.environ.get("RETENTION_DAYS", 0))  # 0 disables it
+RETENTION_INTERVAL_SECONDS = float(os.environ.get("RETENTION_INTERVAL_SECONDS", 3600))
+RETENTION_BATCH_SIZE = int(os.environ.get("RETENTION_BATCH_SIZE", 5000))
+RETENTION_BATCH_DELAY = float(os.environ.get("RETENTION_BATCH_DELAY", 0.5))
+
+# Only one process runs the job at a time
+RETENTION_LOCK_ID = 802_042
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+BATCH_BOUND = text(
+    "SELECT datetime FROM entry_compact WHERE datetime < :cutoff "
+    "ORDER BY datetime OFFSET :batch_size LIMIT 1"
+)
+OLDEST = text("SELECT min(datetime) FROM entry_compact")
+NEXT_DATETIME = text(
+    "SELECT min(datetime) FROM entry_compact WHERE datetime > :datetime"
+)
+
+ROLL_UP = text(
+    """
+    WITH expired AS (
+        DELETE FROM entry_compact WHERE datetime < :bound
+        RETURNING id, training_id, service_id, action_id, path_template_id,
+            country_id, training_type_id, datetime
+    ), decoded AS (
+        SELECT coalesce(service.value, '') AS service,
+            coalesce(action.value, '') AS action,
+            coalesce(path_template.value, '') AS path_template,
+            coalesce(country.value, '') AS country,
+            coalesce(training_type.value, '') AS training_type,
+            substr(expired.datetime, 1, 7) AS month, expired.datetime
+        FROM expired
+        LEFT JOIN entry_term AS service ON service.id = expired.service_id
+        LEFT JOIN entry_term AS action ON action.id = expired.action_id
+        LEFT JOIN entry_term AS path_template
+            ON path_template.id = expired.path_template_id
+        LEFT JOIN entry_term AS country ON country.id = expired.country_id
+        LEFT JOIN entry_term AS training_type
+            ON training_type.id = expired.training_type_id
+        -- The entries of deleted trainings were already uncounted
+        WHERE NOT EXISTS (
+            SELECT 1 FROM training_tombstone d
+            WHERE d.training_id = expired.training_id AND expired.id <= d.max_id
+        )
+    ), rolled_up AS (
+        INSERT INTO entry_rollup (
+            service, action, path_template, country, training_type, month,
+            count, distinct_datetimes
+        )
+        SELECT service, action, path_template, country, training_type, month,
+            count(*), count(DISTINCT datetime)
+        FROM decoded
+        GROUP BY 1, 2, 3, 4, 5, 6
+        ON CONFLICT (service, action, path_template, country, training_type, month)
+        DO UPDATE SET count = entry_rollup.count + excluded.count,
+            distinct_datetimes =
+                entry_rollup.distinct_datetimes + excluded.distinct_datetimes
+    ), rolled_up_datetimes AS (
+        INSERT INTO entry_rollup_datetime (
+            service, action, path_template, month, datetime
+        )
+        SELECT DISTINCT service, action, path_template, month, datetime
+        FROM decoded
+        ON CONFLICT DO NOTHING
+    )
+    SELECT count(*) FROM expired
+    """
+)
+
+logger = logging.getLogger('app')
+
+
+def retention_cutoff(days: int, now: Optional[dt.datetime] = None) -> str:
+    """
+    Returns the datetime (in the entries' format) before which the entries
+    are expired
+    """
+    now = now or dt.datetime.now(dt.timezone.utc)
+    return (now - dt.timedelta(days=days)).strftime(DATETIME_FORMAT)
+
+
+async def roll_up_batch(conn, cutoff: str, batch_size: int) -> int:
+    """
+    Rolls up and deletes about batch_size of the oldest expired entries.
+    Returns how many were deleted
+    """
+    bound = await conn.scalar(BATCH_BOUND, {"cutoff": cutoff, "batch_size": batch_size})
+    if bound is None:
+        bound = cutoff
+    elif bound == await conn.scalar(OLDEST):
+        # More than a batch share the oldest datetime: take them all
+        after = await conn.scalar(NEXT_DATETIME, {"datetime": bound})
+        bound = min(after or cutoff, cutoff)
+    return await conn.scalar(ROLL_UP, {"bound": bound})
+
+
+class RetentionJob:
+    def __init__(self, days: int, interval: float, batch_size: int, batch_delay: float):
+        self.days = days
+        self.interval = interval
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.deleted = 0
+        self.runs = 0
+        self.last_run = None
+
+    async def run_once(self) -> Optional[int]:
+        """
+        Rolls up every expired entry, unless another process is already doing
+        it. Returns the number of deleted entries (None if it didn't run)
+        """
+        cutoff = retention_cutoff(self.days)
+        deleted = 0
+        async with engine.connect() as conn:
+            conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+            locked = await conn.scalar(
+                text("SELECT pg_try_advisory_lock(:id)"), {"id": RETENTION_LOCK_ID}
+            )
+            if not locked:
+                return None
+            try:
+                while True:
+                    batch = await roll_up_batch(conn, cutoff, self.batch_size)
+                    deleted += batch
+                    self.deleted += batch
+                    if not batch:
+                        break
+                    await asyncio.sleep(self.batch_delay)
+            finally:
+                await conn.execute(
+                    text("SELECT pg_advisory_unlock(:id)"), {"id": RETENTION_LOCK_ID}
+                )
+        self.runs += 1
+        self.last_run = {"cutoff": cutoff, "deleted": deleted}
+        return deleted
+
+    async def run(self):
+        while True:
+            try:
+                deleted = await self.run_once()
+                if deleted:
+                    logger.info("Rolled up %d expired entries", deleted)
+            except Exception as e:
+                logger.error("Could not roll up the expired entries: %s", e)
+            await asyncio.sleep(self.interval)
+
+    def to_dict(self) -> dict:
+        return {
+            "days": self.days,
+            "runs": self.runs,
+            "deleted": self.deleted,
+            "last_run": self.last_run,
+        }
+
+
+retention_job = RetentionJob(
+    RETENTION_DAYS,
+    RETENTION_INTERVAL_SECONDS,
+    RETENTION_BATCH_SIZE,
+    RETENTION_BATCH_DELAY,
+)
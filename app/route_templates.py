@@ -0,0 +1,66 @@
+import re
+from functools import lru_cache
+
+# Normalizes the path of an entry into its route template, e.g.
+# "/users/8f2a.../block" -> "/users/{user_id}/block", so that the history
+# queries filter on a small, indexed set of values instead of matching
+# patterns over every path. The templates are matched by a single compiled
+# regex; trailing slashes and query strings are ignored.
+
+ROUTE_TEMPLATES = (
+    # user-service
+    "/login/",
+    "/login/google/",
+    "/login/forgot_password",
+    "/signup/",
+    "/signup/google/",
+    "/users/",
+    "/users/{user_id}",
+    "/users/{user_id}/block",
+    "/users/{user_id}/unblock",
+    "/users/{user_id}/trainings/favorites",
+    "/users/{user_id}/trainings/favorites/{training_id}",
+    # training-service
+    "/trainings/",
+    "/trainings/{training_id}",
+    "/trainings/{training_id}/media",
+)
+ROUTE_TEMPLATES_CACHE_SIZE = 65536
+
+# Path segments of unknown routes that look like ids (numbers, uuids,
+# object ids) are replaced by "{id}"
+_ID_SEGMENT = re.compile(
+    r"\d+|[0-9a-fA-F]{24}|[0-9a-fA-F]{8}-([0-9a-fA-F]{4}-){3}[0-9a-fA-F]{12}"
+)
+_PARAMETER = re.compile(r"\{\w+\}")
+
+
+def _template_pattern(template: str) -> str:
+    parts = _PARAMETER.split(template.rstrip("/"))
+    return "[^/]+".join(re.escape(part) for part in parts) + "/?"
+
+
+_ROUTES = re.compile(
+    "|".join(
+        f"(?P<r{i}>{_template_pattern(template)})"
+        for i, template in enumerate(ROUTE_TEMPLATES)
+    )
+)
+
+
+@lru_cache(maxsize=ROUTE_TEMPLATES_CACHE_SIZE)
+def route_template(path: str) -> str:
+    """
+    Returns the template of the route the path belongs to
+    """
+    path = (path or "").split("?", 1)[0]
+    match = _ROUTES.fullmatch(path)
+    if match:
+        return ROUTE_TEMPLATES[int(match.lastgroup[1:])]
+    # Unknown routes are templated without their trailing slash
+    if path:
+        path = path.rstrip("/") or "/"
+    return "/".join(
+        "{id}" if _ID_SEGMENT.fullmatch(segment) else segment
+        for segment in path.split("/")
+    )
@@ -0,0 +1,409 @@
+import asyncio
+import fcntl
+import itertools
+import logging
+import mmap
+import os
+import struct
+import zlib
+from typing import Optional
+from sqlalchemy.exc import IntegrityError
+
+# Local write-ahead spool of the ingest path. The consumer appends each
+# message to an append-only log on local disk and acks it to the broker once
+# it is fsynced (fsyncs are batched: one per SPOOL_FSYNC_INTERVAL_MS for
+# every message appended meanwhile). A replayer reads the log back through
+# mmap and applies it to Postgres in batches, so a slow or unavailable
+# database delays the entries instead of losing them.
+#
+# Directory layout: <SPOOL_DIR>/<n>/ is claimed (flock) by one process, so
+# worker processes each get their own spool, and the spool of a process that
+# died is replayed by the next one that starts. It holds:
+#   <segment>.log: records, rolled over every SPOOL_SEGMENT_BYTES
+#   checkpoint:    segment and offset of the first record not yet replayed
+#
+# Record layout (little-endian): crc32 of id + body (uint32), body length
+# (uint32), id length (uint16), message id (UTF-8), body.
+#
+# Messages are validated before being spooled (see ConsumerQueue.on_message).
+# A record that still fails on replay with a data error (not a database
+# outage) is moved to <n>/quarantine.log, in the same layout, and the replay
+# goes on past it.
+
+SPOOL_DIR = os.environ.get("SPOOL_DIR")  # the spool is disabled when unset
+SPOOL_SEGMENT_BYTES = int(os.environ.get("SPOOL_SEGMENT_BYTES", 64 * 1024 * 1024))
+SPOOL_FSYNC_INTERVAL_MS = float(os.environ.get("SPOOL_FSYNC_INTERVAL_MS", 10))
+SPOOL_REPLAY_BATCH = int(os.environ.get("SPOOL_REPLAY_BATCH", 500))
+# Unacked messages the broker may deliver: acks wait for the next fsync
+SPOOL_PREFETCH_COUNT = int(os.environ.get("SPOOL_PREFETCH_COUNT", 1000))
+
+RECORD = struct.Struct("<IIH")
+CHECKPOINT = struct.Struct("<QQ")
+SEGMENT_SUFFIX = ".log"
+
+# Errors of a record itself, which retrying won't fix
+POISON_ERRORS = (ValueError, TypeError, KeyError, IntegrityError)
+QUARANTINE_FILE = "quarantine.log"
+
+logger = logging.getLogger('app')
+
+
+def _segment_name(segment: int) -> str:
+    return f"{segment:016d}{SEGMENT_SUFFIX}"
+
+
+def encode_record(message_id: str, body: bytes) -> bytes:
+    id_bytes = message_id.encode("utf-8")
+    crc = zlib.crc32(body, zlib.crc32(id_bytes))
+    return RECORD.pack(crc, len(body), len(id_bytes)) + id_bytes + body
+
+
+def decode_record(data, offset: int, limit: int) -> Optional[tuple]:
+    """
+    Returns the (message id, body, next offset) of the record at the offset,
+    or None if it is incomplete or corrupt
+    """
+    if offset + RECORD.size > limit:
+        return None
+    crc, body_length, id_length = RECORD.unpack_from(data, offset)
+    start = offset + RECORD.size
+    end = start + id_length + body_length
+    if end > limit:
+        return None
+    id_bytes = bytes(data[start : start + id_length])
+    body = bytes(data[start + id_length : end])
+    if zlib.crc32(body, zlib.crc32(id_bytes)) != crc:
+        return None
+    return id_bytes.decode("utf-8"), body, end
+
+
+class Spool:
+    def __init__(
+        self,
+        directory: str,
+        segment_bytes: int = SPOOL_SEGMENT_BYTES,
+        fsync_interval: float = SPOOL_FSYNC_INTERVAL_MS / 1000,
+    ):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync_interval = fsync_interval
+        self.appended = 0
+        self.replayed = 0
+        self.quarantined = 0
+        self.fsyncs = 0
+
+        segments = sorted(
+            int(name[: -len(SEGMENT_SUFFIX)])
+            for name in os.listdir(directory)
+            if name.endswith(SEGMENT_SUFFIX)
+        )
+        self.checkpoint = self._read_checkpoint() or (
+            segments[0] if segments else 0,
+            0,
+        )
+        # Only the last segment can end with a record torn by a crash
+        self._segment = segments[-1] if segments else self.checkpoint[0]
+        self._size = self._recover(self._segment)
+        self._file = open(self._path(self._segment), "ab")
+        # Segment and size up to which the records are fsynced
+        self.synced = (self._segment, self._size)
+        self._rolled = []
+        self._waiters = []
+        self._maps = {}
+        self._wakeup = asyncio.Event()
+        self._synced_event = asyncio.Event()
+
+    def _path(self, segment: int) -> str:
+        return os.path.join(self.directory, _segment_name(segment))
+
+    def _read_checkpoint(self) -> Optional[tuple]:
+        try:
+            with open(os.path.join(self.directory, "checkpoint"), "rb") as file:
+                return CHECKPOINT.unpack(file.read(CHECKPOINT.size))
+        except (OSError, struct.error):
+            return None
+
+    def _recover(self, segment: int) -> int:
+        """
+        Truncates the segment after its last valid record. Returns its size
+        """
+        path = self._path(segment)
+        if not os.path.exists(path) or not os.path.getsize(path):
+            return 0
+        with open(path, "r+b") as file:
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            offset, size = 0, len(data)
+            while (record := decode_record(data, offset, size)) is not None:
+                offset = record[2]
+            data.close()
+            if offset < size:
+                logger.warning(
+                    "Truncating spool segment %s from %d to %d bytes",
+                    path,
+                    size,
+                    offset,
+                )
+                file.truncate(offset)
+                os.fsync(file.fileno())
+        return offset
+
+    def append(self, message_id: str, body: bytes) -> asyncio.Future:
+        """
+        Appends a message. The returned future is done once it is fsynced
+        """
+        record = encode_record(message_id, body)
+        if self._size and self._size + len(record) > self.segment_bytes:
+            self._roll()
+        self._file.write(record)
+        self._size += len(record)
+        self.appended += 1
+        written = asyncio.get_running_loop().create_future()
+        self._waiters.append(written)
+        self._wakeup.set()
+        return written
+
+    def _roll(self):
+        # The file is closed by the next sync, once fsynced
+        self._rolled.append(self._file)
+        self._segment += 1
+        self._size = 0
+        self._file = open(self._path(self._segment), "ab")
+
+    async def sync(self):
+        """
+        Fsyncs the appended records and resolves their futures
+        """
+        waiters, self._waiters = self._waiters, []
+        files, self._rolled = self._rolled + [self._file], []
+        position = (self._segment, self._size)
+        try:
+            for file in files:
+                file.flush()
+            await asyncio.get_running_loop().run_in_executor(
+                None, lambda: [os.fsync(file.fileno()) for file in files]
+            )
+        except Exception as e:
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_exception(e)
+            raise
+        finally:
+            for file in files[:-1]:
+                file.close()
+        self.fsyncs += 1
+        self.synced = position
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self._synced_event.set()
+
+    async def run(self):
+        """
+        Fsyncs every SPOOL_FSYNC_INTERVAL_MS while messages are appended
+        """
+        while True:
+            await self._wakeup.wait()
+            await asyncio.sleep(self.fsync_interval)
+            self._wakeup.clear()
+            try:
+                await self.sync()
+            except Exception as e:
+                logger.error("Could not fsync the spool: %s", e)
+
+    async def wait_synced(self, fsyncs: int):
+        """
+        Waits until there were more than `fsyncs` fsyncs
+        """
+        while self.fsyncs == fsyncs:
+            self._synced_event.clear()
+            await self._synced_event.wait()
+
+    def _segment_size(self, segment: int) -> int:
+        if segment == self._segment:
+            return self._size
+        try:
+            return os.path.getsize(self._path(segment))
+        except FileNotFoundError:
+            return 0
+
+    def _map(self, segment: int, size: int):
+        data = self._maps.get(segment)
+        if data is None or len(data) < size:
+            if data is not None:
+                data.close()
+            with open(self._path(segment), "rb") as file:
+                data = mmap.mmap(file.fileno(), size, access=mmap.ACCESS_READ)
+            self._maps[segment] = data
+        return data
+
+    def read(self, max_records: int) -> tuple:
+        """
+        Returns up to max_records (message id, body) fsynced records from the
+        checkpoint, and the position after them
+        """
+        segment, offset = self.checkpoint
+        records = []
+        while len(records) < max_records:
+            synced_segment, synced_size = self.synced
+            if segment > synced_segment:
+                break
+            if segment < synced_segment:
+                size = self._segment_size(segment)
+            else:
+                size = synced_size
+            if offset < size:
+                data = self._map(segment, size)
+                record = decode_record(data, offset, size)
+                if record is not None:
+                    records.append(record[:2])
+                    offset = record[2]
+                    continue
+                logger.error(
+                    "Corrupt record in spool segment %s at %d, skipping the segment",
+                    self._path(segment),
+                    offset,
+                )
+                offset = size
+            if segment == synced_segment:
+                break
+            segment, offset = segment + 1, 0
+        # So that a fully replayed segment can be deleted right away
+        if segment < self.synced[0] and offset >= self._segment_size(segment):
+            segment, offset = segment + 1, 0
+        return records, (segment, offset)
+
+    def commit(self, position: tuple, replayed: int):
+        """
+        Moves the checkpoint to the position, deleting the replayed segments
+        """
+        self.replayed += replayed
+        path = os.path.join(self.directory, "checkpoint")
+        with open(path + ".tmp", "wb") as file:
+            file.write(CHECKPOINT.pack(*position))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(path + ".tmp", path)
+        _fsync_directory(self.directory)
+        for segment in range(self.checkpoint[0], position[0]):
+            data = self._maps.pop(segment, None)
+            if data is not None:
+                data.close()
+            try:
+                os.remove(self._path(segment))
+            except FileNotFoundError:
+                pass
+        self.checkpoint = position
+
+    def quarantine(self, message_id: str, body: bytes, error: Exception):
+        """
+        Keeps a record that can't be applied aside, so the replay can go on
+        """
+        logger.error("Quarantining spooled message %s: %s", message_id, error)
+        with open(os.path.join(self.directory, QUARANTINE_FILE), "ab") as file:
+            file.write(encode_record(message_id, body))
+            file.flush()
+            os.fsync(file.fileno())
+        self.quarantined += 1
+
+    def backlog_bytes(self) -> int:
+        segment, offset = self.checkpoint
+        return (
+            sum(
+                self._segment_size(current)
+                for current in range(segment, self._segment + 1)
+            )
+            - offset
+        )
+
+    def to_dict(self) -> dict:
+        return {
+            "directory": self.directory,
+            "appended": self.appended,
+            "replayed": self.replayed,
+            "quarantined": self.quarantined,
+            "fsyncs": self.fsyncs,
+            "segments": self._segment - self.checkpoint[0] + 1,
+            "backlog_bytes": self.backlog_bytes(),
+        }
+
+
+def _fsync_directory(directory: str):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class SpoolReplayer:
+    """
+    Applies the spooled messages with `apply(records)`, in batches of
+    SPOOL_REPLAY_BATCH, retrying with backoff while it fails. A batch that
+    fails with a data error is applied record by record instead, and the
+    records that fail are quarantined
+    """
+
+    def __init__(self, spool: Spool, apply, batch_size: int = SPOOL_REPLAY_BATCH):
+        self.spool = spool
+        self.apply = apply
+        self.batch_size = batch_size
+        self.failures = 0
+
+    async def run(self):
+        delay = 1
+        while True:
+            fsyncs = self.spool.fsyncs
+            records, position = self.spool.read(self.batch_size)
+            if records:
+                try:
+                    await self._apply(records)
+                except Exception as e:
+                    self.failures += 1
+                    logger.error(
+                        "Could not replay %d spooled messages (%s), retrying in %ds",
+                        len(records),
+                        e,
+                        delay,
+                    )
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, 30)
+                    continue
+                delay = 1
+            if position != self.spool.checkpoint:
+                self.spool.commit(position, len(records))
+            if len(records) < self.batch_size:
+                await self.spool.wait_synced(fsyncs)
+
+    async def _apply(self, records: list):
+        try:
+            await self.apply(records)
+        except POISON_ERRORS:
+            pass
+        else:
+            return
+        # Raises (and the batch is retried) on any other error
+        for message_id, body in records:
+            try:
+                await self.apply([(message_id, body)])
+            except POISON_ERRORS as e:
+                self.spool.quarantine(message_id, body, e)
+
+
+def open_spool(root: str) -> Spool:
+    """
+    Opens the first spool directory under root not claimed by another process
+    """
+    for index in itertools.count():
+        directory = os.path.join(root, str(index))
+        os.makedirs(directory, exist_ok=True)
+        lock = open(os.path.join(directory, "lock"), "w")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            continue
+        spool = Spool(directory)
+        # Held (and the directory claimed) as long as the process lives
+        spool.lock = lock
+        logger.info("Using the spool %s", directory)
+        return spool
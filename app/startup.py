@@ -0,0 +1,233 @@
+import asyncio
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.future import select
+from app.aggregates import HISTORY_AGGREGATES
+from app.analytics import ANALYTICS_DIR, create_changelog, open_mirror
+from app.consumer.consumer_queue import (
+    ConsumerQueue,
+    poll_queue_depth,
+    runConsumerQueue,
+    update_prefetch,
+)
+from app.consumer.flow_control import FLOW_CONTROL, FlowController
+from app.consumer.message_queue_wrapper import process_spooled
+from app.data_versions import data_versions
+from app.db import async_session, engine, init_db, lock_schema, read_engine
+from app.entry_storage import terms
+from app.funnels import user_bitmaps
+from app.history_views import history_view_refresher, init_history_views, view_name
+from app.hot_window import hot_window, window_enabled
+from app.import_timer import import_timer
+from app.live import live_dashboard
+from app.migrations.backfill_path_templates import backfill_path_templates
+from app.models import Entry
+from app.retention import RETENTION_DAYS, retention_job
+from app.spool import (
+    SPOOL_DIR,
+    SPOOL_PREFETCH_COUNT,
+    SPOOL_REPLAY_BATCH,
+    SpoolReplayer,
+    open_spool,
+)
+from app.tombstones import tombstone_compactor
+
+# Ordered startup of the app, run in the background so that the server
+# answers /health/live right away; /health/ready only succeeds once every
+# phase is done. Each phase is timed (GET /admin/startup).
+
+STARTUP_DB_RETRIES = int(os.environ.get("STARTUP_DB_RETRIES", 10))
+STARTUP_DB_RETRY_DELAY = float(os.environ.get("STARTUP_DB_RETRY_DELAY", 1))
+# Connections opened (and warmed up) per engine before being ready
+WARMUP_CONNECTIONS = int(os.environ.get("WARMUP_CONNECTIONS", 5))
+# API processes also consume the queue unless RUN_CONSUMER=false (when the
+# ingest runs in `python -m app.worker` processes). The history views are
+# refreshed by the processes that consume, unless overridden
+RUN_CONSUMER = os.environ.get("RUN_CONSUMER", "true").lower() == "true"
+RUN_HISTORY_REFRESHER = (
+    os.environ.get("RUN_HISTORY_REFRESHER", str(RUN_CONSUMER)).lower() == "true"
+)
+
+# Run once on every pooled connection, so asyncpg has them prepared and
+# SQLAlchemy has them compiled before the first request
+WARMUP_READ_STATEMENTS = tuple(
+    text(f"SELECT key, count, refreshed_at FROM {view_name(aggregate)}")
+    for aggregate in HISTORY_AGGREGATES
+) + (select(Entry).where(Entry.id == 0),)
+
+logger = logging.getLogger('app')
+
+
+class Startup:
+    def __init__(self):
+        self.phases = []
+        self.tasks = {}
+        self.ready = False
+        self.started_at = None
+        self.finished_at = None
+
+    @asynccontextmanager
+    async def phase(self, name: str):
+        record = {"name": name, "status": "running", "seconds": None}
+        self.phases.append(record)
+        started = time.perf_counter()
+        try:
+            yield record
+        except Exception as e:
+            record["status"] = "failed"
+            record["error"] = f"{type(e).__name__}: {e}"
+            logger.exception("Startup phase %s failed", name)
+            raise
+        else:
+            record["status"] = "done"
+        finally:
+            record["seconds"] = round(time.perf_counter() - started, 4)
+
+    async def _init_db(self, record: dict):
+        delay = STARTUP_DB_RETRY_DELAY
+        for attempt in range(1, STARTUP_DB_RETRIES + 1):
+            record["attempts"] = attempt
+            try:
+                await init_db()
+                return
+            except (OSError, asyncio.TimeoutError, DBAPIError) as e:
+                if attempt == STARTUP_DB_RETRIES:
+                    raise
+                logger.warning(
+                    "Could not connect to Postgres (%s), retrying in %.0fs", e, delay
+                )
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30)
+
+    async def run(self, api: bool = True):
+        """
+        Initializes the database, warms up the pools and caches and only then
+        starts the background tasks and the consumer. Worker processes
+        (api=False) don't serve requests: they skip the warm-up and the live
+        dashboard, and always consume
+        """
+        consumer = RUN_CONSUMER or not api
+        refresher = RUN_HISTORY_REFRESHER or not api
+        self.started_at = time.perf_counter()
+        try:
+            async with self.phase("database") as record:
+                await self._init_db(record)
+                # The entries stored before the route templates (the history
+                # aggregates filter on them)
+                record["path_templates"] = await backfill_path_templates()
+            async with self.phase("history_views"):
+                await init_history_views()
+            async with self.phase("data_versions") as record:
+                async with engine.begin() as conn:
+                    await data_versions.init(conn)
+                record["families"] = len(data_versions.versions)
+            async with self.phase("term_cache") as record:
+                async with async_session() as session:
+                    await terms.load(session)
+                record["terms"] = len(terms.ids)
+            if api and ANALYTICS_DIR:
+                async with self.phase("analytics") as record:
+                    async with engine.begin() as conn:
+                        await lock_schema(conn)
+                        await create_changelog(conn)
+                    mirror = open_mirror(ANALYTICS_DIR)
+                    record["mirror"] = mirror.path
+            if api and window_enabled():
+                async with self.phase("hot_window") as record:
+                    await hot_window.load()
+                    record["entries"] = hot_window.window.size
+            if api:
+                async with self.phase("warm_up"):
+                    await warm_up(engine, WARMUP_CONNECTIONS)
+                    if read_engine is not engine:
+                        await warm_up(read_engine, WARMUP_CONNECTIONS)
+            async with self.phase("background_tasks"):
+                self.tasks["data_versions"] = asyncio.create_task(data_versions.run())
+                self.tasks["user_bitmaps"] = asyncio.create_task(user_bitmaps.run())
+                if refresher:
+                    self.tasks["history_view_refresher"] = asyncio.create_task(
+                        history_view_refresher.run()
+                    )
+                    if RETENTION_DAYS:
+                        self.tasks["retention"] = asyncio.create_task(
+                            retention_job.run()
+                        )
+                    self.tasks["tombstone_compactor"] = asyncio.create_task(
+                        tombstone_compactor.run()
+                    )
+                if api:
+                    self.tasks["live_dashboard"] = asyncio.create_task(
+                        live_dashboard.run()
+                    )
+                    self.tasks["data_versions_listener"] = asyncio.create_task(
+                        data_versions.listen()
+                    )
+                    if window_enabled():
+                        self.tasks["hot_window"] = asyncio.create_task(
+                            hot_window.run(ingests=consumer)
+                        )
+                    if ANALYTICS_DIR:
+                        self.tasks["analytics_mirror"] = asyncio.create_task(
+                            mirror.run()
+                        )
+            if consumer:
+                async with self.phase("consumer") as record:
+                    if SPOOL_DIR:
+                        spool = open_spool(SPOOL_DIR)
+                        record["spool"] = spool.to_dict()
+                        ConsumerQueue.spool = spool
+                        self.tasks["spool"] = asyncio.create_task(spool.run())
+                        replayer = SpoolReplayer(spool, process_spooled)
+                        if FLOW_CONTROL:
+                            controller = FlowController(
+                                SPOOL_PREFETCH_COUNT, SPOOL_REPLAY_BATCH
+                            )
+                            controller.attach(replayer, update_prefetch)
+                            ConsumerQueue.flow_controller = controller
+                            self.tasks["flow_control"] = asyncio.create_task(
+                                controller.run(poll_queue_depth)
+                            )
+                        self.tasks["spool_replayer"] = asyncio.create_task(
+                            replayer.run()
+                        )
+                    self.tasks["consumer"] = asyncio.create_task(runConsumerQueue())
+        except Exception:
+            logger.error("Startup failed, the app won't be ready")
+            return
+        finally:
+            self.finished_at = time.perf_counter()
+            import_timer.stop()
+        self.ready = True
+        logger.info("Ready in %.2fs", self.finished_at - import_timer.started_at)
+
+    def to_dict(self, imports: int = 15) -> dict:
+        finished_at = self.finished_at or time.perf_counter()
+        return {
+            "ready": self.ready,
+            "total_seconds": round(finished_at - import_timer.started_at, 4),
+            "imports_seconds": round(import_timer.total, 4),
+            "phases": self.phases,
+            "tasks": sorted(self.tasks),
+            "slowest_imports": import_timer.top(imports),
+        }
+
+
+async def warm_up(target, connections: int):
+    """
+    Opens `connections` connections of the engine's pool at once and runs the
+    warm-up statements on each of them
+    """
+
+    async def warm_connection():
+        async with target.connect() as conn:
+            for statement in WARMUP_READ_STATEMENTS:
+                await conn.execute(statement)
+
+    await asyncio.gather(*(warm_connection() for _ in range(connections)))
+
+
+startup = Startup()
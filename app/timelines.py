@@ -0,0 +1,124 @@
+import base64
+import os
+from enum import Enum
+from typing import Optional
+import orjson
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.entry_storage import PUBLIC_ENTRY_COLUMNS
+
+# Activity timelines: every entry of a user or of a training, in time order,
+# one page at a time. Pages are cut with a keyset on (datetime, id) instead
+# of an OFFSET, and read from the (key, datetime, id) indexes of
+# entry_compact (see ENTRY_COMPACT_UPGRADES), so a page costs the same at
+# the start and at the end of the most active user's history. The action
+# filter is checked on the action_id the indexes include, without reading
+# the skipped rows from the table.
+#
+# Only the ids of the page are looked up on entry_compact; the page is then
+# decoded through the entry view.
+
+TIMELINE_PAGE_SIZE = int(os.environ.get("TIMELINE_PAGE_SIZE", 100))
+TIMELINE_MAX_PAGE_SIZE = int(os.environ.get("TIMELINE_MAX_PAGE_SIZE", 1000))
+
+
+class TimelineKey(str, Enum):
+    user_id = "user_id"
+    training_id = "training_id"
+
+
+class TimelineOrder(str, Enum):
+    asc = "asc"
+    desc = "desc"
+
+
+def encode_cursor(datetime: str, id: int) -> str:
+    """
+    Returns the opaque cursor of the page following the given entry
+    """
+    return base64.urlsafe_b64encode(orjson.dumps([datetime, id])).decode()
+
+
+def decode_cursor(cursor: str) -> tuple:
+    """
+    Returns the (datetime, id) of a cursor. Raises ValueError if it is not
+    one of ours
+    """
+    try:
+        datetime, id = orjson.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception:
+        raise ValueError(f"Invalid cursor: {cursor}")
+    if not isinstance(datetime, str) or not isinstance(id, int):
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return datetime, id
+
+
+def timeline_sql(
+    key: TimelineKey,
+    actions: bool = False,
+    after: bool = False,
+    order: TimelineOrder = TimelineOrder.asc,
+) -> str:
+    """
+    Returns the query of a timeline page (limit + 1 entries, to tell whether
+    there is a next one)
+    """
+    conditions = [f"{key.value} = :key"]
+    if key == TimelineKey.training_id:
+        # Lets the planner use the partial index
+        conditions.append("training_id <> ''")
+    # Deleted trainings, not compacted yet (see app/tombstones.py)
+    conditions.append(
+        "NOT EXISTS (SELECT 1 FROM training_tombstone d "
+        "WHERE d.training_id = entry_compact.training_id "
+        "AND entry_compact.id <= d.max_id)"
+    )
+    if actions:
+        conditions.append(
+            "action_id IN (SELECT id FROM entry_term "
+            "WHERE value = ANY(CAST(:actions AS text[])))"
+        )
+    if after:
+        comparison = ">" if order == TimelineOrder.asc else "<"
+        conditions.append(f"(datetime, id) {comparison} (:after_datetime, :after_id)")
+    direction = "" if order == TimelineOrder.asc else " DESC"
+    ordering = f"datetime{direction}, id{direction}"
+    return (
+        f"SELECT {', '.join(PUBLIC_ENTRY_COLUMNS)} FROM entry WHERE id IN ("
+        f"SELECT id FROM entry_compact WHERE {' AND '.join(conditions)} "
+        f"ORDER BY {ordering} LIMIT :limit) "
+        f"ORDER BY {ordering}"
+    )
+
+
+async def read_timeline(
+    session: AsyncSession,
+    key: TimelineKey,
+    value: str,
+    actions: tuple = (),
+    cursor: Optional[str] = None,
+    limit: int = TIMELINE_PAGE_SIZE,
+    order: TimelineOrder = TimelineOrder.asc,
+) -> dict:
+    """
+    Returns a page of the timeline of a user or training, and the cursor of
+    the next one (None on the last page)
+    """
+    params = {"key": value, "limit": limit + 1}
+    if actions:
+        params["actions"] = list(actions)
+    if cursor:
+        params["after_datetime"], params["after_id"] = decode_cursor(cursor)
+    result = await session.execute(
+        text(timeline_sql(key, bool(actions), bool(cursor), order)), params
+    )
+    rows = list(result)
+    following = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = dict(zip(PUBLIC_ENTRY_COLUMNS, rows[-1]))
+        following = encode_cursor(last["datetime"], last["id"])
+    return {
+        "entries": [dict(zip(PUBLIC_ENTRY_COLUMNS, row)) for row in rows],
+        "next": following,
+    }
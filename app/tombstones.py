@@ -0,0 +1,152 @@
+import asyncio
+import logging
+import os
+from typing import Optional
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.data_versions import data_versions
+from app.db import engine
+from app.history_views import history_view_refresher
+
+# Logical deletes of trainings: deleting a training only records a tombstone
+# (its id and the highest entry id at that moment), which the entry view
+# checks, so the deleted entries disappear from every read at once without
+# touching them in the ingest path. The history views are materialized: the
+# tombstone marks every aggregate family changed and refreshes them right
+# away instead of at the next scheduled refresh. The compactor then deletes
+# them from entry_compact in batches with a pause between them (using the
+# (training_id, datetime, id) index) and drops the tombstone when none is
+# left. Entries of the training stored after the delete stay visible.
+
+TOMBSTONE_COMPACT_INTERVAL_SECONDS = float(
+    os.environ.get("TOMBSTONE_COMPACT_INTERVAL_SECONDS", 30)
+)
+TOMBSTONE_BATCH_SIZE = int(os.environ.get("TOMBSTONE_BATCH_SIZE", 5000))
+TOMBSTONE_BATCH_DELAY = float(os.environ.get("TOMBSTONE_BATCH_DELAY", 0.5))
+
+# Only one process compacts at a time
+TOMBSTONE_LOCK_ID = 802_045
+
+ADD_TOMBSTONE = text(
+    """
+    INSERT INTO training_tombstone (training_id, max_id, deleted_at)
+    SELECT :training_id, coalesce(max(id), 0), now() FROM entry_compact
+    ON CONFLICT (training_id) DO UPDATE
+    SET max_id = excluded.max_id, deleted_at = excluded.deleted_at
+    """
+)
+TOMBSTONES = text(
+    "SELECT training_id, max_id FROM training_tombstone ORDER BY deleted_at"
+)
+DELETE_BATCH = text(
+    """
+    DELETE FROM entry_compact WHERE id IN (
+        SELECT id FROM entry_compact
+        WHERE training_id = :training_id AND training_id <> '' AND id <= :max_id
+        LIMIT :batch_size
+    )
+    """
+)
+# Unless the training was deleted again meanwhile (with a higher max_id)
+DROP_TOMBSTONE = text(
+    "DELETE FROM training_tombstone "
+    "WHERE training_id = :training_id AND max_id = :max_id"
+)
+
+logger = logging.getLogger('app')
+
+
+async def add_tombstone(training_id: str, session: AsyncSession):
+    """
+    Hides every stored entry of the training, and has the history views stop
+    counting them. Raises ValueError without a training id: the tombstone
+    would hide the entries of no training
+    """
+    if not training_id:
+        raise ValueError("A training id is required to delete its entries")
+    await session.execute(ADD_TOMBSTONE, {"training_id": training_id})
+    await session.commit()
+    # Any family: the entries of other services may carry the training id
+    data_versions.mark_changed()
+    history_view_refresher.refresh_now()
+
+
+async def compact_tombstone(
+    conn, training_id: str, max_id: int, batch_size: int, batch_delay: float
+) -> int:
+    """
+    Deletes the entries hidden by the tombstone, batch by batch, and then
+    the tombstone. Returns how many entries were deleted
+    """
+    params = {"training_id": training_id, "max_id": max_id}
+    deleted = 0
+    while True:
+        result = await conn.execute(DELETE_BATCH, {**params, "batch_size": batch_size})
+        deleted += result.rowcount
+        if result.rowcount < batch_size:
+            break
+        await asyncio.sleep(batch_delay)
+    await conn.execute(DROP_TOMBSTONE, params)
+    return deleted
+
+
+class TombstoneCompactor:
+    def __init__(self, interval: float, batch_size: int, batch_delay: float):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.deleted = 0
+        self.compacted = 0
+        self.runs = 0
+
+    async def run_once(self) -> Optional[int]:
+        """
+        Compacts every tombstone, unless another process is already doing
+        it. Returns the number of deleted entries (None if it didn't run)
+        """
+        deleted = 0
+        async with engine.connect() as conn:
+            conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+            locked = await conn.scalar(
+                text("SELECT pg_try_advisory_lock(:id)"), {"id": TOMBSTONE_LOCK_ID}
+            )
+            if not locked:
+                return None
+            try:
+                for training_id, max_id in (await conn.execute(TOMBSTONES)).all():
+                    batch = await compact_tombstone(
+                        conn, training_id, max_id, self.batch_size, self.batch_delay
+                    )
+                    deleted += batch
+                    self.deleted += batch
+                    self.compacted += 1
+            finally:
+                await conn.execute(
+                    text("SELECT pg_advisory_unlock(:id)"), {"id": TOMBSTONE_LOCK_ID}
+                )
+        self.runs += 1
+        return deleted
+
+    async def run(self):
+        while True:
+            try:
+                deleted = await self.run_once()
+                if deleted:
+                    logger.info("Compacted %d entries of deleted trainings", deleted)
+            except Exception as e:
+                logger.error("Could not compact the deleted trainings: %s", e)
+            await asyncio.sleep(self.interval)
+
+    def to_dict(self) -> dict:
+        return {
+            "runs": self.runs,
+            "compacted_tombstones": self.compacted,
+            "deleted": self.deleted,
+        }
+
+
+tombstone_compactor = TombstoneCompactor(
+    TOMBSTONE_COMPACT_INTERVAL_SECONDS,
+    TOMBSTONE_BATCH_SIZE,
+    TOMBSTONE_BATCH_DELAY,
+)
@@ -0,0 +1,125 @@
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import time
+from logging.config import dictConfig
+from dotenv import load_dotenv
+from app.consumer.consumer_queue import ConsumerQueue
+from app.log_config import LOG_QUEUE_SIZE, LOG_SAMPLING, logconfig
+from app.log_pipeline import (
+    parse_sampling_rules,
+    start_queue_logging,
+    stop_queue_logging,
+)
+from app.startup import startup
+
+# Ingest worker: runs the queue consumer (and the history views refresher)
+# without the HTTP API, in N processes, so that consumers and API workers
+# (started with RUN_CONSUMER=false) scale independently.
+#
+# Usage: python -m app.worker [--processes N]
+
+WORKER_PROCESSES = int(os.environ.get("WORKER_PROCESSES", 1))
+# Seconds given to the consumer to cancel and close its connection
+WORKER_SHUTDOWN_TIMEOUT = float(os.environ.get("WORKER_SHUTDOWN_TIMEOUT", 10))
+# A worker that exits is restarted, at most once per this many seconds
+WORKER_RESTART_DELAY = float(os.environ.get("WORKER_RESTART_DELAY", 5))
+
+logger = logging.getLogger('app')
+
+
+async def run_worker():
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stopping.set)
+
+    await startup.run(api=False)
+    if not startup.ready:
+        raise SystemExit(1)
+    consumer = startup.tasks["consumer"]
+    await asyncio.wait(
+        {consumer, asyncio.create_task(stopping.wait())},
+        return_when=asyncio.FIRST_COMPLETED,
+    )
+    if consumer.done():
+        logger.error("The consumer stopped unexpectedly")
+        raise SystemExit(1)
+
+    logger.info("Stopping worker %d", os.getpid())
+    if ConsumerQueue.instance is not None:
+        ConsumerQueue.instance.stop()
+    try:
+        await asyncio.wait_for(consumer, WORKER_SHUTDOWN_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning("The consumer didn't stop in time")
+
+
+def worker_process():
+    """
+    Entry point of each worker process
+    """
+    load_dotenv()
+    dictConfig(logconfig)
+    start_queue_logging('app', parse_sampling_rules(LOG_SAMPLING), LOG_QUEUE_SIZE)
+    try:
+        asyncio.run(run_worker())
+    finally:
+        stop_queue_logging()
+
+
+def supervise(processes: int):
+    """
+    Starts the worker processes, restarts the ones that exit and stops them
+    all on SIGTERM or SIGINT
+    """
+    context = multiprocessing.get_context("spawn")
+    workers = {}
+    started_at = {}
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for worker in workers.values():
+            if worker.is_alive():
+                worker.terminate()  # SIGTERM: the worker stops gracefully
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while not stopping:
+        for index in range(processes):
+            worker = workers.get(index)
+            if worker is not None:
+                if worker.is_alive():
+                    continue
+                logger.warning("Worker %d exited with %s", worker.pid, worker.exitcode)
+                del workers[index]
+            if time.monotonic() - started_at.get(index, -WORKER_RESTART_DELAY) < (
+                WORKER_RESTART_DELAY
+            ):
+                continue
+            worker = context.Process(target=worker_process, name=f"worker-{index}")
+            worker.start()
+            workers[index] = worker
+            started_at[index] = time.monotonic()
+            logger.info("Started worker %d (%d/%d)", worker.pid, index + 1, processes)
+        time.sleep(0.5)
+
+    for worker in workers.values():
+        worker.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the ingest workers")
+    parser.add_argument("--processes", type=int, default=WORKER_PROCESSES)
+    args = parser.parse_args()
+    if args.processes == 1:
+        worker_process()
+    else:
+        dictConfig(logconfig)
+        supervise(args.processes)
@@ -0,0 +1,155 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+# Compares computing every /history aggregate on Postgres (the query behind
+# its materialized view) and on the DuckDB analytics mirror, and times the
+# initial copy of the mirror and an incremental sync.
+#
+# Usage: BENCHMARK_DATABASE_URL=... python -m benchmarks.bench_analytics \
+#            [--rows 10000000] [--runs 5] [--output results.json]
+#
+# Needs the bench and analytics extras. The database is truncated and
+# re-seeded: never point it to a database you care about.
+
+BENCHMARK_DATABASE_URL = os.environ.get("BENCHMARK_DATABASE_URL")
+if not BENCHMARK_DATABASE_URL:
+    sys.exit("BENCHMARK_DATABASE_URL is not set")
+# app.db reads DATABASE_URL on import
+os.environ["DATABASE_URL"] = BENCHMARK_DATABASE_URL
+os.environ.pop("DATABASE_READ_URL", None)
+
+from sqlalchemy import text  # noqa: E402
+from app.aggregates import HISTORY_AGGREGATES  # noqa: E402
+from app.analytics import AnalyticsMirror, create_changelog  # noqa: E402
+from app.db import engine, init_db  # noqa: E402
+from benchmarks.bench_queries import (  # noqa: E402
+    BENCH_ENTRY,
+    RESULTS_DIR,
+    git_revision,
+    measure,
+)
+from benchmarks.seed import seed  # noqa: E402
+
+DEFAULT_ROWS = 10000000
+SYNC_ENTRIES = 1000
+
+
+async def add_sync_entries():
+    """
+    Inserts entries and updates as many, for the incremental sync
+    """
+    columns = ", ".join(BENCH_ENTRY)
+    values = ", ".join(f":{column}" for column in BENCH_ENTRY)
+    async with engine.begin() as conn:
+        await conn.execute(
+            text(f"INSERT INTO entry ({columns}) VALUES ({values})"),
+            [BENCH_ENTRY] * SYNC_ENTRIES,
+        )
+        await conn.execute(
+            text(
+                "UPDATE entry_compact SET user_id = user_id WHERE id IN "
+                "(SELECT id FROM entry_compact ORDER BY id LIMIT :count)"
+            ),
+            {"count": SYNC_ENTRIES},
+        )
+
+
+async def main(rows: int, runs: int, output: Path):
+    await init_db()
+    async with engine.begin() as conn:
+        await create_changelog(conn)
+    seconds = await seed(BENCHMARK_DATABASE_URL, rows, truncate=True)
+    print(f"[{rows} rows] seeded in {seconds:.1f}s")
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        mirror = AnalyticsMirror(
+            sync_interval=0,
+            batch_size=1000000,
+            lookback=10000,
+            change_retention=86400,
+            threads=4,
+        )
+        mirror.open(os.path.join(directory, "bench.duckdb"))
+
+        started = time.perf_counter()
+        await mirror.sync()
+        initial = time.perf_counter() - started
+        await add_sync_entries()
+        started = time.perf_counter()
+        await mirror.sync()
+        incremental = time.perf_counter() - started
+        results.append(
+            {
+                "rows": rows,
+                "initial_sync_s": round(initial, 3),
+                f"incremental_sync_{SYNC_ENTRIES}_s": round(incremental, 3),
+                "mirror_bytes": os.path.getsize(mirror.path),
+            }
+        )
+        print(
+            f"[{rows} rows] mirror copied in {initial:.1f}s, "
+            f"synced {SYNC_ENTRIES} inserts and updates in {incremental:.3f}s"
+        )
+
+        for aggregate in HISTORY_AGGREGATES:
+            query = aggregate.all_time_sql()
+
+            async def on_postgres(session, query=text(query)):
+                return (await session.execute(query)).all()
+
+            async def on_duckdb(session, query=query):
+                return await mirror.query(query)
+
+            for backend, target in (("postgres", on_postgres), ("duckdb", on_duckdb)):
+                stats = await measure(target, runs)
+                results.append(
+                    {
+                        "rows": rows,
+                        "backend": backend,
+                        "target": aggregate.name,
+                        **stats,
+                    }
+                )
+                print(
+                    f"[{rows} rows] {backend:8} {aggregate.name:35} "
+                    f"median {stats['median_ms']} ms"
+                )
+        mirror.db.close()
+    await engine.dispose()
+
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(
+        json.dumps(
+            {
+                "benchmark": "analytics",
+                "revision": git_revision(),
+                "created_at": datetime.utcnow().isoformat(),
+                "results": results,
+            },
+            indent=2,
+        )
+    )
+    print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the history aggregates on Postgres and DuckDB"
+    )
+    parser.add_argument("--rows", type=int, default=DEFAULT_ROWS)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument(
+        "--output",
+        type=Path,
+        default=RESULTS_DIR / f"analytics-{datetime.utcnow():%Y%m%d-%H%M%S}.json",
+    )
+    args = parser.parse_args()
+    asyncio.run(main(args.rows, args.runs, args.output))
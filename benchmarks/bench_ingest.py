@@ -0,0 +1,181 @@
+import argparse
+import asyncio
+import gzip
+import json
+import os
+import sys
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+# Compares the ingest throughput of single-event messages and of batches
+# (JSON arrays and NDJSON, plain, gzip and zstd), stored through
+# MessageQueueWrapper with the consumer's concurrency (one task per
+# message, at most --prefetch of them at a time). The broker isn't part of
+# it: its per-message framing and acks only widen the gap.
+#
+# Usage: BENCHMARK_DATABASE_URL=... python -m benchmarks.bench_ingest \
+#            [--events 100000] [--batch-sizes 1 100 1000] [--output results.json]
+#
+# The entries table is truncated before each run: never point it to a
+# database you care about.
+
+BENCHMARK_DATABASE_URL = os.environ.get("BENCHMARK_DATABASE_URL")
+if not BENCHMARK_DATABASE_URL:
+    sys.exit("BENCHMARK_DATABASE_URL is not set")
+# app.db reads DATABASE_URL on import
+os.environ["DATABASE_URL"] = BENCHMARK_DATABASE_URL
+os.environ.pop("DATABASE_READ_URL", None)
+
+import orjson  # noqa: E402
+from pika import BasicProperties  # noqa: E402
+from sqlalchemy import text  # noqa: E402
+from app.consumer.message_queue_wrapper import MessageQueueWrapper  # noqa: E402
+from app.db import engine, init_db  # noqa: E402
+from benchmarks.bench_queries import (  # noqa: E402
+    BENCH_ENTRY,
+    RESULTS_DIR,
+    git_revision,
+)
+
+DEFAULT_EVENTS = 100000
+DEFAULT_BATCH_SIZES = (1, 100, 1000)
+DEFAULT_PREFETCH = 100
+
+
+def as_array(events: list) -> bytes:
+    return orjson.dumps(events)
+
+
+def as_ndjson(events: list) -> bytes:
+    return b"\n".join(orjson.dumps(event) for event in events)
+
+
+def encodings() -> dict:
+    """
+    Returns the body encoders of a batch, by name: (encode, content_encoding)
+    """
+    variants = {
+        "array": (as_array, None),
+        "ndjson": (as_ndjson, None),
+        "array+gzip": (lambda events: gzip.compress(as_array(events)), "gzip"),
+    }
+    try:
+        import zstandard
+    except ImportError:
+        print("zstandard is not installed (poetry install -E zstd): skipping zstd")
+    else:
+        compressor = zstandard.ZstdCompressor()
+        variants["array+zstd"] = (
+            lambda events: compressor.compress(as_array(events)),
+            "zstd",
+        )
+    return variants
+
+
+def make_events(count: int) -> list:
+    return [{**BENCH_ENTRY, "user_id": f"bench-user-{i % 5000}"} for i in range(count)]
+
+
+async def ingest(messages: list, prefetch: int) -> float:
+    """
+    Stores (body, content_encoding) messages as the consumer does. Returns
+    the elapsed seconds
+    """
+    window = asyncio.Semaphore(prefetch)
+
+    async def deliver(body, content_encoding):
+        properties = BasicProperties(
+            message_id=uuid.uuid4().hex, content_encoding=content_encoding
+        )
+        async with window:
+            await MessageQueueWrapper(None, None, properties, body)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(deliver(body, encoding) for body, encoding in messages))
+    return time.perf_counter() - started
+
+
+async def stored() -> int:
+    async with engine.begin() as conn:
+        return await conn.scalar(text("SELECT count(*) FROM entry_compact"))
+
+
+async def run(name: str, messages: list, events: int, prefetch: int) -> dict:
+    async with engine.begin() as conn:
+        await conn.execute(text("TRUNCATE entry_compact"))
+    seconds = await ingest(messages, prefetch)
+    count = await stored()
+    if count != events:
+        print(f"{name}: stored {count} of {events} events")
+    body_bytes = sum(len(body) for body, _ in messages)
+    return {
+        "variant": name,
+        "messages": len(messages),
+        "events": events,
+        "seconds": round(seconds, 3),
+        "events_per_second": round(events / seconds),
+        "bytes_per_event": round(body_bytes / events, 1),
+    }
+
+
+async def main(events: int, batch_sizes, prefetch: int, output: Path):
+    await init_db()
+    data = make_events(events)
+    results = []
+    for batch_size in batch_sizes:
+        if batch_size == 1:
+            variants = {"single": [(orjson.dumps(event), None) for event in data]}
+        else:
+            batches = [
+                data[start : start + batch_size]
+                for start in range(0, events, batch_size)
+            ]
+            variants = {
+                f"{name} x{batch_size}": [
+                    (encode(batch), encoding) for batch in batches
+                ]
+                for name, (encode, encoding) in encodings().items()
+            }
+        for name, messages in variants.items():
+            result = await run(name, messages, events, prefetch)
+            results.append(result)
+            print(
+                f"{name:20} {result['events_per_second']:>9} events/s "
+                f"{result['bytes_per_event']:>7} bytes/event"
+            )
+    await engine.dispose()
+
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(
+        json.dumps(
+            {
+                "benchmark": "ingest",
+                "revision": git_revision(),
+                "created_at": datetime.utcnow().isoformat(),
+                "prefetch": prefetch,
+                "results": results,
+            },
+            indent=2,
+        )
+    )
+    print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the ingest of single-event and batched messages"
+    )
+    parser.add_argument("--events", type=int, default=DEFAULT_EVENTS)
+    parser.add_argument(
+        "--batch-sizes", type=int, nargs="+", default=DEFAULT_BATCH_SIZES
+    )
+    parser.add_argument("--prefetch", type=int, default=DEFAULT_PREFETCH)
+    parser.add_argument(
+        "--output",
+        type=Path,
+        default=RESULTS_DIR / f"ingest-{datetime.utcnow():%Y%m%d-%H%M%S}.json",
+    )
+    args = parser.parse_args()
+    asyncio.run(main(args.events, args.batch_sizes, args.prefetch, args.output))
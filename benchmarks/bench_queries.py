@@ -0,0 +1,281 @@
+import argparse
+import asyncio
+import inspect
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+# Benchmarks every function of app/entries_utils.py and every handler of
+# app/api/history.py (plus the raw aggregate query and the refresh of each
+# materialized view behind it) at several table sizes.
+#
+# Usage: BENCHMARK_DATABASE_URL=... python -m benchmarks.bench_queries \
+#            [--sizes 10000 1000000 10000000] [--runs 5] [--output results.json]
+#
+# The database is truncated and re-seeded for every size: never point it to
+# a database you care about.
+
+BENCHMARK_DATABASE_URL = os.environ.get("BENCHMARK_DATABASE_URL")
+if not BENCHMARK_DATABASE_URL:
+    sys.exit("BENCHMARK_DATABASE_URL is not set")
+# app.db reads DATABASE_URL on import
+os.environ["DATABASE_URL"] = BENCHMARK_DATABASE_URL
+os.environ.pop("DATABASE_READ_URL", None)
+
+from sqlalchemy import text  # noqa: E402
+from starlette.requests import Request  # noqa: E402
+from app import entries_utils  # noqa: E402
+from app.aggregates import HISTORY_AGGREGATES  # noqa: E402
+from app.api import history  # noqa: E402
+from app.db import async_session, engine, init_db  # noqa: E402
+from app.history_views import init_history_views, view_name  # noqa: E402
+from app.models import EntryCreate, EntryUpdate  # noqa: E402
+from benchmarks.seed import seed  # noqa: E402
+
+RESULTS_DIR = Path(__file__).parent / "results"
+DEFAULT_SIZES = (10000, 1000000, 10000000)
+# The history handlers are timed without If-None-Match, so they always query
+NO_HEADERS = Request({"type": "http", "headers": []})
+
+BENCH_ENTRY = {
+    "service": "user-service",
+    "path": "/signup/",
+    "url": "https://user-service.fiufit.com/signup/",
+    "method": "POST",
+    "status_code": 200,
+    "datetime": "2023-06-30 12:00:00",
+    "response_time": 0.1,
+    "user_id": "bench-user",
+    "ip": "10.0.0.1",
+    "country": "Argentina",
+    "action": "signup",
+    "training_id": "bench-training",
+    "training_type": "running",
+}
+
+
+async def measure(target, runs: int, setup=None) -> dict:
+    """
+    Runs `target(session)` `runs` times, each one in a fresh session after
+    the optional `setup(session)`, and returns timing statistics in ms
+    """
+    timings = []
+    for _ in range(runs):
+        async with async_session() as session:
+            if setup is not None:
+                await setup(session)
+            started = time.perf_counter()
+            await target(session)
+            timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return {
+        "runs": runs,
+        "min_ms": round(timings[0], 3),
+        "median_ms": round(statistics.median(timings), 3),
+        "p95_ms": round(timings[min(len(timings) - 1, int(0.95 * len(timings)))], 3),
+        "max_ms": round(timings[-1], 3),
+    }
+
+
+async def add_bench_entry(session, **overrides):
+    entry = await entries_utils.add_db_entry(
+        EntryCreate(**{**BENCH_ENTRY, **overrides}), session
+    )
+    return entry.id
+
+
+def entries_utils_targets(max_full_scan_rows: int, rows: int) -> dict:
+    """
+    (setup, target) pairs for every function of entries_utils. Destructive
+    functions get their own rows inserted by the setup
+    """
+    state = {}
+
+    async def insert_one(session):
+        state["id"] = await add_bench_entry(session)
+
+    async def insert_signup(session):
+        # update_db_entry_location expects a single signup per user
+        state["user_id"] = f"bench-located-user-{state.get('runs', 0)}"
+        state["runs"] = state.get("runs", 0) + 1
+        await add_bench_entry(session, user_id=state["user_id"])
+
+    async def insert_training(session):
+        for _ in range(10):
+            await add_bench_entry(session, training_id="bench-deleted-training")
+
+    targets = {
+        "add_db_entry": (
+            None,
+            lambda s: entries_utils.add_db_entry(EntryCreate(**BENCH_ENTRY), s),
+        ),
+        "add_db_entries[100]": (
+            None,
+            lambda s: entries_utils.add_db_entries(
+                [EntryCreate(**BENCH_ENTRY)] * 100, s
+            ),
+        ),
+        "get_db_entry_by_id": (
+            insert_one,
+            lambda s: entries_utils.get_db_entry_by_id(state["id"], s),
+        ),
+        "update_db_entry": (
+            insert_one,
+            lambda s: entries_utils.update_db_entry(
+                state["id"], EntryUpdate(user_id="bench-user", country="Chile"), s
+            ),
+        ),
+        "delete_db_entry": (
+            insert_one,
+            lambda s: entries_utils.delete_db_entry(state["id"], s),
+        ),
+        "update_db_entry_location": (
+            insert_signup,
+            lambda s: entries_utils.update_db_entry_location(
+                state["user_id"], "Uruguay", s
+            ),
+        ),
+        "delete_db_entry_by_user_and_action": (
+            lambda s: add_bench_entry(s, user_id="bench-blocked-user", action="block"),
+            lambda s: entries_utils.delete_db_entry_by_user_and_action(
+                "bench-blocked-user", "block", s
+            ),
+        ),
+        "delete_db_entry_by_training_and_action": (
+            lambda s: add_bench_entry(
+                s, training_id="bench-fav-training", action="add_training_to_favs"
+            ),
+            lambda s: entries_utils.delete_db_entry_by_training_and_action(
+                "bench-fav-training", "add_training_to_favs", s
+            ),
+        ),
+        "delete_db_all_entries_with_training_id": (
+            insert_training,
+            lambda s: entries_utils.delete_db_all_entries_with_training_id(
+                "bench-deleted-training", s
+            ),
+        ),
+    }
+    # Full table scans: skipped for the big sizes
+    if rows <= max_full_scan_rows:
+        targets["get_db_entries"] = (None, entries_utils.get_db_entries)
+        targets["get_db_entries_rows"] = (None, entries_utils.get_db_entries_rows)
+        targets["delete_all_db_entries"] = (None, entries_utils.delete_all_db_entries)
+    return targets
+
+
+def history_targets() -> dict:
+    targets = {}
+    for name in dir(history):
+        handler = getattr(history, name)
+        # The handlers of the materialized views (not the funnels)
+        if (
+            name.startswith("get_")
+            and asyncio.iscoroutinefunction(handler)
+            and "request" in inspect.signature(handler).parameters
+        ):
+            targets[name] = lambda s, handler=handler: handler(
+                request=NO_HEADERS, session=s
+            )
+    return targets
+
+
+def aggregate_targets() -> dict:
+    targets = {}
+    for aggregate in HISTORY_AGGREGATES:
+        query = text(aggregate.sql(encoded=True))
+        refresh = text(f"REFRESH MATERIALIZED VIEW {view_name(aggregate)}")
+
+        async def run(session, query=query):
+            return (await session.execute(query)).all()
+
+        async def run_refresh(session, refresh=refresh):
+            await session.execute(refresh)
+            await session.commit()
+
+        targets[f"{aggregate.name}:query"] = run
+        targets[f"{aggregate.name}:refresh"] = run_refresh
+    return targets
+
+
+async def run_size(rows: int, runs: int, max_full_scan_rows: int) -> list:
+    seconds = await seed(BENCHMARK_DATABASE_URL, rows, truncate=True)
+    print(f"[{rows} rows] seeded in {seconds:.1f}s")
+    await init_history_views()
+
+    results = []
+
+    async def record(kind, name, target, setup=None):
+        stats = await measure(target, runs, setup)
+        results.append({"rows": rows, "kind": kind, "target": name, **stats})
+        print(f"[{rows} rows] {kind:13} {name:45} median {stats['median_ms']} ms")
+
+    for name, target in aggregate_targets().items():
+        await record("aggregate", name, target)
+    for name, target in history_targets().items():
+        await record("history", name, target)
+    targets = entries_utils_targets(max_full_scan_rows, rows)
+    # delete_all_db_entries wipes the table, so it goes last
+    delete_all = targets.pop("delete_all_db_entries", None)
+    for name, (setup, target) in targets.items():
+        await record("entries_utils", name, target, setup)
+    if delete_all is not None:
+        await record("entries_utils", "delete_all_db_entries", delete_all[1])
+    for name in ("get_db_entries", "get_db_entries_rows", "delete_all_db_entries"):
+        if rows > max_full_scan_rows:
+            results.append(
+                {"rows": rows, "kind": "entries_utils", "target": name, "skipped": True}
+            )
+    return results
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+async def main(sizes, runs: int, max_full_scan_rows: int, output: Path):
+    await init_db()
+    results = []
+    for rows in sizes:
+        results.extend(await run_size(rows, runs, max_full_scan_rows))
+    await engine.dispose()
+
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(
+        json.dumps(
+            {
+                "benchmark": "queries",
+                "revision": git_revision(),
+                "created_at": datetime.utcnow().isoformat(),
+                "results": results,
+            },
+            indent=2,
+        )
+    )
+    print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark entries and history queries"
+    )
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--max-full-scan-rows", type=int, default=1000000)
+    parser.add_argument(
+        "--output",
+        type=Path,
+        default=RESULTS_DIR / f"queries-{datetime.utcnow():%Y%m%d-%H%M%S}.json",
+    )
+    args = parser.parse_args()
+    asyncio.run(main(args.sizes, args.runs, args.max_full_scan_rows, args.output))
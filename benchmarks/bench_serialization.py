@@ -0,0 +1,130 @@
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import time
+from datetime import datetime
+from pathlib import Path
+
+# Compares the serialization of large /entries and /history responses: the
+# previous path (response_model validation of every row, jsonable_encoder
+# and json.dumps) against orjson over the row tuples, as objects and as
+# column arrays. No database needed.
+#
+# Usage: python -m benchmarks.bench_serialization [--rows 1000 100000] [--runs 5]
+
+os.environ.setdefault("DATABASE_URL", "postgresql+asyncpg://localhost/unused")
+
+import numpy as np  # noqa: E402
+from fastapi.responses import JSONResponse  # noqa: E402
+from fastapi.routing import serialize_response  # noqa: E402
+from fastapi.utils import create_response_field  # noqa: E402
+from app.models import Entry  # noqa: E402
+from app.serialization import (  # noqa: E402
+    FastJSONResponse,
+    ResponseFormat,
+    rows_response,
+)
+from benchmarks.seed import generate  # noqa: E402
+
+RESULTS_DIR = Path(__file__).parent / "results"
+DEFAULT_ROWS = (1000, 100000)
+
+
+def entry_rows(rows: int):
+    columns = generate(np.random.default_rng(42), rows, rows // 20 + 1, 50, 6)
+    columns["id"] = list(range(1, rows + 1))
+    names = [name for name in Entry.__table__.columns.keys()]
+    return names, list(zip(*(columns[name] for name in names)))
+
+
+async def legacy_entries(names, rows):
+    objects = [Entry(**dict(zip(names, row))) for row in rows]
+    field = create_response_field(name="response", type_=list[Entry])
+    content = await serialize_response(field=field, response_content=objects)
+    return JSONResponse(content).body
+
+
+async def legacy_history(counts: dict):
+    field = create_response_field(name="response", type_=dict)
+    content = await serialize_response(field=field, response_content=counts)
+    return JSONResponse(content).body
+
+
+async def measure(target, runs: int) -> dict:
+    timings = []
+    size = 0
+    for _ in range(runs):
+        started = time.perf_counter()
+        body = await target()
+        timings.append((time.perf_counter() - started) * 1000)
+        size = len(body)
+    return {
+        "runs": runs,
+        "min_ms": round(min(timings), 3),
+        "median_ms": round(statistics.median(timings), 3),
+        "max_ms": round(max(timings), 3),
+        "bytes": size,
+    }
+
+
+async def main(sizes, runs: int, output: Path):
+    results = []
+    for rows in sizes:
+        names, entries = entry_rows(rows)
+        user_counts = {f"user-{i}": i % 97 for i in range(rows)}
+        user_rows = list(user_counts.items())
+
+        async def as_rows():
+            return rows_response(names, entries).body
+
+        async def as_columns():
+            return rows_response(names, entries, ResponseFormat.columnar).body
+
+        async def history_orjson():
+            return FastJSONResponse({key: count for key, count in user_rows}).body
+
+        async def history_columns():
+            return rows_response(
+                ("key", "count"), user_rows, ResponseFormat.columnar
+            ).body
+
+        targets = {
+            "entries:response_model": lambda: legacy_entries(names, entries),
+            "entries:orjson_rows": as_rows,
+            "entries:orjson_columnar": as_columns,
+            "history_by_user:response_model": lambda: legacy_history(user_counts),
+            "history_by_user:orjson": history_orjson,
+            "history_by_user:orjson_columnar": history_columns,
+        }
+        for name, target in targets.items():
+            stats = await measure(target, runs)
+            results.append({"rows": rows, "target": name, **stats})
+            print(f"[{rows} rows] {name:35} median {stats['median_ms']} ms")
+
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(
+        json.dumps(
+            {
+                "benchmark": "serialization",
+                "created_at": datetime.utcnow().isoformat(),
+                "results": results,
+            },
+            indent=2,
+        )
+    )
+    print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark response serialization")
+    parser.add_argument("--rows", type=int, nargs="+", default=DEFAULT_ROWS)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument(
+        "--output",
+        type=Path,
+        default=RESULTS_DIR / f"serialization-{datetime.utcnow():%Y%m%d-%H%M%S}.json",
+    )
+    args = parser.parse_args()
+    asyncio.run(main(args.rows, args.runs, args.output))
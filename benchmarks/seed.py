@@ -0,0 +1,198 @@
+import argparse
+import asyncio
+import os
+import time
+import asyncpg
+import numpy as np
+
+# Bulk seeding tool for benchmarks: generates a realistic, reproducible
+# distribution of entries (Zipf-skewed users and trainings, weighted
+# countries and actions, months of timestamps) and loads it with COPY.
+#
+# Usage: python -m benchmarks.seed --rows 1000000 [--seed 42] [--truncate]
+#
+# The database must already have the schema (start the app once, or run
+# app.db.init_db). BENCHMARK_DATABASE_URL points to it.
+
+BENCHMARK_DATABASE_URL = os.environ.get("BENCHMARK_DATABASE_URL")
+CHUNK_SIZE = 250000
+
+# (service, action, path template, method, weight)
+ACTIONS = (
+    ("user-service", "login", "/login/", "POST", 0.30),
+    ("user-service", "google_login", "/login/google/", "POST", 0.08),
+    ("user-service", "signup", "/signup/", "POST", 0.04),
+    ("user-service", "google_signup", "/signup/google/", "POST", 0.01),
+    ("user-service", "password_reset", "/login/forgot_password", "POST", 0.01),
+    ("user-service", "user_edit", "/users/{user_id}", "PATCH", 0.05),
+    ("user-service", "block", "/users/{user_id}/block", "PATCH", 0.005),
+    (
+        "user-service",
+        "add_training_to_favs",
+        "/users/{user_id}/trainings/favorites",
+        "POST",
+        0.20,
+    ),
+    ("training-service", "new_training", "/trainings/", "POST", 0.12),
+    (
+        "training-service",
+        "media_upload",
+        "/trainings/{training_id}/media",
+        "PATCH",
+        0.175,
+    ),
+)
+COUNTRIES = (
+    ("Argentina", 0.50),
+    ("Brasil", 0.12),
+    ("Chile", 0.08),
+    ("Uruguay", 0.06),
+    ("Mexico", 0.05),
+    ("Colombia", 0.04),
+    ("", 0.15),
+)
+TRAINING_TYPES = (
+    ("running", 0.4),
+    ("cycling", 0.25),
+    ("swimming", 0.15),
+    ("yoga", 0.2),
+)
+STATUS_CODES = ((200, 0.8), (201, 0.1), (400, 0.05), (404, 0.03), (500, 0.02))
+
+ENCODED_COLUMNS = (
+    "service",
+    "path",
+    "url",
+    "method",
+    "country",
+    "action",
+    "training_type",
+    "path_template",
+)
+COPY_COLUMNS = (
+    "status_code",
+    "datetime",
+    "response_time",
+    "user_id",
+    "ip",
+    "training_id",
+) + tuple(f"{column}_id" for column in ENCODED_COLUMNS)
+
+
+def _weighted(rng, choices, size):
+    values, weights = zip(*choices)
+    weights = np.array(weights) / sum(weights)
+    return rng.choice(len(values), size=size, p=weights), values
+
+
+def generate(rng, size: int, users: int, trainings: int, months: int) -> dict:
+    """
+    Returns the columns of `size` random entries, as lists
+    """
+    action_idx, _ = _weighted(rng, [(a, a[-1]) for a in ACTIONS], size)
+    country_idx, countries = _weighted(rng, COUNTRIES, size)
+    type_idx, types = _weighted(rng, TRAINING_TYPES, size)
+    status_idx, statuses = _weighted(rng, STATUS_CODES, size)
+
+    user_ids = (rng.zipf(1.3, size) - 1) % users
+    training_ids = (rng.zipf(1.5, size) - 1) % trainings
+    end = np.datetime64("2023-07-01T00:00:00")
+    seconds = rng.integers(0, months * 30 * 86400, size)
+    timestamps = np.datetime_as_string(end - seconds.astype("timedelta64[s]"), unit="s")
+    ips = rng.integers(0, 2**32, size, dtype=np.uint64)
+
+    columns = {
+        column: []
+        for column in ("service", "path", "path_template", "url", "method", "action")
+    }
+    for i, (u, t) in zip(
+        action_idx.tolist(), zip(user_ids.tolist(), training_ids.tolist())
+    ):
+        service, action, template, method, _ = ACTIONS[i]
+        path = template.format(user_id=f"user-{u}", training_id=f"training-{t}")
+        columns["service"].append(service)
+        columns["path"].append(path)
+        columns["path_template"].append(template)
+        columns["url"].append(f"https://{service}.fiufit.com{path}")
+        columns["method"].append(method)
+        columns["action"].append(action)
+
+    columns["country"] = [countries[i] for i in country_idx.tolist()]
+    columns["training_type"] = [types[i] for i in type_idx.tolist()]
+    columns["status_code"] = [statuses[i] for i in status_idx.tolist()]
+    columns["datetime"] = [ts.replace("T", " ") for ts in timestamps.tolist()]
+    columns["response_time"] = np.round(rng.lognormal(-2.5, 0.8, size), 4).tolist()
+    columns["user_id"] = [f"user-{u}" for u in user_ids.tolist()]
+    columns["ip"] = [
+        f"{ip >> 24}.{ip >> 16 & 255}.{ip >> 8 & 255}.{ip & 255}" for ip in ips.tolist()
+    ]
+    columns["training_id"] = [
+        f"training-{t}" if service == "training-service" else ""
+        for t, service in zip(training_ids.tolist(), columns["service"])
+    ]
+    return columns
+
+
+async def resolve_terms(conn, values) -> dict:
+    await conn.execute(
+        "INSERT INTO entry_term (value) SELECT unnest($1::text[]) "
+        "ON CONFLICT (value) DO NOTHING",
+        list(values),
+    )
+    rows = await conn.fetch(
+        "SELECT id, value FROM entry_term WHERE value = ANY($1::text[])", list(values)
+    )
+    return {row["value"]: row["id"] for row in rows}
+
+
+async def seed(
+    url: str,
+    rows: int,
+    random_seed: int = 42,
+    months: int = 6,
+    truncate: bool = False,
+) -> float:
+    """
+    Loads `rows` random entries into entry_compact, returns the seconds taken
+    """
+    rng = np.random.default_rng(random_seed)
+    users = max(100, rows // 20)
+    trainings = max(50, rows // 100)
+    started = time.perf_counter()
+
+    conn = await asyncpg.connect(url.replace("postgresql+asyncpg", "postgresql"))
+    try:
+        if truncate:
+            await conn.execute("TRUNCATE entry_compact")
+        for start in range(0, rows, CHUNK_SIZE):
+            columns = generate(
+                rng, min(CHUNK_SIZE, rows - start), users, trainings, months
+            )
+            terms = await resolve_terms(
+                conn, set().union(*(columns[column] for column in ENCODED_COLUMNS))
+            )
+            for column in ENCODED_COLUMNS:
+                columns[f"{column}_id"] = [terms[value] for value in columns[column]]
+            await conn.copy_records_to_table(
+                "entry_compact",
+                records=zip(*(columns[column] for column in COPY_COLUMNS)),
+                columns=COPY_COLUMNS,
+            )
+        await conn.execute("ANALYZE entry_compact")
+    finally:
+        await conn.close()
+    return time.perf_counter() - started
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Seed entry_compact with COPY")
+    parser.add_argument("--rows", type=int, required=True)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--months", type=int, default=6)
+    parser.add_argument("--truncate", action="store_true")
+    parser.add_argument("--url", default=BENCHMARK_DATABASE_URL)
+    args = parser.parse_args()
+    elapsed = asyncio.run(
+        seed(args.url, args.rows, args.seed, args.months, args.truncate)
+    )
+    print(f"Seeded {args.rows} rows in {elapsed:.1f}s")
@@ -3,4 +3,10 @@
 datadog-agent run > /dev/null &
 /opt/datadog-agent/embedded/bin/trace-agent --config=/etc/datadog-agent/datadog.yaml > /dev/null &
 /opt/datadog-agent/embedded/bin/process-agent --config=/etc/datadog-agent/datadog.yaml > /dev/null &
-poetry run uvicorn app.main:app --host 0.0.0.0 --port ${PORT}
\ No newline at end of file
+
+if [ "$1" = "worker" ]; then
+    # Ingest only: WORKER_PROCESSES consumer processes
+    exec poetry run python -m app.worker
+fi
+# API: set RUN_CONSUMER=false when the ingest runs in worker dynos
+exec poetry run uvicorn app.main:app --host 0.0.0.0 --port ${PORT} --workers ${WEB_CONCURRENCY:-1}
@@ -0,0 +1,53 @@
+import asyncio
+import os
+import pytest
+
+# The tests marked "database" run against a local, disposable database, which
+# is truncated before each of them:
+#
+#   TEST_DATABASE_URL=postgresql+asyncpg://... poetry run pytest tests/app
+#
+# They are skipped when TEST_DATABASE_URL is not set.
+
+TEST_DATABASE_URL = os.environ.get("TEST_DATABASE_URL")
+
+# app.db creates its engines on import; they only connect when used
+if TEST_DATABASE_URL:
+    os.environ["DATABASE_URL"] = TEST_DATABASE_URL
+    os.environ.pop("DATABASE_READ_URL", None)
+else:
+    os.environ.setdefault("DATABASE_URL", "postgresql+asyncpg://localhost/metrics_test")
+
+
+@pytest.fixture
+def database():
+    """
+    Returns a function running a coroutine function against the emptied test
+    database (the term dictionary is kept: the app caches its ids)
+    """
+    if not TEST_DATABASE_URL:
+        pytest.skip("TEST_DATABASE_URL is not set")
+    from sqlalchemy import text
+    from app.db import engine, init_db
+
+    async def reset():
+        await init_db()
+        async with engine.begin() as conn:
+            await conn.execute(
+                text(
+                    "TRUNCATE entry_compact, entry_rollup, entry_rollup_datetime, "
+                    "training_tombstone"
+                )
+            )
+
+    def run(scenario):
+        async def main():
+            try:
+                await reset()
+                return await scenario()
+            finally:
+                await engine.dispose()
+
+        return asyncio.run(main())
+
+    return run
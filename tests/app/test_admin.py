@@ -0,0 +1,23 @@
+import asyncio
+import pytest
+from fastapi import HTTPException
+from app.api import admin
+
+
+def test_admin_endpoints_need_the_configured_token(monkeypatch):
+    monkeypatch.setattr(admin, "ADMIN_TOKEN", "secret")
+
+    asyncio.run(admin.require_admin("secret"))
+    for token in (None, "other"):
+        with pytest.raises(HTTPException) as error:
+            asyncio.run(admin.require_admin(token))
+        assert error.value.status_code == 403
+
+
+def test_admin_endpoints_are_closed_without_a_token(monkeypatch):
+    monkeypatch.setattr(admin, "ADMIN_TOKEN", None)
+
+    for token in (None, ""):
+        with pytest.raises(HTTPException) as error:
+            asyncio.run(admin.require_admin(token))
+        assert error.value.status_code == 403
@@ -0,0 +1,100 @@
+import asyncio
+import orjson
+import pytest
+from starlette.requests import Request
+from app import history_views
+from app.aggregates import BLOCKED_USERS, USERS_AUTH
+from app.analytics import (
+    ENTRY_MIRROR_COLUMNS,
+    HistoryBackend,
+    parse_backends,
+    read_csv_sql,
+)
+from app.history_views import read_history_view
+
+
+class FakeMirror:
+    """
+    Analytics mirror in sync, answering every query with the same rows
+    """
+
+    ready = True
+    synced_at = 1685620800.0
+    etag_version = "abcd.3"
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.queries = []
+
+    async def query(self, sql):
+        self.queries.append(sql)
+        return self.rows
+
+
+def request(**headers) -> Request:
+    return Request(
+        {
+            "type": "http",
+            "headers": [
+                (k.replace("_", "-").encode(), v.encode()) for k, v in headers.items()
+            ],
+        }
+    )
+
+
+def test_backends_default_and_overrides():
+    backends = parse_backends("postgres", "users_auth=duckdb, blocked_users = duckdb")
+
+    assert backends["users_auth"] == HistoryBackend.duckdb
+    assert backends["blocked_users"] == HistoryBackend.duckdb
+    assert backends["users_by_location"] == HistoryBackend.postgres
+    with pytest.raises(ValueError):
+        parse_backends("postgres", "no_such_aggregate=duckdb")
+    with pytest.raises(ValueError):
+        parse_backends("clickhouse", "")
+
+
+def test_copied_csv_is_read_with_the_entry_types():
+    sql = read_csv_sql("/tmp/it's.csv", ENTRY_MIRROR_COLUMNS)
+
+    assert sql.startswith("read_csv('/tmp/it''s.csv', header = false")
+    assert "'id': 'BIGINT'" in sql
+    assert "'response_time': 'DOUBLE'" in sql
+    assert "nullstr = '\\N'" in sql
+
+
+def test_duckdb_aggregates_are_read_from_the_mirror(monkeypatch):
+    mirror = FakeMirror([("2023-05", 4)])
+    monkeypatch.setattr(history_views, "analytics_mirror", mirror)
+    monkeypatch.setitem(
+        history_views.BACKENDS, BLOCKED_USERS.name, HistoryBackend.duckdb
+    )
+
+    response = asyncio.run(read_history_view(BLOCKED_USERS, request(), session=None))
+    assert orjson.loads(response.body) == {"2023-05": 4}
+    assert mirror.queries == [BLOCKED_USERS.all_time_sql()]
+    assert "abcd.3" in response.headers["etag"]
+
+    again = asyncio.run(
+        read_history_view(
+            BLOCKED_USERS, request(if_none_match=response.headers["etag"]), session=None
+        )
+    )
+    assert again.status_code == 304
+    assert len(mirror.queries) == 1
+
+
+def test_postgres_aggregates_ignore_the_mirror(monkeypatch):
+    mirror = FakeMirror([])
+    monkeypatch.setattr(history_views, "analytics_mirror", mirror)
+
+    class ViewSession:
+        async def execute(self, statement):
+            return self
+
+        def all(self):
+            return []
+
+    response = asyncio.run(read_history_view(USERS_AUTH, request(), ViewSession()))
+    assert orjson.loads(response.body) == {}
+    assert mirror.queries == []
@@ -0,0 +1,31 @@
+import random
+from app.bitmaps import ARRAY_MAX, RoaringBitmap
+
+
+def test_bitmaps_behave_like_sets():
+    rng = random.Random(7)
+    # Sparse and dense containers, some shared
+    a = set(rng.sample(range(300000), 20000)) | set(range(70000, 80000))
+    b = set(rng.sample(range(300000), 3000)) | {0, 2**32 - 1}
+    first, second = RoaringBitmap(a), RoaringBitmap(b)
+
+    assert len(first) == len(a)
+    assert set(first & second) == a & b
+    assert set(first | second) == a | b
+    assert 75000 in first and 2**32 - 1 in second and 1 not in second
+
+
+def test_containers_switch_between_arrays_and_bits():
+    bitmap = RoaringBitmap(range(ARRAY_MAX + 1))
+    assert isinstance(bitmap.containers[0], int)
+
+    sparse = bitmap & RoaringBitmap(range(0, 65536, 1000))
+    assert not isinstance(sparse.containers[0], int)
+    assert list(sparse) == list(range(0, ARRAY_MAX + 1, 1000))
+
+
+def test_serialization_round_trip():
+    bitmap = RoaringBitmap([1, 5, 65536 * 3 + 2] + list(range(200000, 210000)))
+
+    assert RoaringBitmap.deserialize(bitmap.serialize()) == bitmap
+    assert len(RoaringBitmap.deserialize(RoaringBitmap().serialize())) == 0
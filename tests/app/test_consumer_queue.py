@@ -0,0 +1,65 @@
+import asyncio
+import json
+from types import SimpleNamespace
+from pika import BasicProperties
+from app.consumer.consumer_queue import ConsumerQueue
+
+
+def test_consumer_queue_is_a_singleton_per_process(monkeypatch):
+    monkeypatch.setattr(ConsumerQueue, "instance", None)
+    monkeypatch.setattr(ConsumerQueue, "instance_pid", None)
+
+    first = ConsumerQueue("amqp://localhost")
+    assert ConsumerQueue("amqp://localhost") is first
+
+    # As seen from a forked child process
+    monkeypatch.setattr(ConsumerQueue, "instance_pid", -1)
+    assert ConsumerQueue("amqp://localhost") is not first
+
+
+def test_invalid_messages_are_rejected_before_being_spooled(monkeypatch):
+    class Channel:
+        def __init__(self):
+            self.nacked = []
+
+        def basic_nack(self, delivery_tag, requeue=True):
+            self.nacked.append((delivery_tag, requeue))
+
+    class Spool:
+        def __init__(self):
+            self.appended = []
+
+        def append(self, message_id, body):
+            self.appended.append(message_id)
+            return asyncio.get_running_loop().create_future()
+
+    monkeypatch.setattr(ConsumerQueue, "instance", None)
+    monkeypatch.setattr(ConsumerQueue, "spool", Spool())
+    consumer = ConsumerQueue("amqp://localhost")
+    channel = Channel()
+    signup = json.dumps(
+        {
+            "service": "user-service",
+            "path": "/signup/",
+            "url": "http://user-service/signup/",
+            "method": "POST",
+            "status_code": 200,
+            "datetime": "2023-06-01 12:34:56",
+            "response_time": 0.1,
+            "user_id": "1a2b3c",
+            "ip": "192.168.0.1",
+            "action": "signup",
+        }
+    ).encode()
+    invalid = (b"not json", b'{"service": "user-service", "action": "signup"}')
+
+    async def deliver():
+        for tag, body in enumerate(invalid):
+            deliver = SimpleNamespace(delivery_tag=tag)
+            consumer.on_message(channel, deliver, BasicProperties(), body)
+        deliver = SimpleNamespace(delivery_tag=2)
+        consumer.on_message(channel, deliver, BasicProperties(message_id="ok"), signup)
+
+    asyncio.run(deliver())
+    assert channel.nacked == [(0, False), (1, False)]
+    assert ConsumerQueue.spool.appended == ["ok"]
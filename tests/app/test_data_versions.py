@@ -0,0 +1,113 @@
+import asyncio
+import datetime as dt
+import orjson
+from starlette.requests import Request
+from app.aggregates import USERS_AUTH
+from app import data_versions as data_versions_module
+from app.data_versions import DataVersions, data_versions
+from app.events import ENTRIES_CHANGED, ENTRIES_INSERTED, HISTORY_REFRESHED, EventBus
+from app.history_views import etag_matches, read_history_view, validators
+from app.models import EntryCreate
+from app.serialization import ResponseFormat
+
+REFRESHED_AT = dt.datetime(2023, 6, 1, 12, 0, tzinfo=dt.timezone.utc)
+
+
+def make_request(**headers) -> Request:
+    return Request(
+        {
+            "type": "http",
+            "headers": [
+                (k.replace("_", "-").encode(), v.encode()) for k, v in headers.items()
+            ],
+        }
+    )
+
+
+class ViewSession:
+    """
+    Answers the query of a history view, counting the queries
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.queries = 0
+
+    async def execute(self, statement):
+        self.queries += 1
+        return self
+
+    def all(self):
+        return self.rows
+
+
+def test_changes_are_counted_per_family():
+    versions = DataVersions(("training-service", "user-service"), 0.5, 30)
+    entry = EntryCreate(
+        service="user-service",
+        path="/signup/",
+        url="",
+        method="POST",
+        status_code=200,
+        datetime="2023-06-01 12:34:56",
+        response_time=0.1,
+        user_id="1a2b3c",
+        ip="",
+        action="signup",
+    )
+
+    versions.on_event(ENTRIES_INSERTED, [entry])
+    versions.on_event(ENTRIES_CHANGED, ("gateway",))
+    assert versions.pending == {"user-service"}
+
+    versions.on_event(ENTRIES_CHANGED, None)
+    assert versions.pending == {"training-service", "user-service"}
+
+
+def test_notifications_replace_the_versions(monkeypatch):
+    bus = EventBus(10)
+    monkeypatch.setattr(data_versions_module, "event_bus", bus)
+    subscription = bus.subscribe()
+    versions = DataVersions(("user-service",), 0.5, 30)
+    payload = orjson.dumps({"user-service": (7, REFRESHED_AT)}).decode()
+
+    versions._on_notification(None, 1, "data_version", payload)
+
+    assert versions.get("user-service") == (7, REFRESHED_AT)
+    # The live dashboard of this process resyncs, once per new version
+    assert subscription.get_nowait() == (HISTORY_REFRESHED, None)
+    versions._on_notification(None, 1, "data_version", payload)
+    assert subscription.empty()
+
+
+def test_etag_matching():
+    assert etag_matches('"a", W/"b"', '"b"')
+    assert etag_matches("*", '"b"')
+    assert not etag_matches('"a"', '"b"')
+    assert not etag_matches(None, '"b"')
+
+
+def test_current_version_is_not_modified_without_querying(monkeypatch):
+    monkeypatch.setattr(
+        data_versions, "versions", {USERS_AUTH.service: (3, REFRESHED_AT)}
+    )
+    session = ViewSession([("/login/", 5, REFRESHED_AT)])
+
+    response = asyncio.run(read_history_view(USERS_AUTH, make_request(), session))
+    etag = response.headers["etag"]
+    assert response.status_code == 200
+    assert response.headers["last-modified"] == "Thu, 01 Jun 2023 12:00:00 GMT"
+    assert session.queries == 1
+
+    response = asyncio.run(
+        read_history_view(USERS_AUTH, make_request(if_none_match=etag), session)
+    )
+    assert response.status_code == 304
+    assert response.headers["etag"] == etag
+    assert session.queries == 1
+
+    # Another version or format is another representation
+    columnar = validators(USERS_AUTH, ResponseFormat.columnar)["ETag"]
+    data_versions.versions[USERS_AUTH.service] = (4, REFRESHED_AT)
+    assert columnar != etag
+    assert validators(USERS_AUTH, ResponseFormat.rows)["ETag"] != etag
@@ -0,0 +1,166 @@
+import asyncio
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+import app.db as db
+from app.db import ReplicaMonitor, get_read_session, get_session, pool_status
+
+PRIMARY_URL = "postgresql+asyncpg://localhost/primary"
+REPLICA_URL = "postgresql+asyncpg://localhost/replica"
+
+
+def use_engines(monkeypatch, replica_monitor=None):
+    """
+    Replaces the engines of app.db by a primary and a replica (engines only
+    connect when used), returning them
+    """
+    primary = create_async_engine(PRIMARY_URL, pool_size=3, max_overflow=2)
+    replica = create_async_engine(REPLICA_URL, pool_size=4, max_overflow=0)
+    monkeypatch.setattr(db, "engine", primary)
+    monkeypatch.setattr(db, "read_engine", replica)
+    monkeypatch.setattr(db, "async_session", sessionmaker(primary, class_=AsyncSession))
+    monkeypatch.setattr(
+        db, "async_read_session", sessionmaker(replica, class_=AsyncSession)
+    )
+    monkeypatch.setattr(db, "replica_monitor", replica_monitor)
+    return primary, replica
+
+
+def session_bind(dependency):
+    async def first():
+        async for session in dependency():
+            return session.bind
+
+    return asyncio.run(first())
+
+
+class LagConnection:
+    def __init__(self, lags: list):
+        self.lags = lags
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def scalar(self, statement):
+        assert statement is db.REPLICA_LAG_QUERY
+        lag = self.lags.pop(0)
+        if isinstance(lag, Exception):
+            raise lag
+        return lag
+
+
+class LagEngine:
+    """
+    Read engine answering the lag query with the given lags, in order
+    """
+
+    def __init__(self, *lags):
+        self.lags = list(lags)
+
+    def connect(self):
+        return LagConnection(self.lags)
+
+
+def test_reads_use_the_read_engine_and_writes_the_primary(monkeypatch):
+    primary, replica = use_engines(monkeypatch)
+
+    assert session_bind(get_read_session) is replica
+    assert session_bind(get_session) is primary
+
+
+def test_the_api_writes_on_the_primary():
+    from app.main import app
+
+    for route in app.routes:
+        methods = getattr(route, "methods", None) or set()
+        dependant = getattr(route, "dependant", None)
+        if dependant is None or not methods & {"POST", "PUT", "PATCH", "DELETE"}:
+            continue
+        calls = {dependency.call for dependency in dependant.dependencies}
+        assert get_read_session not in calls, route.path
+
+
+def test_reads_fall_back_to_the_primary_while_the_replica_lags(monkeypatch):
+    monitor = ReplicaMonitor(max_lag=5, interval=0)
+    primary, replica = use_engines(monkeypatch, monitor)
+    monkeypatch.setattr(db, "read_engine", LagEngine(1.0, 12.5, 3.0))
+
+    assert session_bind(get_read_session) is replica
+    assert monitor.to_dict() == {
+        "lag_seconds": 1.0,
+        "max_lag_seconds": 5,
+        "healthy": True,
+        "fallbacks": 0,
+    }
+
+    assert session_bind(get_read_session) is primary
+    assert not monitor.healthy
+    assert monitor.lag == 12.5
+    assert monitor.fallbacks == 1
+
+    assert session_bind(get_read_session) is replica
+    assert monitor.healthy
+    assert monitor.fallbacks == 1
+
+
+def test_an_unreachable_replica_is_not_used(monkeypatch):
+    monitor = ReplicaMonitor(max_lag=5, interval=0)
+    primary, _ = use_engines(monkeypatch, monitor)
+    monkeypatch.setattr(db, "read_engine", LagEngine(OSError("refused")))
+
+    assert session_bind(get_read_session) is primary
+    assert not monitor.healthy
+
+
+def test_the_lag_is_checked_once_per_interval(monkeypatch):
+    monitor = ReplicaMonitor(max_lag=5, interval=3600)
+    use_engines(monkeypatch, monitor)
+    lag_engine = LagEngine(12.5, 1.0)
+    monkeypatch.setattr(db, "read_engine", lag_engine)
+
+    assert not asyncio.run(monitor.use_replica())
+    assert not asyncio.run(monitor.use_replica())
+    assert lag_engine.lags == [1.0]
+    assert monitor.fallbacks == 2
+
+
+def test_pool_status_reports_each_engine(monkeypatch):
+    monitor = ReplicaMonitor(max_lag=5, interval=0)
+    use_engines(monkeypatch, monitor)
+
+    status = pool_status()
+
+    assert set(status) == {"primary", "read", "replica"}
+    assert status["primary"] == {
+        "size": 3,
+        "checked_in": 0,
+        "checked_out": 0,
+        "overflow": -3,
+    }
+    assert status["read"]["size"] == 4
+    assert status["replica"] == monitor.to_dict()
+
+
+def test_pool_status_without_a_replica(monkeypatch):
+    primary, _ = use_engines(monkeypatch)
+    monkeypatch.setattr(db, "read_engine", primary)
+
+    assert set(pool_status()) == {"primary"}
+
+
+def test_pool_status_counts_the_checked_out_connections(database):
+    from sqlalchemy import text
+
+    async def scenario():
+        async with db.engine.connect() as conn:
+            await conn.execute(text("SELECT 1"))
+            during = pool_status()["primary"]
+        return during, pool_status()["primary"]
+
+    during, after = database(scenario)
+
+    assert during["checked_out"] == 1
+    assert after["checked_out"] == 0
+    assert after["checked_in"] >= 1
@@ -0,0 +1,38 @@
+from types import SimpleNamespace
+from app.dedup import RecentIds, message_id_of
+
+
+def test_message_id_of_prefers_producer_id():
+    properties = SimpleNamespace(message_id="abc-123")
+
+    assert message_id_of(properties, b'{"a": 1}') == "abc-123"
+
+
+def test_message_id_of_hashes_body_without_producer_id():
+    properties = SimpleNamespace(message_id=None)
+
+    first = message_id_of(properties, b'{"a": 1}')
+    second = message_id_of(properties, b'{"a": 1}')
+
+    assert first == second
+    assert first != message_id_of(properties, b'{"a": 2}')
+
+
+def test_recent_ids_drops_duplicates_and_evicts_oldest():
+    recent_ids = RecentIds(max_size=2)
+
+    assert not recent_ids.seen("1")
+    assert recent_ids.seen("1")
+    assert not recent_ids.seen("2")
+    assert not recent_ids.seen("3")
+    assert not recent_ids.seen("1")
+    assert recent_ids.dropped_cache == 1
+
+
+def test_recent_ids_forget():
+    recent_ids = RecentIds(max_size=10)
+    recent_ids.seen("1")
+
+    recent_ids.forget("1")
+
+    assert not recent_ids.seen("1")
@@ -242,34 +242,32 @@ async def test_update_db_entry_location(async_db_engine):
 
 
 @pytest.mark.asyncio
-async def test_delete_db_all_entries_with_training_id(async_db_engine):
+async def test_delete_db_all_entries_with_training_id():
     session = MockAsyncSession()
 
     training_id = "4d5e6f"
 
-    entry_1_dict["id"] = "1a2b3c"
-    entry_1_dict["training_id"] = training_id
-    entry_1 = Entry(**entry_1_dict)
-
-    entry_2_dict["id"] = "7g8h9i"
-    entry_2_dict["training_id"] = training_id
-    entry_2 = Entry(**entry_2_dict)
+    # The entries are hidden by a tombstone, not loaded and deleted here
+    with patch.object(session, 'execute') as execute:
+        result = await delete_db_all_entries_with_training_id(training_id, session)
 
-    await session.add(entry_1)
-    await session.add(entry_2)
+        execute.assert_called_once()
+        assert execute.call_args.args[1] == {"training_id": training_id}
+        assert session.committed
+        assert result is None
 
-    entries = [entry_1, entry_2]
 
-    result_mock = MagicMock()
-    result_mock.scalars.return_value.all.return_value = entries
-    scalars_mock = MagicMock(return_value=result_mock)
+@pytest.mark.asyncio
+@pytest.mark.parametrize("training_id", [None, ""])
+async def test_delete_db_all_entries_without_training_id(training_id):
+    session = MockAsyncSession()
 
-    with patch.object(session, 'execute', return_value=result_mock):
-        result = await delete_db_all_entries_with_training_id(training_id, session)
-        session.execute.assert_called_once
-        session.committed
+    with patch.object(session, 'execute') as execute:
+        with pytest.raises(ValueError):
+            await delete_db_all_entries_with_training_id(training_id, session)
 
-        assert result == entries
+        execute.assert_not_called()
+        assert not session.committed
 
 
 @pytest.mark.asyncio
@@ -0,0 +1,227 @@
+import asyncio
+import httpx
+from sqlalchemy import text
+import app.entry_storage as entry_storage
+from app.aggregates import BLOCKED_USERS, HISTORY_AGGREGATES, USERS_AUTH
+from app.entry_storage import (
+    INSERT_ENTRIES,
+    PUBLIC_ENTRY_COLUMNS,
+    TermCache,
+    insert_entries,
+)
+from app.models import EntryCreate
+
+
+class TermDatabase:
+    """
+    entry_term shared by every caller, recording the inserted values
+    """
+
+    def __init__(self):
+        self.ids = {}
+        self.inserts = []
+
+    def begin(self):
+        return TermConnection(self)
+
+
+class TermConnection:
+    def __init__(self, db: TermDatabase):
+        self.db = db
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def execute(self, statement, params):
+        values = params["values"]
+        # Let the other callers run in between
+        await asyncio.sleep(0)
+        if statement.text.startswith("INSERT"):
+            self.db.inserts.append(sorted(values))
+            for value in values:
+                self.db.ids.setdefault(value, len(self.db.ids) + 1)
+            return []
+        return [(self.db.ids[value], value) for value in values]
+
+
+class Result:
+    def __init__(self, rows: list):
+        self.rows = rows
+
+    def all(self) -> list:
+        return self.rows
+
+
+class Session:
+    def __init__(self, db: TermDatabase):
+        self.bind = db
+        self.statements = []
+
+    async def execute(self, statement, params):
+        self.statements.append((statement, params))
+        return Result([(i,) for i, _ in enumerate(params["status_code"])])
+
+
+def entry(**values) -> EntryCreate:
+    fields = {
+        "service": "user-service",
+        "path": "/users/u1/block",
+        "url": "https://user-service.fiufit.com/users/u1/block",
+        "method": "PATCH",
+        "status_code": 200,
+        "datetime": "2023-05-01 10:00:00",
+        "response_time": 0.1,
+        "user_id": "u1",
+        "ip": "181.0.0.1",
+        "country": "Chile",
+        "action": "block",
+        "training_id": "",
+        "training_type": "",
+    }
+    fields.update(values)
+    return EntryCreate(**fields)
+
+
+def test_only_the_missing_terms_are_inserted():
+    db = TermDatabase()
+    cache = TermCache()
+
+    asyncio.run(cache.resolve(["a", "b", "a", None], Session(db)))
+    asyncio.run(cache.resolve(["b", "c"], Session(db)))
+    asyncio.run(cache.resolve(["c", "a"], Session(db)))
+
+    assert db.inserts == [["a", "b"], ["c"]]
+    assert cache.encode("a") == db.ids["a"]
+    assert cache.decode(db.ids["c"]) == "c"
+    assert cache.encode(None) is None
+
+
+def test_callers_resolving_the_same_new_term_get_the_same_id():
+    db = TermDatabase()
+    first, second = TermCache(), TermCache()
+
+    async def resolve_both():
+        await asyncio.gather(
+            first.resolve(["new"], Session(db)), second.resolve(["new"], Session(db))
+        )
+
+    asyncio.run(resolve_both())
+
+    assert first.encode("new") == second.encode("new") == db.ids["new"]
+    assert len(db.ids) == 1
+
+
+def test_entries_are_inserted_as_column_arrays(monkeypatch):
+    db = TermDatabase()
+    monkeypatch.setattr(entry_storage, "terms", TermCache())
+    session = Session(db)
+    entries = [
+        entry(),
+        entry(service="training-service", path="/trainings/", training_id="t1"),
+        # Built without validation: a NULL column
+        EntryCreate.construct(**{**entry().dict(), "training_type": None}),
+    ]
+
+    assert asyncio.run(insert_entries(entries, session)) == 3
+
+    ((statement, params),) = session.statements
+    ids = db.ids
+    assert statement is INSERT_ENTRIES
+    assert params["status_code"] == [200, 200, 200]
+    assert params["training_id"] == ["", "t1", ""]
+    assert params["service_id"] == [
+        ids["user-service"],
+        ids["training-service"],
+        ids["user-service"],
+    ]
+    assert params["path_template_id"] == [
+        ids["/users/{user_id}/block"],
+        ids["/trainings/"],
+        ids["/users/{user_id}/block"],
+    ]
+    assert params["training_type_id"] == [ids[""], ids[""], None]
+    assert params["message_id"] == [None, None, None]
+    assert None not in ids
+
+
+def test_message_ids_are_passed_along(monkeypatch):
+    monkeypatch.setattr(entry_storage, "terms", TermCache())
+    session = Session(TermDatabase())
+
+    asyncio.run(insert_entries([entry(), entry()], session, message_ids=["m1", "m2"]))
+
+    assert session.statements[0][1]["message_id"] == ["m1", "m2"]
+
+
+def test_history_filters_use_the_term_ids():
+    sql = USERS_AUTH.sql(encoded=True)
+
+    assert "FROM entry_compact e" in sql
+    assert (
+        "e.service_id = (SELECT id FROM entry_term WHERE value = 'user-service')" in sql
+    )
+    assert "e.path_template_id = ANY(ARRAY(SELECT id FROM entry_term" in sql
+    assert "training_tombstone" in sql
+    assert "FROM entry " not in BLOCKED_USERS.all_time_sql(encoded=True)
+
+
+def test_entries_round_trip_through_the_api(database):
+    from app.db import async_session
+    from app.entries_utils import add_db_entries
+    from app.main import app
+
+    sent = entry(country="Uruguay")
+
+    async def scenario():
+        async with async_session() as session:
+            await add_db_entries([entry()], session)
+        async with httpx.AsyncClient(app=app, base_url="http://test") as client:
+            created = (await client.post("/entries/", json=sent.dict())).json()
+            listed = (await client.get("/entries/")).json()
+            read = (await client.get(f"/entries/{created['id']}")).json()
+        return created, listed, read
+
+    created, listed, read = database(scenario)
+    listed.sort(key=lambda e: e["id"])
+
+    assert set(created) == set(PUBLIC_ENTRY_COLUMNS)
+    assert {k: v for k, v in created.items() if k != "id"} == sent.dict()
+    assert read == created
+    assert [set(e) for e in listed] == [set(PUBLIC_ENTRY_COLUMNS)] * 2
+    assert listed[1] == created
+    assert {k: v for k, v in listed[0].items() if k != "id"} == entry().dict()
+
+
+def test_encoded_history_queries_match_the_view_and_use_the_index(database):
+    from app.db import async_session, engine
+    from app.entries_utils import add_db_entries
+
+    entries = [
+        entry(),
+        entry(path="/login/", action="login"),
+        entry(path="/users/u2/block", datetime="2023-06-01 10:00:00"),
+        entry(service="training-service", path="/trainings/", action="new_training"),
+    ]
+
+    async def scenario():
+        async with async_session() as session:
+            await add_db_entries(entries, session)
+        async with engine.connect() as conn:
+            counts = []
+            for aggregate in HISTORY_AGGREGATES:
+                for encoded in (False, True):
+                    rows = await conn.execute(text(aggregate.sql(encoded=encoded)))
+                    counts.append(sorted(rows.all(), key=repr))
+            await conn.execute(text("SET enable_seqscan = off"))
+            plan = await conn.execute(
+                text(f"EXPLAIN {BLOCKED_USERS.sql(encoded=True)}")
+            )
+            return counts, "\n".join(row[0] for row in plan)
+
+    counts, plan = database(scenario)
+
+    assert counts[0::2] == counts[1::2]
+    assert "entry_compact_service_action" in plan
@@ -0,0 +1,66 @@
+import asyncio
+from app.consumer.flow_control import FlowController
+
+
+class Replayer:
+    def __init__(self, apply):
+        self.apply = apply
+        self.batch_size = None
+
+
+def controller(**kwargs) -> FlowController:
+    options = {
+        "prefetch": 1000,
+        "batch_size": 500,
+        "target_latency": 0.25,
+        "prefetch_bounds": (50, 10000),
+        "batch_bounds": (50, 5000),
+        "prefetch_step": 100,
+        "batch_step": 50,
+    }
+    return FlowController(**{**options, **kwargs})
+
+
+def test_slow_commits_halve_prefetch_and_batch_size():
+    prefetches = []
+    flow = controller()
+    replayer = Replayer(None)
+    flow.attach(replayer, prefetches.append)
+    flow.commits = [(0.1, 500, False), (0.4, 500, False)]
+
+    assert flow.decide() == "decrease"
+    assert (flow.prefetch, flow.batch_size) == (500, 250)
+    assert replayer.batch_size == 250
+    assert prefetches == [500]
+    assert flow.to_dict()["decisions"][0]["latency_ms"] == 400.0
+
+
+def test_backlog_and_full_batches_grow_additively():
+    flow = controller()
+    flow.queue_depth = 20000
+    flow.delivered = 950
+    flow.commits = [(0.05, 500, False)]
+
+    assert flow.decide() == "increase"
+    assert (flow.prefetch, flow.batch_size) == (1100, 550)
+
+    # Idle: nothing queued nor committed
+    flow.queue_depth = 0
+    assert flow.decide() is None
+
+
+def test_failures_decrease_down_to_the_bounds():
+    flow = controller(prefetch=60, batch_size=60)
+
+    async def fail(records):
+        raise ConnectionError("database is down")
+
+    replayer = Replayer(fail)
+    flow.attach(replayer)
+    try:
+        asyncio.run(replayer.apply([("id", b"{}")]))
+    except ConnectionError:
+        pass
+
+    assert flow.decide() == "decrease"
+    assert (flow.prefetch, flow.batch_size) == (50, 50)
@@ -0,0 +1,71 @@
+import asyncio
+import datetime as dt
+from app.bitmaps import RoaringBitmap
+from app.funnels import bitmap_names, funnel, retention
+
+
+class BitmapSession:
+    """
+    Answers the user_bitmap queries from a dict of bitmaps
+    """
+
+    def __init__(self, bitmaps: dict):
+        self.rows = {name: bitmap.serialize() for name, bitmap in bitmaps.items()}
+
+    async def execute(self, statement, params):
+        if "prefix" in params:
+            return [
+                (name, data)
+                for name, data in self.rows.items()
+                if name.startswith(params["prefix"])
+            ]
+        return [
+            (name, self.rows[name]) for name in params["names"] if name in self.rows
+        ]
+
+
+session = BitmapSession(
+    {
+        "action:signup:2023-05-30": RoaringBitmap([1, 2]),
+        "action:signup:2023-06-01": RoaringBitmap([3, 4, 5]),
+        "action:new_training:2023-06-02": RoaringBitmap([1, 3, 4]),
+        "action:new_training:2023-07-10": RoaringBitmap([5]),
+        "action:media_upload:2023-06-03": RoaringBitmap([3, 4, 9]),
+        "signup_month:2023-05": RoaringBitmap([1, 2]),
+        "signup_month:2023-06": RoaringBitmap([3, 4, 5]),
+        "country:Argentina": RoaringBitmap([1, 3]),
+        "country:Chile": RoaringBitmap([2, 4, 5]),
+    }
+)
+
+
+def test_signups_also_set_the_cohorts():
+    assert bitmap_names("signup", "2023-06-01 10:00:00", "Chile") == [
+        "action:signup:2023-06-01",
+        "signup_month:2023-06",
+        "country:Chile",
+    ]
+    assert bitmap_names("login", "2023-06-01 10:00:00", "Chile") == [
+        "action:login:2023-06-01"
+    ]
+
+
+def test_funnel_intersects_the_steps():
+    result = asyncio.run(
+        funnel(
+            session,
+            ("signup", "new_training", "media_upload"),
+            dt.date(2023, 5, 1),
+            dt.date(2023, 6, 30),
+            by="country",
+        )
+    )
+
+    assert result["users"] == [5, 3, 2]
+    assert result["by"] == {"Argentina": [2, 2, 1], "Chile": [3, 1, 1]}
+
+
+def test_retention_counts_active_users_per_cohort_month():
+    result = asyncio.run(retention(session, "new_training", "2023-06", 2))
+
+    assert result["cohorts"] == {"2023-06": {"users": 3, "active": [2, 1]}}
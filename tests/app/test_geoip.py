@@ -0,0 +1,61 @@
+from app import geoip as geoip_module
+from app.geoip import GeoIPDatabase, build, read_ranges_csv
+from app.models import EntryCreate
+
+
+def make_database(tmp_path):
+    ranges_csv = tmp_path / "ranges.csv"
+    ranges_csv.write_text(
+        '"10.0.0.0","10.0.0.255","AR","Argentina"\n'
+        '"16777216","16777471","AU","Australia"\n'
+        '"2001:db8::","2001:db8::ffff","US","United States"\n'
+        '"10.0.2.0","10.0.2.255","CL","Chile"\n'
+    )
+    path = tmp_path / "geoip.bin"
+    build(read_ranges_csv(str(ranges_csv)), str(path))
+    return GeoIPDatabase(str(path), cache_size=16)
+
+
+def test_lookup_finds_the_range_of_the_address(tmp_path):
+    database = make_database(tmp_path)
+
+    assert database.size == 3
+    assert database.lookup("10.0.0.0") == "Argentina"
+    assert database.lookup("10.0.0.255") == "Argentina"
+    assert database.lookup("1.0.0.7") == "Australia"
+    assert database.lookup("10.0.2.1") == "Chile"
+    assert database.lookup("10.0.1.1") is None
+    assert database.lookup("0.0.0.1") is None
+    assert database.lookup("2001:db8::1") is None
+    assert database.lookup("not an ip") is None
+
+
+def test_lookup_caches_repeated_addresses(tmp_path):
+    database = make_database(tmp_path)
+
+    database.lookup("10.0.0.1")
+    database.lookup("10.0.0.1")
+
+    assert database.to_dict()["cache_hits"] == 1
+
+
+def test_resolve_country_only_fills_empty_countries(tmp_path, monkeypatch):
+    monkeypatch.setattr(geoip_module, "geoip", make_database(tmp_path))
+    entry = {
+        "service": "user-service",
+        "path": "/signup/",
+        "url": "http://user-service/signup/",
+        "method": "POST",
+        "status_code": 200,
+        "datetime": "2023-06-01 12:34:56",
+        "response_time": 0.1,
+        "user_id": "1a2b3c",
+        "ip": "10.0.0.1",
+        "action": "signup",
+    }
+
+    assert geoip_module.resolve_country(EntryCreate(**entry)).country == "Argentina"
+    assert (
+        geoip_module.resolve_country(EntryCreate(**entry, country="Chile")).country
+        == "Chile"
+    )
@@ -0,0 +1,263 @@
+import asyncio
+import datetime as dt
+import orjson
+from starlette.requests import Request
+import app.history_views as history_views
+from app.aggregates import HISTORY_AGGREGATES, USERS_AUTH
+from app.data_versions import data_versions
+from app.events import HISTORY_REFRESHED, event_bus
+from app.history_views import (
+    FRESHNESS_HEADER,
+    REFRESH_LOCK_ID,
+    HistoryViewRefresher,
+    read_history_view,
+    refresh_history_views,
+    view_name,
+)
+
+REFRESHED_AT = dt.datetime(2023, 6, 1, 12, 0, tzinfo=dt.timezone.utc)
+
+
+def fake_refresh(monkeypatch, refreshed: bool = True) -> list:
+    """
+    Replaces refresh_history_views, returning the list of its calls
+    """
+    calls = []
+
+    async def refresh_history_views():
+        calls.append(1)
+        return refreshed
+
+    monkeypatch.setattr(history_views, "refresh_history_views", refresh_history_views)
+    return calls
+
+
+def run_refresher(refresher: HistoryViewRefresher, scenario):
+    """
+    Runs the scenario while the refresher runs, returning the events
+    published meanwhile
+    """
+
+    async def main():
+        subscription = event_bus.subscribe()
+        task = asyncio.create_task(refresher.run())
+        try:
+            await asyncio.sleep(0)
+            await scenario()
+        finally:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            event_bus.unsubscribe(subscription)
+        events = []
+        while not subscription.empty():
+            events.append(subscription.get_nowait()[0])
+        return events
+
+    return asyncio.run(main())
+
+
+def test_enough_changes_wake_the_refresher_up(monkeypatch):
+    calls = fake_refresh(monkeypatch)
+    refresher = HistoryViewRefresher(interval=3600, max_pending=3)
+
+    async def scenario():
+        refresher.notify_changed(2)
+        await asyncio.sleep(0.01)
+        assert calls == []
+        refresher.notify_changed()
+        await asyncio.sleep(0.01)
+
+    events = run_refresher(refresher, scenario)
+
+    assert calls == [1]
+    assert refresher.pending == 0
+    assert events == [HISTORY_REFRESHED]
+
+
+def test_the_refresher_runs_every_interval_without_changes(monkeypatch):
+    calls = fake_refresh(monkeypatch)
+    refresher = HistoryViewRefresher(interval=0.01, max_pending=0)
+
+    async def scenario():
+        await asyncio.sleep(0.05)
+
+    run_refresher(refresher, scenario)
+
+    assert len(calls) >= 2
+
+
+def test_a_skipped_refresh_is_not_announced(monkeypatch):
+    calls = fake_refresh(monkeypatch, refreshed=False)
+    refresher = HistoryViewRefresher(interval=3600, max_pending=1)
+
+    async def scenario():
+        refresher.notify_changed()
+        await asyncio.sleep(0.01)
+
+    assert run_refresher(refresher, scenario) == []
+    assert calls == [1]
+
+
+class LockConnection:
+    """
+    AUTOCOMMIT connection whose advisory lock is (or not) free, recording
+    the statements
+    """
+
+    def __init__(self, free: bool):
+        self.free = free
+        self.statements = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def execution_options(self, **options):
+        assert options == {"isolation_level": "AUTOCOMMIT"}
+        return self
+
+    async def scalar(self, statement, params):
+        self.statements.append((statement.text, params))
+        return self.free
+
+    async def execute(self, statement, params=None):
+        self.statements.append((statement.text, params))
+
+
+class LockEngine:
+    def __init__(self, conn: LockConnection):
+        self.conn = conn
+
+    def connect(self):
+        return self.conn
+
+
+def fake_versions(monkeypatch) -> list:
+    calls = []
+
+    async def snapshot(conn):
+        calls.append("snapshot")
+        return {}
+
+    async def publish(conn, changes):
+        calls.append("publish")
+
+    monkeypatch.setattr(data_versions, "snapshot", snapshot)
+    monkeypatch.setattr(data_versions, "publish", publish)
+    return calls
+
+
+def test_the_refresh_is_skipped_while_another_process_holds_the_lock(monkeypatch):
+    conn = LockConnection(free=False)
+    monkeypatch.setattr(history_views, "engine", LockEngine(conn))
+    versions = fake_versions(monkeypatch)
+
+    assert asyncio.run(refresh_history_views()) is False
+
+    assert conn.statements == [
+        ("SELECT pg_try_advisory_lock(:id)", {"id": REFRESH_LOCK_ID})
+    ]
+    assert versions == []
+
+
+def test_the_lock_holder_refreshes_every_view_then_unlocks(monkeypatch):
+    conn = LockConnection(free=True)
+    monkeypatch.setattr(history_views, "engine", LockEngine(conn))
+    versions = fake_versions(monkeypatch)
+
+    assert asyncio.run(refresh_history_views()) is True
+
+    refreshes = [
+        f"REFRESH MATERIALIZED VIEW CONCURRENTLY {view_name(aggregate)}"
+        for aggregate in HISTORY_AGGREGATES
+    ]
+    assert [statement for statement, _ in conn.statements[1:-1]] == refreshes
+    assert conn.statements[-1] == (
+        "SELECT pg_advisory_unlock(:id)",
+        {"id": REFRESH_LOCK_ID},
+    )
+    assert versions == ["snapshot", "publish"]
+
+
+class ViewSession:
+    def __init__(self, rows):
+        self.rows = rows
+        self.statements = []
+
+    async def execute(self, statement):
+        self.statements.append(statement.text)
+        return self
+
+    def all(self):
+        return self.rows
+
+
+def test_view_reads_carry_the_time_of_the_last_refresh(monkeypatch):
+    monkeypatch.setattr(data_versions, "versions", {})
+    session = ViewSession([("/login/", 5, REFRESHED_AT), ("/signup/", 2, REFRESHED_AT)])
+
+    response = asyncio.run(
+        read_history_view(USERS_AUTH, Request({"type": "http", "headers": []}), session)
+    )
+
+    assert session.statements == [
+        f"SELECT key, count, refreshed_at FROM {view_name(USERS_AUTH)}"
+    ]
+    assert response.headers[FRESHNESS_HEADER] == "2023-06-01T12:00:00+00:00"
+    assert orjson.loads(response.body) == {"/login/": 5, "/signup/": 2}
+
+
+def test_an_empty_view_has_no_freshness_header(monkeypatch):
+    monkeypatch.setattr(data_versions, "versions", {})
+
+    response = asyncio.run(
+        read_history_view(
+            USERS_AUTH, Request({"type": "http", "headers": []}), ViewSession([])
+        )
+    )
+
+    assert FRESHNESS_HEADER not in response.headers
+    assert orjson.loads(response.body) == {}
+
+
+def test_the_freshness_header_follows_the_refresh(database, monkeypatch):
+    from app.db import async_session
+    from app.entries_utils import add_db_entries
+    from app.history_views import init_history_views
+    from app.models import EntryCreate
+
+    monkeypatch.setattr(data_versions, "versions", {})
+    login = EntryCreate(
+        service="user-service",
+        path="/login/",
+        url="https://user-service.fiufit.com/login/",
+        method="POST",
+        status_code=200,
+        datetime="2023-05-01 10:00:00",
+        response_time=0.1,
+        user_id="u1",
+        ip="181.0.0.1",
+        country="Chile",
+        action="login",
+    )
+
+    async def scenario():
+        async with async_session() as session:
+            await add_db_entries([login], session)
+        await init_history_views()
+        started = dt.datetime.now(dt.timezone.utc)
+        await refresh_history_views()
+        async with async_session() as session:
+            response = await read_history_view(
+                USERS_AUTH, Request({"type": "http", "headers": []}), session
+            )
+        return started, response
+
+    started, response = database(scenario)
+
+    refreshed_at = dt.datetime.fromisoformat(response.headers[FRESHNESS_HEADER])
+    assert started - dt.timedelta(seconds=1) <= refreshed_at
+    assert refreshed_at <= dt.datetime.now(dt.timezone.utc)
+    assert orjson.loads(response.body) == {"/login/": 1}
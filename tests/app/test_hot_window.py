@@ -0,0 +1,133 @@
+import pytest
+from collections import Counter
+from app.aggregates import HISTORY_AGGREGATES
+from app.models import EntryCreate
+
+pytest.importorskip("numpy")
+
+from app.hot_window import ENCODED_COLUMNS, HotWindow, _timestamp  # noqa: E402
+
+entry_dict = {
+    "service": "user-service",
+    "path": "/signup/",
+    "url": "http://user-service/signup/",
+    "method": "POST",
+    "status_code": 200,
+    "datetime": "2023-06-01 12:34:56",
+    "response_time": 0.1,
+    "user_id": "1a2b3c",
+    "ip": "192.168.0.1",
+    "country": "Argentina",
+    "action": "signup",
+    "training_id": "",
+    "training_type": "",
+}
+
+
+def make_entry(**changes):
+    return EntryCreate(**{**entry_dict, **changes})
+
+
+ENTRIES = [
+    make_entry(),
+    make_entry(country="Chile", datetime="2023-06-01 12:35:10"),
+    make_entry(path="/login/", action="login", status_code=500),
+    make_entry(path="/users/1a2b3c/block", action="block"),
+    make_entry(path="/users/1a2b3c/block", action="block"),
+    make_entry(path="/users/9z/block", action="block", datetime="2023-07-02 08:00:00"),
+    make_entry(
+        service="training-service",
+        path="/trainings/",
+        action="new_training",
+        training_type="running",
+        status_code=503,
+        datetime="2023-07-02 08:00:30",
+    ),
+    make_entry(
+        service="training-service",
+        path="/trainings/7/favs",
+        action="add_training_to_favs",
+        user_id="4d5e",
+        datetime="2023-07-02 08:01:00",
+    ),
+]
+
+
+def expected_counts(aggregate, entries):
+    if aggregate.count_distinct:
+        keys = {
+            (aggregate.key_of(e), getattr(e, aggregate.count_distinct))
+            for e in entries
+            if aggregate.matches(e)
+        }
+        return dict(Counter(key for key, _ in keys))
+    return dict(Counter(aggregate.key_of(e) for e in entries if aggregate.matches(e)))
+
+
+def test_counts_match_the_aggregates():
+    window = HotWindow(100, 24)
+    window.append(ENTRIES)
+
+    for aggregate in HISTORY_AGGREGATES:
+        assert window.supports(aggregate)
+        assert window.counts(aggregate, 0) == expected_counts(aggregate, ENTRIES)
+    since = _timestamp("2023-07-01 00:00:00")
+    assert window.counts(HISTORY_AGGREGATES[1], since) == {"2023-07": 1}
+
+
+def test_load_converts_rows_like_append():
+    appended = HotWindow(100, 24)
+    appended.append(ENTRIES)
+    loaded = HotWindow(100, 24)
+    loaded.load(
+        [
+            (e.datetime, e.response_time, e.status_code)
+            + tuple(getattr(e, column) for column in ENCODED_COLUMNS)
+            for e in ENTRIES
+        ]
+    )
+
+    for aggregate in HISTORY_AGGREGATES:
+        assert loaded.counts(aggregate, 0) == appended.counts(aggregate, 0)
+    record = loaded.records(_timestamp("2023-07-02 08:00:30"))[0]
+    assert record.path_template == "/trainings/"
+    assert record.status_code == 503
+
+
+def test_overwritten_entries_are_no_longer_covered():
+    window = HotWindow(4, 24)
+    window.load([(e.datetime, 0.1, 200, "s", "a", "", "/", "", "u") for e in ENTRIES])
+    window.append(ENTRIES[:1])
+
+    assert window.size == 4
+    assert [r.datetime for r in window.records()] == [
+        "2023-06-01 12:34:56",
+        "2023-07-02 08:00:00",
+        "2023-07-02 08:00:30",
+        "2023-07-02 08:01:00",
+    ]
+    assert not window.covers(_timestamp("2023-06-01 12:35:10"))
+    assert window.covers(_timestamp("2023-06-01 12:35:11"))
+
+
+def test_series_counts_requests_and_errors_per_minute():
+    window = HotWindow(100, 24)
+    window.append(ENTRIES)
+    since = _timestamp("2023-07-02 08:00:00")
+    until = _timestamp("2023-07-02 08:02:00")
+
+    assert window.series(since, until) == {
+        "minutes": ["2023-07-02 08:00", "2023-07-02 08:01", "2023-07-02 08:02"],
+        "requests": [2, 1, 0],
+        "errors": [1, 0, 0],
+        "error_rate": [0.5, 0.0, 0.0],
+    }
+    assert window.series(since, until, "user-service")["requests"] == [1, 0, 0]
+
+
+def test_timestamps_keep_the_offset_of_aware_datetimes():
+    utc = _timestamp("2023-07-02 11:00:00")
+
+    assert _timestamp("2023-07-02 08:00:00-03:00") == utc
+    assert _timestamp("2023-07-02T11:00:00+00:00") == utc
+    assert _timestamp("not a datetime") is None
@@ -0,0 +1,88 @@
+import asyncio
+import json
+from app.aggregates import BLOCKED_USERS, USERS_AUTH, USERS_BY_LOCATION
+from app.events import ENTRIES_INSERTED
+from app.live import LiveAggregate, LiveDashboard
+from app.models import EntryCreate
+
+entry_dict = {
+    "service": "user-service",
+    "path": "/signup/",
+    "url": "http://user-service/signup/",
+    "method": "POST",
+    "status_code": 200,
+    "datetime": "2023-06-01 12:34:56",
+    "response_time": 0.1,
+    "user_id": "1a2b3c",
+    "ip": "192.168.0.1",
+    "country": "Argentina",
+    "action": "signup",
+    "training_id": "",
+    "training_type": "",
+}
+
+
+def make_entry(**changes):
+    return EntryCreate(**{**entry_dict, **changes})
+
+
+def test_aggregate_matches_like_its_sql_filters():
+    block = make_entry(path="/users/1a2b3c/block", action="block")
+
+    assert USERS_AUTH.matches(make_entry())
+    assert not USERS_AUTH.matches(block)
+    assert BLOCKED_USERS.matches(block)
+    assert not BLOCKED_USERS.matches(make_entry(path="/users/1a2b3c/blocked"))
+    assert BLOCKED_USERS.key_of(block) == "2023-06"
+
+
+def test_live_aggregate_counts_distinct_values_once():
+    live = LiveAggregate(BLOCKED_USERS)
+    live.load({"2023-06": 3})
+    block = make_entry(path="/users/1a2b3c/block", action="block")
+
+    assert live.apply(block) == "2023-06"
+    assert live.apply(block) is None
+    assert live.apply(make_entry()) is None
+    assert live.counts == {"2023-06": 4}
+
+
+def test_dashboard_pushes_snapshot_then_coalesced_deltas():
+    async def scenario():
+        dashboard = LiveDashboard((USERS_BY_LOCATION,), 0, client_queue_size=10)
+        dashboard._needs_sync = False
+        dashboard.aggregates["users_by_location"].load({"Argentina": 1})
+        client = dashboard.connect()
+
+        dashboard.apply(ENTRIES_INSERTED, [make_entry(), make_entry()])
+        dashboard.apply(ENTRIES_INSERTED, [make_entry(country="Chile")])
+        await dashboard.flush()
+        await dashboard.flush()
+
+        return [json.loads(client.get_nowait()) for _ in range(client.qsize())]
+
+    snapshot, delta = asyncio.run(scenario())
+
+    assert snapshot["type"] == "snapshot"
+    assert snapshot["data"] == {"users_by_location": {"Argentina": 1}}
+    assert delta == {
+        "type": "delta",
+        "data": {"users_by_location": {"Argentina": 3, "Chile": 1}},
+    }
+
+
+def test_dashboard_resets_clients_that_fall_behind():
+    async def scenario():
+        dashboard = LiveDashboard((USERS_BY_LOCATION,), 0, client_queue_size=1)
+        dashboard._needs_sync = False
+        client = dashboard.connect()
+
+        dashboard.apply(ENTRIES_INSERTED, [make_entry()])
+        await dashboard.flush()
+
+        return dashboard.resets, [json.loads(client.get_nowait())]
+
+    resets, messages = asyncio.run(scenario())
+
+    assert resets == 1
+    assert messages[0]["data"] == {"users_by_location": {"Argentina": 1}}
@@ -0,0 +1,56 @@
+import json
+import logging
+import queue
+from app.log_pipeline import (
+    CountingQueueHandler,
+    JsonFormatter,
+    SamplingFilter,
+    log_stats,
+    parse_sampling_rules,
+)
+
+
+def make_record(name, level=logging.INFO, msg="hello %s", args=("world",)):
+    return logging.LogRecord(name, level, __file__, 1, msg, args, None)
+
+
+def test_parse_sampling_rules():
+    rules = parse_sampling_rules("app.ingest=0.1/50, app.consumer.ack=0")
+
+    assert rules == {"app.ingest": (0.1, 50.0), "app.consumer.ack": (0.0, None)}
+
+
+def test_sampling_filter_drops_and_counts_hot_path_records():
+    sampling = SamplingFilter({"app.consumer.ack": (0.0, None)})
+
+    assert not sampling.filter(make_record("app.consumer.ack"))
+    assert sampling.filter(make_record("app.consumer.ack", level=logging.WARNING))
+    assert sampling.filter(make_record("app"))
+    assert log_stats.sampled["app.consumer.ack"] >= 1
+
+
+def test_sampling_filter_rate_limit_applies_to_children():
+    sampling = SamplingFilter({"app.ingest": (1.0, 2)})
+
+    results = [sampling.filter(make_record("app.ingest.bulk")) for _ in range(5)]
+
+    assert results.count(True) == 2
+    assert log_stats.rate_limited["app.ingest.bulk"] >= 3
+
+
+def test_queue_handler_drops_when_full():
+    handler = CountingQueueHandler(queue.Queue(maxsize=1))
+    before = log_stats.dropped["app.test"]
+
+    handler.handle(make_record("app.test"))
+    handler.handle(make_record("app.test"))
+
+    assert log_stats.dropped["app.test"] == before + 1
+
+
+def test_json_formatter():
+    payload = json.loads(JsonFormatter().format(make_record("app.ingest")))
+
+    assert payload["message"] == "hello world"
+    assert payload["logger"] == "app.ingest"
+    assert payload["level"] == "INFO"
@@ -0,0 +1,79 @@
+import asyncio
+import gzip
+import json
+import pytest
+from app.consumer import message_queue_wrapper
+from app.consumer.payloads import decode_events, decompress
+from app.dedup import RecentIds
+
+EVENT = {"service": "user-service", "action": "signup", "user_id": "1a2b3c"}
+
+
+def test_single_events_and_batches():
+    other = {**EVENT, "user_id": "4d5e"}
+
+    assert decode_events(json.dumps(EVENT).encode()) == ([EVENT], False)
+    assert decode_events(json.dumps([EVENT, other]).encode()) == ([EVENT, other], True)
+    ndjson = f"{json.dumps(EVENT)}\n\n{json.dumps(other)}\n".encode()
+    assert decode_events(ndjson) == ([EVENT, other], True)
+    with pytest.raises(ValueError):
+        decode_events(b"[1, 2]")
+
+
+def test_compressed_bodies_are_decoded_with_or_without_the_encoding():
+    body = json.dumps([EVENT]).encode()
+    compressed = gzip.compress(body)
+
+    assert decompress(compressed, "gzip") == body
+    assert decompress(compressed) == body
+    assert decode_events(compressed) == ([EVENT], True)
+    with pytest.raises(ValueError):
+        decompress(compressed, "gzip", limit=len(body) - 1)
+    with pytest.raises(ValueError):
+        decompress(body, "br")
+
+
+def test_content_encodings_are_case_insensitive():
+    body = json.dumps([EVENT]).encode()
+
+    for encoding in ("UTF-8", "Identity", " utf8 "):
+        assert decompress(body, encoding) == body
+    assert decompress(gzip.compress(body), "GZIP") == body
+
+
+def test_zstd_bodies_are_decoded():
+    zstandard = pytest.importorskip("zstandard")
+    body = json.dumps([EVENT]).encode()
+
+    assert decompress(zstandard.ZstdCompressor().compress(body), "zstd") == body
+
+
+def test_spooled_batches_are_applied_event_by_event(monkeypatch):
+    applied = []
+
+    async def process_batch(messages):
+        applied.extend(messages)
+
+    monkeypatch.setattr(message_queue_wrapper, "process_batch", process_batch)
+    monkeypatch.setattr(message_queue_wrapper, "recent_ids", RecentIds(10))
+    records = [
+        ("a", json.dumps(EVENT).encode()),
+        ("b", gzip.compress(json.dumps([EVENT, EVENT]).encode())),
+        ("a", json.dumps(EVENT).encode()),
+    ]
+
+    asyncio.run(message_queue_wrapper.process_spooled(records))
+
+    assert [message_id for message_id, _ in applied] == ["a", "b#0", "b#1"]
+
+
+def test_training_deletes_without_a_training_id_are_invalid():
+    delete = {"service": "training-service", "action": "delete_training"}
+
+    message_queue_wrapper.validate_message(
+        json.dumps({**delete, "training_id": "4d5e"}).encode()
+    )
+    for training_id in (None, ""):
+        body = json.dumps({**delete, "training_id": training_id}).encode()
+        with pytest.raises(ValueError):
+            message_queue_wrapper.validate_message(body)
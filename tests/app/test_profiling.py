@@ -0,0 +1,70 @@
+import asyncio
+from app.profiling import Profiler, ProfilingMiddleware, profiler, record_phase
+from app.serialization import FastJSONResponse
+
+
+def test_capture_records_the_phases_of_the_call():
+    profiles = Profiler(0.001, kept=2)
+    record_phase("sql", 1.0)
+
+    with profiles.capture("queue", "MessageQueueWrapper") as profile:
+        record_phase("sql", 0.002)
+        record_phase("sql", 0.003)
+
+    phases = profile.to_dict()["phases"]
+    assert phases["sql"] == {"ms": 5.0, "calls": 2}
+    assert "other" in phases
+    assert profiles.get(profile.id) is profile
+    assert profiles.to_dict()["captured"] == 1
+
+
+def test_only_one_call_is_profiled_at_a_time():
+    profiles = Profiler(0.001, kept=2)
+
+    with profiles.capture("http", "GET /history/users_auth") as first:
+        with profiles.capture("http", "GET /history/blocked_users") as second:
+            pass
+
+    assert first is not None
+    assert second is None
+    assert profiles.skipped == 1
+    assert [p["name"] for p in profiles.to_dict()["profiles"]] == [
+        "GET /history/users_auth"
+    ]
+
+
+def test_json_encoding_is_timed_while_profiling():
+    with Profiler(0.001, kept=1).capture("http", "GET /") as profile:
+        FastJSONResponse({"a": 1})
+
+    assert profile.phases["json"][1] == 1
+
+
+def test_middleware_profiles_requests_with_the_header_and_token():
+    async def app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b"{}"})
+
+    def request(headers, admin_token="secret"):
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {
+            "type": "http",
+            "method": "GET",
+            "path": "/history/users_auth",
+            "headers": headers,
+        }
+        middleware = ProfilingMiddleware(app, admin_token=admin_token)
+        asyncio.run(middleware(scope, None, send))
+        return dict(sent[0]["headers"])
+
+    profiled = request([(b"x-profile", b"1"), (b"x-admin-token", b"secret")])
+    assert profiler.get(profiled[b"x-profile-id"].decode()) is not None
+    assert profiled[b"server-timing"].startswith(b"other;dur=")
+    assert request([(b"x-profile", b"1")]) == {}
+    assert request([]) == {}
+    # On-demand profiling needs an admin token to be configured
+    assert request([(b"x-profile", b"1")], admin_token=None) == {}
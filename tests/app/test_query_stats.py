@@ -0,0 +1,39 @@
+from app.query_stats import QueryStats, normalize_statement
+
+
+def test_normalize_statement_groups_values():
+    first = normalize_statement(
+        "SELECT entry.id FROM entry WHERE entry.user_id = %s AND entry.id IN (1, 2, 3)"
+    )
+    second = normalize_statement(
+        "SELECT entry.id   FROM entry WHERE entry.user_id = 'abc' AND entry.id IN (7, 8)"
+    )
+
+    assert first == second
+    assert (
+        first
+        == "SELECT entry.id FROM entry WHERE entry.user_id = ? AND entry.id IN (?, ...)"
+    )
+
+
+def test_normalize_statement_keeps_casts_and_labels():
+    statement = normalize_statement(
+        "SELECT count(*) AS count_1, substr(x, 1, 7)::text FROM t"
+    )
+
+    assert statement == "SELECT count(*) AS count_1, substr(x, ?, ?)::text FROM t"
+
+
+def test_query_stats_top_by_total_and_p99():
+    stats = QueryStats()
+    for _ in range(99):
+        stats.record("SELECT 1 FROM a WHERE x = %s", 0.001)
+    stats.record("SELECT 1 FROM a WHERE x = %s", 0.5)
+    stats.record("SELECT 1 FROM b WHERE y = %s", 0.2)
+
+    by_total = stats.top(limit=2, order_by="total")
+    by_p99 = stats.top(limit=1, order_by="p99")
+
+    assert by_total[0]["statement"] == "SELECT ? FROM a WHERE x = ?"
+    assert by_total[0]["calls"] == 100
+    assert by_p99[0]["statement"] == "SELECT ? FROM b WHERE y = ?"
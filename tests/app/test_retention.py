@@ -0,0 +1,162 @@
+import datetime as dt
+from sqlalchemy import text
+from app.aggregates import (
+    BLOCKED_USERS,
+    FAVORITE_TRAININGS_BY_USER,
+    HISTORY_AGGREGATES,
+    HistoryAggregate,
+    NEW_TRAININGS_PER_MONTH,
+    TRAININGS_PER_TYPE,
+    TRAININGS_UPLOADS_BY_USER,
+)
+from app.history_views import view_sql
+from app.models import EntryCreate
+from app.retention import RetentionJob, retention_cutoff
+
+
+def test_cutoff_is_in_the_entries_format():
+    now = dt.datetime(2023, 6, 1, 12, 34, 56, tzinfo=dt.timezone.utc)
+
+    assert retention_cutoff(90, now) == "2023-03-03 12:34:56"
+
+
+def test_only_rollup_columns_aggregates_use_rollups():
+    assert TRAININGS_PER_TYPE.uses_rollups()
+    # Through the rolled up distinct datetimes
+    assert BLOCKED_USERS.uses_rollups()
+    assert NEW_TRAININGS_PER_MONTH.uses_rollups()
+    assert not TRAININGS_UPLOADS_BY_USER.uses_rollups()
+    assert not HistoryAggregate(
+        "by_path", "user-service", key="country", path_like="/users/%"
+    ).uses_rollups()
+    # The distinct datetimes aren't rolled up per country
+    assert not HistoryAggregate(
+        "by_country", "user-service", key="country", count_distinct="datetime"
+    ).uses_rollups()
+    assert not HistoryAggregate(
+        "users", "user-service", key="month", count_distinct="user_id"
+    ).uses_rollups()
+
+
+def test_views_add_the_rollups_to_the_entries():
+    assert TRAININGS_PER_TYPE.rollup_sql() == (
+        "SELECT training_type AS key, sum(count) AS count FROM entry_rollup "
+        "WHERE service = 'training-service' "
+        "AND action IN ('new_training') GROUP BY training_type"
+    )
+    assert TRAININGS_PER_TYPE.rollup_sql() in view_sql(TRAININGS_PER_TYPE)
+    assert "entry_rollup" not in view_sql(TRAININGS_UPLOADS_BY_USER)
+
+
+def test_distinct_datetimes_are_counted_once_over_entries_and_rollups():
+    sql = BLOCKED_USERS.all_time_sql()
+
+    assert BLOCKED_USERS.rollup_datetimes_sql() == (
+        "SELECT month AS key, datetime FROM entry_rollup_datetime "
+        "WHERE service = 'user-service' "
+        "AND path_template IN ('/users/{user_id}/block')"
+    )
+    assert BLOCKED_USERS.rollup_datetimes_sql() in sql
+    assert sql.startswith("SELECT key, count(DISTINCT datetime) AS count FROM (")
+    assert "sum(count)" not in sql
+
+
+def test_aggregates_without_rollups_only_count_the_retained_entries():
+    by_path = HistoryAggregate(
+        "by_path", "user-service", key="country", paths=("/users/",)
+    )
+    for aggregate in (
+        TRAININGS_UPLOADS_BY_USER,
+        FAVORITE_TRAININGS_BY_USER,
+        by_path,
+    ):
+        assert aggregate.all_time_sql() == aggregate.sql()
+        assert "entry_rollup" not in view_sql(aggregate)
+
+
+def entry(service, action, path, datetime, country):
+    return EntryCreate(
+        service=service,
+        path=path,
+        url=f"https://{service}.fiufit.com{path}",
+        method="POST",
+        status_code=200,
+        datetime=datetime,
+        response_time=0.1,
+        user_id="u1",
+        ip="181.0.0.1",
+        country=country,
+        action=action,
+        training_id="t1" if service == "training-service" else "",
+        training_type="running",
+    )
+
+
+def test_retention_keeps_the_all_time_counts(database):
+    from app.db import async_session, engine
+    from app.entries_utils import add_db_entries
+
+    recent = dt.datetime.now(dt.timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+    entries = [
+        # The same datetimes in several rollup buckets (countries)
+        entry(
+            "user-service", "block", "/users/u2/block", "2021-01-05 10:00:00", "Chile"
+        ),
+        entry(
+            "user-service", "block", "/users/u3/block", "2021-01-05 10:00:00", "Peru"
+        ),
+        entry(
+            "user-service", "block", "/users/u4/block", "2021-01-06 10:00:00", "Peru"
+        ),
+        entry(
+            "user-service", "block", "/users/u5/block", "2021-02-01 10:00:00", "Chile"
+        ),
+        entry("user-service", "block", "/users/u6/block", recent, "Chile"),
+        entry(
+            "training-service",
+            "new_training",
+            "/trainings/",
+            "2021-01-05 10:00:00",
+            "Chile",
+        ),
+        entry(
+            "training-service",
+            "new_training",
+            "/trainings/",
+            "2021-01-05 10:00:00",
+            "Peru",
+        ),
+        entry(
+            "training-service",
+            "new_training",
+            "/trainings/",
+            "2021-01-07 10:00:00",
+            "Peru",
+        ),
+        entry("user-service", "login", "/login/", "2021-01-05 10:00:00", "Chile"),
+        entry("user-service", "login", "/login/", recent, "Peru"),
+    ]
+
+    async def counts(conn, aggregate):
+        rows = await conn.execute(text(aggregate.all_time_sql()))
+        return sorted(tuple(row) for row in rows)
+
+    async def scenario():
+        async with async_session() as session:
+            await add_db_entries(entries, session)
+        aggregates = [a for a in HISTORY_AGGREGATES if a.uses_rollups()]
+        async with engine.connect() as conn:
+            before = {a.name: await counts(conn, a) for a in aggregates}
+        # Small batches, some split between buckets of the same datetime
+        job = RetentionJob(days=30, interval=0, batch_size=2, batch_delay=0)
+        deleted = await job.run_once()
+        async with engine.connect() as conn:
+            after = {a.name: await counts(conn, a) for a in aggregates}
+        return deleted, before, after
+
+    deleted, before, after = database(scenario)
+
+    assert deleted == 8
+    assert after == before
+    assert before["blocked_users"] == [("2021-01", 2), ("2021-02", 1), (recent[:7], 1)]
+    assert before["new_trainings_per_month"] == [("2021-01", 2)]
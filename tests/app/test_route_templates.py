@@ -0,0 +1,99 @@
+from sqlalchemy import text
+from app.aggregates import BLOCKED_USERS, USERS_AUTH
+from app.models import EntryCreate
+from app.route_templates import route_template
+
+
+def test_route_template_matches_known_routes():
+    assert route_template("/users/8f2a9c/block") == "/users/{user_id}/block"
+    assert route_template("/users/8f2a9c/block/") == "/users/{user_id}/block"
+    assert route_template("/login") == "/login/"
+    assert route_template("/login/google/?next=/home") == "/login/google/"
+    assert (
+        route_template("/users/8f2a9c/trainings/favorites/42")
+        == "/users/{user_id}/trainings/favorites/{training_id}"
+    )
+
+
+def test_route_template_replaces_ids_of_unknown_routes():
+    assert route_template("/goals/64a1f0c2e4b0a1b2c3d4e5f6/progress/7") == (
+        "/goals/{id}/progress/{id}"
+    )
+    assert route_template("/health") == "/health"
+    assert route_template("/goals/42/steps/7?page=2") == "/goals/{id}/steps/{id}"
+    assert route_template("/workouts/550E8400-E29B-41D4-A716-446655440000/laps/3") == (
+        "/workouts/{id}/laps/{id}"
+    )
+    # Not id-like
+    assert route_template("/goals/g42/steps/abc") == "/goals/g42/steps/abc"
+    assert route_template("/goals/12ab/") == "/goals/12ab"
+
+
+def test_trailing_slashes_give_the_same_template():
+    for path in ("/goals/42", "/health", "/users/8f2a9c/block", "/login"):
+        assert route_template(path + "/") == route_template(path)
+    assert route_template("/trainings/12/") == "/trainings/{training_id}"
+    assert route_template("/") == "/"
+    assert route_template("") == ""
+
+
+def test_history_aggregates_filter_on_route_templates():
+    assert "path_template IN ('/users/{user_id}/block')" in BLOCKED_USERS.sql()
+    assert "LIKE" not in BLOCKED_USERS.sql()
+    assert USERS_AUTH.sql().startswith("SELECT path_template AS key")
+
+
+def test_entries_stored_without_a_template_are_backfilled(database):
+    from app.db import async_session, engine
+    from app.entries_utils import add_db_entries
+    from app.migrations.backfill_path_templates import backfill_path_templates
+
+    def entry(path: str, action: str) -> EntryCreate:
+        return EntryCreate(
+            service="user-service",
+            path=path,
+            url=f"https://user-service.fiufit.com{path}",
+            method="POST",
+            status_code=200,
+            datetime="2023-05-01 10:00:00",
+            response_time=0.1,
+            user_id="u1",
+            ip="181.0.0.1",
+            country="Chile",
+            action=action,
+        )
+
+    async def counts():
+        async with engine.connect() as conn:
+            return [
+                dict((await conn.execute(text(aggregate.all_time_sql()))).all())
+                for aggregate in (USERS_AUTH, BLOCKED_USERS)
+            ]
+
+    async def scenario():
+        async with async_session() as session:
+            await add_db_entries(
+                [entry("/login", "login"), entry("/users/u2/block/", "block")],
+                session,
+            )
+        expected = await counts()
+        # As stored before the route templates
+        async with engine.begin() as conn:
+            await conn.execute(text("UPDATE entry_compact SET path_template_id = NULL"))
+        legacy = await counts()
+        updated = await backfill_path_templates(batch_size=1)
+        return (
+            expected,
+            legacy,
+            updated,
+            await counts(),
+            await backfill_path_templates(),
+        )
+
+    expected, legacy, updated, backfilled, again = database(scenario)
+
+    assert expected == [{"/login/": 1}, {"2023-05": 1}]
+    assert legacy == [{}, {}]
+    assert updated == 2
+    assert backfilled == expected
+    assert again == 0
@@ -0,0 +1,37 @@
+import orjson
+from app.serialization import FastJSONResponse, ResponseFormat, rows_response
+
+columns = ("id", "service", "country")
+rows = [(1, "user-service", "Argentina"), (2, "training-service", "")]
+
+
+def test_rows_response_encodes_objects():
+    response = rows_response(columns, rows)
+
+    assert orjson.loads(response.body) == [
+        {"id": 1, "service": "user-service", "country": "Argentina"},
+        {"id": 2, "service": "training-service", "country": ""},
+    ]
+
+
+def test_rows_response_encodes_column_arrays():
+    response = rows_response(columns, rows, ResponseFormat.columnar)
+    empty = rows_response(columns, [], ResponseFormat.columnar)
+
+    assert orjson.loads(response.body) == {
+        "columns": {
+            "id": [1, 2],
+            "service": ["user-service", "training-service"],
+            "country": ["Argentina", ""],
+        },
+        "count": 2,
+    }
+    assert orjson.loads(empty.body)["columns"] == {
+        "id": [],
+        "service": [],
+        "country": [],
+    }
+
+
+def test_fast_json_response_accepts_null_keys():
+    assert FastJSONResponse({None: 1, "": 2}).body == b'{"null":1,"":2}'
@@ -0,0 +1,121 @@
+import asyncio
+import os
+from app.spool import Spool, SpoolReplayer, encode_record
+
+
+def test_records_are_read_once_fsynced(tmp_path):
+    async def scenario():
+        spool = Spool(str(tmp_path), fsync_interval=0)
+        written = [spool.append(f"id-{i}", b'{"n": %d}' % i) for i in range(3)]
+        assert spool.read(10)[0] == []
+
+        await spool.sync()
+        assert all(future.done() for future in written)
+        records, position = spool.read(2)
+        assert records == [("id-0", b'{"n": 0}'), ("id-1", b'{"n": 1}')]
+
+        spool.commit(position, len(records))
+        assert spool.read(10)[0] == [("id-2", b'{"n": 2}')]
+
+    asyncio.run(scenario())
+
+
+def test_torn_tail_is_truncated_on_open(tmp_path):
+    async def scenario():
+        spool = Spool(str(tmp_path))
+        spool.append("id-0", b"complete")
+        await spool.sync()
+
+    asyncio.run(scenario())
+    segment = tmp_path / "0000000000000000.log"
+    size = segment.stat().st_size
+    with open(segment, "ab") as file:
+        file.write(encode_record("id-1", b"torn")[:-2])
+
+    async def reopen():
+        return Spool(str(tmp_path)).read(10)[0]
+
+    assert asyncio.run(reopen()) == [("id-0", b"complete")]
+    assert segment.stat().st_size == size
+
+
+def test_replayed_segments_are_deleted(tmp_path):
+    record_size = len(encode_record("id-0", b"x" * 10))
+
+    async def scenario():
+        spool = Spool(str(tmp_path), segment_bytes=2 * record_size)
+        for i in range(5):
+            spool.append(f"id-{i}", b"x" * 10)
+        await spool.sync()
+        assert len(os.listdir(tmp_path)) == 3
+
+        records, position = spool.read(4)
+        spool.commit(position, len(records))
+        assert sorted(os.listdir(tmp_path)) == ["0000000000000002.log", "checkpoint"]
+
+    asyncio.run(scenario())
+
+    async def reopen():
+        return Spool(str(tmp_path)).read(10)[0]
+
+    assert asyncio.run(reopen()) == [("id-4", b"x" * 10)]
+
+
+def test_replayer_retries_the_failed_batch(tmp_path, monkeypatch):
+    applied = []
+
+    async def noop(delay=0):
+        pass
+
+    # No backoff
+    monkeypatch.setattr(asyncio, "sleep", noop)
+
+    async def apply(records):
+        if not applied:
+            applied.append(None)
+            raise ConnectionError("database is down")
+        applied.append([message_id for message_id, _ in records])
+
+    async def scenario():
+        spool = Spool(str(tmp_path))
+        for i in range(3):
+            spool.append(f"id-{i}", b"{}")
+        await spool.sync()
+        replayer = SpoolReplayer(spool, apply, batch_size=2)
+        task = asyncio.create_task(replayer.run())
+        while spool.replayed < 3:
+            await noop()
+            await asyncio.wait([task], timeout=0.01)
+        task.cancel()
+        return replayer.failures
+
+    assert asyncio.run(scenario()) == 1
+    assert applied[1:] == [["id-0", "id-1"], ["id-2"]]
+
+
+def test_records_failing_with_data_errors_are_quarantined(tmp_path):
+    applied = []
+
+    async def apply(records):
+        if any(body == b"bad" for _, body in records):
+            raise ValueError("invalid message")
+        applied.extend(message_id for message_id, _ in records)
+
+    async def scenario():
+        spool = Spool(str(tmp_path))
+        for message_id in ("id-0", "id-1", "id-2"):
+            spool.append(message_id, b"bad" if message_id == "id-1" else b"{}")
+        await spool.sync()
+        replayer = SpoolReplayer(spool, apply, batch_size=10)
+        task = asyncio.create_task(replayer.run())
+        while spool.replayed < 3:
+            await asyncio.wait([task], timeout=0.01)
+        task.cancel()
+        return spool
+
+    spool = asyncio.run(scenario())
+    assert applied == ["id-0", "id-2"]
+    assert spool.quarantined == 1
+    assert spool.read(10)[0] == []
+    quarantine = (tmp_path / "quarantine.log").read_bytes()
+    assert quarantine == encode_record("id-1", b"bad")
@@ -0,0 +1,38 @@
+import asyncio
+import sys
+import pytest
+from app.import_timer import ImportTimer
+from app.startup import Startup
+
+
+def test_import_timer_times_first_imports_only():
+    sys.modules.pop("colorsys", None)
+    timer = ImportTimer()
+    timer.start()
+    try:
+        import colorsys  # noqa: F401
+        import json  # noqa: F401
+    finally:
+        timer.stop()
+
+    assert "colorsys" in timer.times
+    assert "json" not in timer.times
+    assert timer.top(1)[0]["module"] == "colorsys"
+
+
+def test_startup_phases_are_timed_and_failures_recorded():
+    startup = Startup()
+
+    async def scenario():
+        async with startup.phase("ok"):
+            await asyncio.sleep(0)
+        with pytest.raises(ValueError):
+            async with startup.phase("broken"):
+                raise ValueError("boom")
+
+    asyncio.run(scenario())
+
+    ok, broken = startup.phases
+    assert ok["status"] == "done" and ok["seconds"] is not None
+    assert broken["status"] == "failed"
+    assert broken["error"] == "ValueError: boom"
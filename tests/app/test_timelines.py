@@ -0,0 +1,88 @@
+import asyncio
+import pytest
+from app.entry_storage import PUBLIC_ENTRY_COLUMNS
+from app.timelines import (
+    TimelineKey,
+    TimelineOrder,
+    decode_cursor,
+    encode_cursor,
+    read_timeline,
+    timeline_sql,
+)
+
+
+class TimelineSession:
+    """
+    Answers the timeline query from a list of entries, checking the keyset
+    """
+
+    def __init__(self, entries: list):
+        self.entries = entries
+        self.params = []
+
+    async def execute(self, statement, params):
+        self.params.append(params)
+        after = (params.get("after_datetime"), params.get("after_id"))
+        rows = sorted(
+            (e["datetime"], e["id"], e)
+            for e in self.entries
+            if e["user_id"] == params["key"]
+            and (after[1] is None or (e["datetime"], e["id"]) > after)
+        )
+        return [
+            tuple(e.get(column) for column in PUBLIC_ENTRY_COLUMNS)
+            for _, _, e in rows[: params["limit"]]
+        ]
+
+
+def entry(id: int, user_id: str, datetime: str) -> dict:
+    return {"id": id, "user_id": user_id, "datetime": datetime, "action": "login"}
+
+
+def test_cursor_round_trip():
+    cursor = encode_cursor("2023-06-01 10:00:00", 42)
+
+    assert decode_cursor(cursor) == ("2023-06-01 10:00:00", 42)
+    with pytest.raises(ValueError):
+        decode_cursor("not-a-cursor")
+
+
+def test_pages_follow_the_keyset():
+    entries = [
+        entry(3, "u1", "2023-06-01 10:00:00"),
+        entry(1, "u1", "2023-06-01 10:00:00"),
+        entry(2, "u2", "2023-06-01 11:00:00"),
+        entry(4, "u1", "2023-06-02 09:00:00"),
+    ]
+    session = TimelineSession(entries)
+
+    async def pages():
+        first = await read_timeline(session, TimelineKey.user_id, "u1", limit=2)
+        second = await read_timeline(
+            session, TimelineKey.user_id, "u1", cursor=first["next"], limit=2
+        )
+        return first, second
+
+    first, second = asyncio.run(pages())
+    assert [e["id"] for e in first["entries"]] == [1, 3]
+    assert [e["id"] for e in second["entries"]] == [4]
+    assert second["next"] is None
+    assert session.params[1]["after_id"] == 3
+
+
+def test_query_seeks_the_index():
+    sql = timeline_sql(
+        TimelineKey.training_id, actions=True, after=True, order=TimelineOrder.desc
+    )
+
+    assert "WHERE training_id = :key AND training_id <> ''" in sql
+    assert "(datetime, id) < (:after_datetime, :after_id)" in sql
+    assert sql.endswith("ORDER BY datetime DESC, id DESC")
+    assert "OFFSET" not in sql
+
+
+def test_derived_columns_are_not_returned():
+    sql = timeline_sql(TimelineKey.user_id, actions=False, after=False)
+
+    assert "path_template" not in sql.split(" FROM ")[0]
+    assert "path_template" not in PUBLIC_ENTRY_COLUMNS
@@ -0,0 +1,203 @@
+import asyncio
+from sqlalchemy import text
+import app.history_views as history_views
+import app.tombstones as tombstones
+from app.aggregates import TRAININGS_PER_TYPE
+from app.data_versions import data_versions
+from app.entry_storage import ENTRY_VIEW_DDL
+from app.history_views import HistoryViewRefresher, view_name
+from app.models import EntryCreate
+from app.retention import ROLL_UP
+from app.tombstones import (
+    ADD_TOMBSTONE,
+    DELETE_BATCH,
+    DROP_TOMBSTONE,
+    add_tombstone,
+    compact_tombstone,
+)
+
+
+class Result:
+    def __init__(self, rowcount: int):
+        self.rowcount = rowcount
+
+
+class CompactConnection:
+    """
+    Deletes from a count of hidden entries, recording the statements
+    """
+
+    def __init__(self, hidden: int):
+        self.hidden = hidden
+        self.statements = []
+
+    async def execute(self, statement, params):
+        self.statements.append((statement, params))
+        if statement is DELETE_BATCH:
+            deleted = min(self.hidden, params["batch_size"])
+            self.hidden -= deleted
+            return Result(deleted)
+        return Result(1)
+
+
+def test_entries_are_deleted_in_batches_then_the_tombstone():
+    conn = CompactConnection(hidden=25)
+
+    deleted = asyncio.run(compact_tombstone(conn, "t1", 99, 10, batch_delay=0))
+
+    assert deleted == 25
+    assert [s for s, _ in conn.statements] == [DELETE_BATCH] * 3 + [DROP_TOMBSTONE]
+    assert conn.statements[-1][1] == {"training_id": "t1", "max_id": 99}
+
+
+def test_a_full_last_batch_is_followed_by_an_empty_one():
+    conn = CompactConnection(hidden=20)
+
+    assert asyncio.run(compact_tombstone(conn, "t1", 99, 10, batch_delay=0)) == 20
+    assert len(conn.statements) == 4
+
+
+def test_the_view_and_the_rollups_skip_deleted_trainings():
+    view = next(ddl for ddl in ENTRY_VIEW_DDL if "CREATE VIEW entry" in ddl)
+
+    assert "training_tombstone" in view
+    assert "training_tombstone" in ROLL_UP.text
+
+
+class TombstoneSession:
+    def __init__(self):
+        self.statements = []
+        self.committed = False
+
+    async def execute(self, statement, params):
+        self.statements.append((statement, params))
+
+    async def commit(self):
+        self.committed = True
+
+
+def test_a_tombstone_refreshes_the_views_at_once(monkeypatch):
+    refreshes = []
+    monkeypatch.setattr(
+        tombstones.history_view_refresher, "refresh_now", lambda: refreshes.append(1)
+    )
+    monkeypatch.setattr(data_versions, "pending", set())
+    session = TombstoneSession()
+
+    asyncio.run(add_tombstone("t1", session))
+
+    assert session.statements == [(ADD_TOMBSTONE, {"training_id": "t1"})]
+    assert session.committed
+    assert refreshes == [1]
+    # The training's entries may belong to any family
+    assert data_versions.pending == set(data_versions.families)
+
+
+def test_refresh_now_wakes_the_running_refresher(monkeypatch):
+    refreshes = []
+
+    async def refresh_history_views():
+        refreshes.append(1)
+        return True
+
+    monkeypatch.setattr(history_views, "refresh_history_views", refresh_history_views)
+    refresher = HistoryViewRefresher(interval=3600, max_pending=0)
+
+    async def scenario():
+        task = asyncio.create_task(refresher.run())
+        await asyncio.sleep(0)
+        refresher.refresh_now()
+        await asyncio.sleep(0.01)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    asyncio.run(scenario())
+
+    assert refreshes == [1]
+
+
+def test_refresh_now_without_the_refresher_runs_a_one_off_refresh(monkeypatch):
+    refreshes = []
+
+    async def refresh_history_views():
+        refreshes.append(1)
+        return True
+
+    monkeypatch.setattr(history_views, "refresh_history_views", refresh_history_views)
+    refresher = HistoryViewRefresher(interval=3600, max_pending=0)
+
+    async def scenario():
+        refresher.refresh_now()
+        await asyncio.gather(*refresher._tasks)
+
+    asyncio.run(scenario())
+
+    assert refreshes == [1]
+    assert not refresher._tasks
+
+
+def training_entry(training_id: str, training_type: str) -> EntryCreate:
+    return EntryCreate(
+        service="training-service",
+        path="/trainings/",
+        url="https://training-service.fiufit.com/trainings/",
+        method="POST",
+        status_code=201,
+        datetime="2023-05-01 10:00:00",
+        response_time=0.1,
+        user_id="u1",
+        ip="181.0.0.1",
+        country="Chile",
+        action="new_training",
+        training_id=training_id,
+        training_type=training_type,
+    )
+
+
+def test_the_views_stop_counting_a_deleted_training_before_the_timer(
+    database, monkeypatch
+):
+    from app.db import async_session, engine
+    from app.entries_utils import add_db_entries
+    from app.history_views import init_history_views, refresh_history_views
+
+    refresher = HistoryViewRefresher(interval=3600, max_pending=0)
+    monkeypatch.setattr(tombstones, "history_view_refresher", refresher)
+    view = view_name(TRAININGS_PER_TYPE)
+
+    async def counts():
+        async with engine.connect() as conn:
+            rows = await conn.execute(text(f"SELECT key, count FROM {view}"))
+            return dict(rows.all())
+
+    async def scenario():
+        async with async_session() as session:
+            await add_db_entries(
+                [training_entry("t1", "running"), training_entry("t2", "running")],
+                session,
+            )
+        await init_history_views()
+        async with engine.begin() as conn:
+            await data_versions.init(conn)
+        await refresh_history_views()
+        before = await counts()
+        version = data_versions.get("training-service")[0]
+
+        task = asyncio.create_task(refresher.run())
+        async with async_session() as session:
+            await add_tombstone("t1", session)
+        after = before
+        for _ in range(100):
+            await asyncio.sleep(0.05)
+            after = await counts()
+            if after != before:
+                break
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return before, after, version, data_versions.get("training-service")[0]
+
+    before, after, version, new_version = database(scenario)
+
+    assert before == {"running": 2}
+    assert after == {"running": 1}
+    assert new_version != version
@@ -0,0 +1,96 @@
+import asyncio
+import os
+import random
+import pytest
+import pytest_asyncio
+
+# The load tests run the app in-process against a local, disposable
+# database, which is truncated and seeded at the start of the session:
+#
+#   LOAD_TEST_DATABASE_URL=postgresql+asyncpg://... poetry run pytest tests/load
+#
+# They are skipped when LOAD_TEST_DATABASE_URL is not set.
+
+LOAD_TEST_DATABASE_URL = os.environ.get("LOAD_TEST_DATABASE_URL")
+LOAD_TEST_ROWS = int(os.environ.get("LOAD_TEST_ROWS", 50000))
+
+if LOAD_TEST_DATABASE_URL:
+    os.environ["DATABASE_URL"] = LOAD_TEST_DATABASE_URL
+    os.environ.pop("DATABASE_READ_URL", None)
+else:
+    collect_ignore_glob = ["test_*.py"]
+
+SERVICES = {
+    "user-service": (
+        ("signup", "/signup/", "POST"),
+        ("login", "/login/", "POST"),
+        ("google_login", "/login/google/", "POST"),
+        ("block", "/users/{user_id}/block", "PATCH"),
+        ("add_training_to_favs", "/users/{user_id}/trainings/favorites", "POST"),
+    ),
+    "training-service": (
+        ("new_training", "/trainings/", "POST"),
+        ("media_upload", "/trainings/{training_id}/media", "PATCH"),
+    ),
+}
+COUNTRIES = ("Argentina", "Brasil", "Chile", "Uruguay", "")
+TRAINING_TYPES = ("running", "cycling", "swimming", "yoga")
+
+
+def random_entry(rng: random.Random) -> dict:
+    service = rng.choice(tuple(SERVICES))
+    action, path, method = rng.choice(SERVICES[service])
+    user_id = f"user-{int(rng.paretovariate(1.2)) % 5000}"
+    training_id = f"training-{rng.randrange(2000)}"
+    path = path.format(user_id=user_id, training_id=training_id)
+    return {
+        "service": service,
+        "path": path,
+        "url": f"https://{service}.fiufit.com{path}",
+        "method": method,
+        "status_code": rng.choice((200, 200, 200, 201, 400, 500)),
+        "datetime": f"2023-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d} "
+        f"{rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}:{rng.randint(0, 59):02d}",
+        "response_time": round(rng.expovariate(10), 4),
+        "user_id": user_id,
+        "ip": f"181.{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(256)}",
+        "country": rng.choice(COUNTRIES),
+        "action": action,
+        "training_id": training_id if service == "training-service" else "",
+        "training_type": rng.choice(TRAINING_TYPES),
+    }
+
+
+@pytest.fixture(scope="session")
+def event_loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest_asyncio.fixture(scope="session")
+async def seeded_app():
+    from sqlalchemy import text
+    from app.db import async_session, engine, init_db
+    from app.entries_utils import add_db_entries
+    from app.history_views import init_history_views, refresh_history_views
+    from app.main import app
+    from app.models import EntryCreate
+
+    await init_db()
+    async with engine.begin() as conn:
+        await conn.execute(text("TRUNCATE entry_compact"))
+
+    rng = random.Random(42)
+    async with async_session() as session:
+        for start in range(0, LOAD_TEST_ROWS, 1000):
+            batch = [
+                EntryCreate(**random_entry(rng))
+                for _ in range(min(1000, LOAD_TEST_ROWS - start))
+            ]
+            await add_db_entries(batch, session)
+    await init_history_views()
+    await refresh_history_views()
+
+    yield app
+    await engine.dispose()
@@ -0,0 +1,129 @@
+import asyncio
+import json
+import os
+import time
+from collections import Counter, defaultdict
+from pathlib import Path
+
+BASELINES_PATH = Path(__file__).parent / "baselines.json"
+LOAD_TEST_REPORT = os.environ.get("LOAD_TEST_REPORT", "load_test_report.json")
+# Allowed regression over the baselines before a scenario fails
+LOAD_TEST_TOLERANCE = float(os.environ.get("LOAD_TEST_TOLERANCE", 0.25))
+LOAD_TEST_UPDATE_BASELINES = os.environ.get("LOAD_TEST_UPDATE_BASELINES") == "1"
+
+
+def percentile(ordered: list, q: float) -> float:
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+class LoadReport:
+    """
+    Latencies and errors of the requests of a scenario, per route
+    """
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = Counter()
+        self.elapsed = 0.0
+
+    def record(self, route: str, elapsed: float, ok: bool):
+        self.latencies[route].append(elapsed)
+        if not ok:
+            self.errors[route] += 1
+
+    def summary(self) -> dict:
+        summary = {}
+        for route, latencies in sorted(self.latencies.items()):
+            ordered = sorted(latencies)
+            summary[route] = {
+                "requests": len(ordered),
+                "errors": self.errors[route],
+                "throughput_rps": round(len(ordered) / self.elapsed, 2),
+                "p50_ms": round(percentile(ordered, 50) * 1000, 2),
+                "p95_ms": round(percentile(ordered, 95) * 1000, 2),
+                "p99_ms": round(percentile(ordered, 99) * 1000, 2),
+            }
+        return summary
+
+
+async def timed_request(client, report: LoadReport, method: str, url: str, **kwargs):
+    route = kwargs.pop("route", url)
+    started = time.perf_counter()
+    response = await client.request(method, url, **kwargs)
+    report.record(route, time.perf_counter() - started, response.status_code < 400)
+    return response
+
+
+async def run_scenario(client, workers: list, duration: float) -> LoadReport:
+    """
+    Runs every worker (an async function of client and report) in a loop,
+    concurrently, for the given number of seconds
+    """
+    report = LoadReport()
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + duration
+
+    async def run_worker(worker):
+        while loop.time() < deadline:
+            await worker(client, report)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(run_worker(worker) for worker in workers))
+    report.elapsed = time.perf_counter() - started
+    return report
+
+
+def check_against_baselines(scenario: str, summary: dict) -> list:
+    """
+    Stores the summary in the report file and returns the regressions over
+    the stored baselines. With LOAD_TEST_UPDATE_BASELINES=1 the summary
+    becomes the new baseline instead
+    """
+    report = {}
+    if os.path.exists(LOAD_TEST_REPORT):
+        report = json.loads(Path(LOAD_TEST_REPORT).read_text())
+    report[scenario] = summary
+    Path(LOAD_TEST_REPORT).write_text(json.dumps(report, indent=2))
+
+    baselines = json.loads(BASELINES_PATH.read_text())
+    if LOAD_TEST_UPDATE_BASELINES:
+        baselines[scenario] = summary
+        BASELINES_PATH.write_text(json.dumps(baselines, indent=2) + "\n")
+        return []
+
+    regressions = []
+    for route, baseline in baselines.get(scenario, {}).items():
+        result = summary.get(route)
+        if result is None:
+            regressions.append(f"{route}: no requests")
+            continue
+        if result["errors"]:
+            regressions.append(f"{route}: {result['errors']} failed requests")
+        for metric in ("p95_ms", "p99_ms"):
+            if result[metric] > baseline[metric] * (1 + LOAD_TEST_TOLERANCE):
+                regressions.append(
+                    f"{route}: {metric} {result[metric]} > {baseline[metric]}"
+                )
+        if result["throughput_rps"] < baseline["throughput_rps"] * (
+            1 - LOAD_TEST_TOLERANCE
+        ):
+            regressions.append(
+                f"{route}: throughput {result['throughput_rps']} rps "
+                f"< {baseline['throughput_rps']} rps"
+            )
+    return regressions
+
+
+def print_summary(scenario: str, summary: dict):
+    print(f"\n{scenario}")
+    print(
+        f"{'route':45} {'req':>7} {'err':>5} {'rps':>9} {'p50':>8} {'p95':>8} {'p99':>8}"
+    )
+    for route, result in summary.items():
+        print(
+            f"{route:45} {result['requests']:>7} {result['errors']:>5} "
+            f"{result['throughput_rps']:>9} {result['p50_ms']:>8} "
+            f"{result['p95_ms']:>8} {result['p99_ms']:>8}"
+        )
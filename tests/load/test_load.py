@@ -0,0 +1,77 @@
+import os
+import random
+import httpx
+import pytest
+from tests.load.conftest import random_entry
+from tests.load.runner import (
+    check_against_baselines,
+    print_summary,
+    run_scenario,
+    timed_request,
+)
+
+LOAD_TEST_DURATION = float(os.environ.get("LOAD_TEST_DURATION", 20))
+LOAD_TEST_DASHBOARDS = int(os.environ.get("LOAD_TEST_DASHBOARDS", 10))
+LOAD_TEST_WRITERS = int(os.environ.get("LOAD_TEST_WRITERS", 5))
+
+HISTORY_ROUTES = (
+    "/history/users_auth",
+    "/history/blocked_users",
+    "/history/users_by_location",
+    "/history/trainings_requests_count",
+    "/history/new_trainings_per_month",
+    "/history/trainings_uploads_by_user",
+    "/history/trainings_per_type",
+    "/history/favorite_trainings_per_location",
+    "/history/favorite_trainings_by_user",
+)
+
+
+async def dashboard(client, report):
+    """
+    A dashboard refresh: every history endpoint, one after the other
+    """
+    for route in HISTORY_ROUTES:
+        await timed_request(client, report, "GET", route)
+
+
+def writer(seed: int):
+    rng = random.Random(seed)
+
+    async def write(client, report):
+        response = await timed_request(
+            client, report, "POST", "/entries/", json=random_entry(rng)
+        )
+        entry_id = response.json()["id"]
+        await timed_request(
+            client, report, "GET", f"/entries/{entry_id}", route="/entries/{id}"
+        )
+
+    return write
+
+
+async def run_and_check(app, scenario: str, workers: list):
+    async with httpx.AsyncClient(app=app, base_url="http://load-test") as client:
+        report = await run_scenario(client, workers, LOAD_TEST_DURATION)
+
+    summary = report.summary()
+    print_summary(scenario, summary)
+    regressions = check_against_baselines(scenario, summary)
+    assert not regressions, "\n".join(regressions)
+
+
+@pytest.mark.load
+@pytest.mark.asyncio
+async def test_dashboard_polling(seeded_app):
+    await run_and_check(
+        seeded_app, "dashboard_polling", [dashboard] * LOAD_TEST_DASHBOARDS
+    )
+
+
+@pytest.mark.load
+@pytest.mark.asyncio
+async def test_dashboard_polling_with_writes(seeded_app):
+    workers = [dashboard] * LOAD_TEST_DASHBOARDS + [
+        writer(seed) for seed in range(LOAD_TEST_WRITERS)
+    ]
+    await run_and_check(seeded_app, "dashboard_polling_with_writes", workers)